@@ -18,15 +18,32 @@ class AsyncLibraryClass(QObject):
     # ListenerList for finished of loading the library
     finished = pyqtSignal()
 
-    # ListenerList for search complete indicating
-    search_complete = pyqtSignal(bool, str)
+    # ListenerList for search complete indicating, the results are handed over with the signal, so they are only
+    # read by the thread of the receiver
+    search_complete = pyqtSignal(bool, str, list)
 
     error_occured = pyqtSignal(str, str)
 
     MSG_LOAD_LIBRARY = "load_lib"
     MSG_SEARCH = "search"
+    MSG_SESSION_START = "session_start"
+    MSG_SESSION_CHUNK = "session_chunk"
+    MSG_SESSION_STOP = "session_stop"
     MSG_EXIT = "exit"
 
+    # Notes of a recording chunk, which start less than this after the last note of the query session, were already
+    # transcribed from the overlap with the previous chunk
+    SESSION_NOTE_TOLERANCE = 0.05
+
+    # The fingerprint-index of a library folder is stored inside of it for a fast restart
+    INDEX_SNAPSHOT_DIR = ".fingerprint_index"
+
+    # The notes of the midi files of a library folder are cached inside of it, only new or changed files are parsed
+    NOTE_CACHE_FILE = ".note_cache.pickle"
+
+    # Number of processes reading the midi files of a library, None uses all cpu cores
+    LIBRARY_LOAD_WORKERS = None
+
     def __init__(self, params):
         QObject.__init__(self)
         self.exiting = False
@@ -35,7 +52,7 @@ class AsyncLibraryClass(QObject):
         self.midi_library = None
         self.search_algorithm = None
         self.params = params
-        self.search_result = None
+        self.query_session = None
         self.transcriber = Transcriptor()
 
     @pyqtSlot()
@@ -54,15 +71,26 @@ class AsyncLibraryClass(QObject):
                 self.create_library(str_param)
             elif msg == self.MSG_SEARCH:
                 self.search(str_param, int_param)
+            elif msg == self.MSG_SESSION_START:
+                self.start_session(int_param)
+            elif msg == self.MSG_SESSION_CHUNK:
+                self.search_chunk(str_param, int_param)
+            elif msg == self.MSG_SESSION_STOP:
+                self.stop_session()
             elif msg == self.MSG_EXIT:
                 self.exiting = True
 
     def create_library(self, path):
         """ Create a new library"""
         if self.midi_library is None:
-            self.midi_library = MidiLibrary(path, self.library_update_progress)
+            note_cache = os.path.join(path, self.NOTE_CACHE_FILE) if os.path.isdir(path) else None
+            self.midi_library = MidiLibrary(path, self.library_update_progress, note_cache=note_cache,
+                                            load_workers=self.LIBRARY_LOAD_WORKERS)
+            params = dict(self.params)
+            if os.path.isdir(path):
+                params[FingerPrinting.INDEX_SNAPSHOT] = os.path.join(path, self.INDEX_SNAPSHOT_DIR)
             self.search_algorithm = FingerPrinting(self.midi_library, self.library_update_progress,
-                                                   **self.params)
+                                                   **params)
         else:
             self.midi_library._load_library(path, self.library_update_progress)
             self.search_algorithm.create_fp_from_library(self.library_update_progress)
@@ -77,14 +105,48 @@ class AsyncLibraryClass(QObject):
                 query = MidiFile(filename, path)
             else:
                 query = self.transcriber.process_file(path)
-            self.search_result = self.search_algorithm.search(query, query_name=filename,
-                                                              evaluate=False, get_top_x=n_of_results)
+            search_result = self.search_algorithm.search(query, query_name=filename,
+                                                         evaluate=False, get_top_x=n_of_results)
 
             # Signal Finished
-            self.search_complete.emit(True, "")
+            self.search_complete.emit(True, "", search_result)
+        except Exception as e:
+            print(e)
+            self.search_complete.emit(False, str(e), [])
+
+    def start_session(self, n_of_results):
+        """ Start a new query session, which is searched while the query is recorded"""
+        self.query_session = None
+        if self.search_algorithm is not None:
+            self.query_session = self.search_algorithm.create_query_session(get_top_x=n_of_results)
+
+    def stop_session(self):
+        """ Stop the query session, when the recording is stopped"""
+        self.query_session = None
+
+    def search_chunk(self, path: str, start_ms):
+        """ Transcribe the next chunk of a recording, which starts start_ms milliseconds after the
+        start of the recording, and update the results of the query session"""
+        if self.query_session is None:
+            return
+
+        try:
+            notes = self.transcriber.process_chunk(path, start_ms / 1000)[:, :2]
+            # the chunks overlap, skip the notes which were already transcribed from the previous chunk
+            if self.query_session.notes is not None and self.query_session.notes.shape[0] > 0:
+                last_position = self.query_session.notes[-1, 1]
+                notes = notes[notes[:, 1] >= last_position + self.SESSION_NOTE_TOLERANCE]
+
+            # the files are only ranked, if the next chunk is not waiting already
+            if self.messages.empty():
+                self.search_complete.emit(True, "", self.query_session.add_notes(notes))
+            else:
+                self.query_session.add_notes(notes, update_results=False)
         except Exception as e:
             print(e)
-            self.search_complete.emit(False, str(e))
+            # the session is stopped, so the error is only reported once and not for every following chunk
+            self.query_session = None
+            self.search_complete.emit(False, str(e), [])
 
     def library_update_progress(self, called_from, act, max, name):
         """ Inform listeners about loading library progress"""
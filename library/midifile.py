@@ -1,4 +1,7 @@
+import copy
 import midi
+import mmap
+import struct
 import numpy as np
 from enum import Enum
 
@@ -17,30 +20,288 @@ class DurationRepresentation(Enum):
 class MidiFile:
     """ Midi file loading / saving / manipulating the samples"""
 
+    # Fields of the note arrays returned by get_notes, pitches and indices use the smallest sufficient types to keep
+    # the notes of large libraries compact
+    NOTE_DTYPE = np.dtype([("pitch", np.int16), ("duration", np.float64), ("onset", np.float64), ("index", np.int32)])
+
+    DEFAULT_TIME_SIGNATURE = (4, 4)
+
+    class NoteReader:
+        """Reads the notes of a standard midi file directly from its bytes, without creating the event objects of
+        the midi package. Only SetTempo-, TimeSignature-, NoteOn- and NoteOff-events are decoded, all other events
+        are skipped. The notes are the same MidiFile.get_notes computes from the pattern read by midi.read_midifile."""
+
+        # Number of data bytes of the channel events by the upper nibble of their status byte
+        DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+        # get_notes ends a note with every NoteEvent of velocity 0, the midi package of upstream python-midi makes
+        # polyphonic aftertouch (0xA0) a NoteEvent, so a pressure of 0 ends the note there as well
+        AFTERTOUCH_ENDS_NOTES = issubclass(midi.AfterTouchEvent, midi.NoteEvent)
+
+        @classmethod
+        def read(cls, filename, bps):
+            """Reads the notes of all tracks of a midi file.
+            :param filename: path of the midi file
+            :param bps: beats per second until the first SetTempo-event, the tempo carries over between tracks
+            :return: resolution of the file, list of note arrays (see MidiFile.NOTE_DTYPE) for each track, the
+            beats per second after the last SetTempo-event and the tempo map, time signatures and number of ticks of
+            track 0 (see MidiFile._get_track_info)"""
+            with open(filename, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if data[:4] != b"MThd":
+                        raise Exception("{} is not a midi file".format(filename))
+                    header_size, _, nr_of_tracks, resolution = struct.unpack(">LHHH", data[4:14])
+                    offset = 14 + max(0, header_size - 6)
+
+                    tracks = []
+                    track_info = None
+                    for _ in range(nr_of_tracks):
+                        if data[offset:offset + 4] != b"MTrk":
+                            raise Exception("{} has a malformed track header".format(filename))
+                        track_size, = struct.unpack(">L", data[offset + 4:offset + 8])
+                        track = data[offset + 8:offset + 8 + track_size]
+                        offset += 8 + track_size
+
+                        notes, bps, info = cls._read_track(track, resolution, bps)
+                        tracks.append(notes)
+                        if track_info is None:
+                            track_info = info
+
+            return resolution, tracks, bps, track_info
+
+        @classmethod
+        def _read_track(cls, track, resolution, bps):
+            """Reads the notes of a single track. Like the midi package, a truncated event at the end of the track
+            is dropped silently.
+            :param track: bytes of the track chunk without its header
+            :param resolution: ticks per beat
+            :param bps: beats per second at the start of the track
+            :return: note array of the track, the beats per second at its end and the tempo map, time signatures and
+            number of ticks of the track"""
+            data_lengths = cls.DATA_LENGTHS
+            aftertouch_ends_notes = cls.AFTERTOUCH_ENDS_NOTES
+            length = len(track)
+            idx = 0
+            running_status = None
+
+            pitches = []
+            durations = []
+            onsets = []
+            pos = 0
+            tick = 0
+            ticks_per_second = resolution*bps
+            tempo_map = []
+            time_signatures = []
+            start_bps = bps
+
+            # see MidiFile.get_notes
+            pending = dict()
+            on_ticks = []
+            on_ticks_per_second = []
+
+            try:
+                while idx < length:
+                    delta = 0
+                    while True:
+                        byte = track[idx]
+                        idx += 1
+                        delta = (delta << 7) + (byte & 0x7F)
+                        if byte < 0x80:
+                            break
+
+                    status = track[idx]
+                    idx += 1
+
+                    if status == 0xFF:
+                        command = track[idx]
+                        idx += 1
+                        data_length = 0
+                        while True:
+                            byte = track[idx]
+                            idx += 1
+                            data_length = (data_length << 7) + (byte & 0x7F)
+                            if byte < 0x80:
+                                break
+                        if idx + data_length > length:
+                            break
+                        if command == 0x51:
+                            if data_length < 3:
+                                raise Exception("SetTempo-event without tempo")
+                            mpqn = (track[idx] << 16) + (track[idx + 1] << 8) + track[idx + 2]
+                            bps = float(6e7)/mpqn/60
+                            ticks_per_second = resolution*bps
+                            pos += delta/ticks_per_second
+                            tempo_map.append((pos, bps))
+                        else:
+                            pos += delta/ticks_per_second
+                            if command == 0x58 and data_length >= 2:
+                                time_signatures.append((pos, (track[idx], 2 ** track[idx + 1])))
+                        tick += delta
+                        idx += data_length
+                        continue
+
+                    if status == 0xF0:
+                        end = track.find(b"\xf7", idx)
+                        if end == -1:
+                            break
+                        idx = end + 1
+                        pos += delta/ticks_per_second
+                        tick += delta
+                        continue
+
+                    kind = status & 0xF0
+                    if kind in data_lengths:
+                        running_status = status
+                        first = track[idx]
+                        idx += 1
+                    elif status < 0x80 and running_status is not None:
+                        kind = running_status & 0xF0
+                        first = status
+                    else:
+                        raise Exception("Unsupported status byte {}".format(status))
+
+                    if data_lengths[kind] == 2:
+                        second = track[idx]
+                        idx += 1
+
+                    pos += delta/ticks_per_second
+                    tick += delta
+
+                    if kind == 0x90 and second > 0:
+                        pending.setdefault(first, []).append(len(pitches))
+                        pitches.append(first)
+                        durations.append(-1/ticks_per_second)
+                        onsets.append(pos)
+                        on_ticks.append(tick)
+                        on_ticks_per_second.append(ticks_per_second)
+                    elif kind == 0x80 or kind == 0x90 or (kind == 0xA0 and second == 0 and aftertouch_ends_notes):
+                        for note_nr in pending.pop(first, ()):
+                            durations[note_nr] = (tick - on_ticks[note_nr])/on_ticks_per_second[note_nr]
+            except IndexError:
+                # The track ends within an event
+                pass
+
+            return MidiFile._create_note_array(pitches, durations, onsets), bps, \
+                MidiFile._get_track_info(tempo_map, time_signatures, tick, start_bps)
+
+    class View:
+        """Read-only view of a MidiFile, which is created in O(1) without copying the file. The note arrays can not
+        be written and the metadata is returned as copies, clone returns a MidiFile, which can be changed."""
+
+        def __init__(self, midifile):
+            self._midifile = midifile
+
+        @property
+        def name(self):
+            return self._midifile.name
+
+        @property
+        def file_path(self):
+            return self._midifile.file_path
+
+        @property
+        def notes(self):
+            """List of read-only note arrays for each track (see MidiFile.NOTE_DTYPE)"""
+            views = []
+            for track in self._midifile.notes:
+                view = track.view()
+                view.flags.writeable = False
+                views.append(view)
+            return views
+
+        def get_metadata(self):
+            """Returns a copy of the metadata, see MidiFile.get_metadata"""
+            return copy.deepcopy(self._midifile.get_metadata())
+
+        def get_notes_for_fingerprints(self, track=0):
+            return self._midifile.get_notes_for_fingerprints(track)
+
+        def get_nr_of_notes(self, track=0):
+            return self._midifile.get_nr_of_notes(track)
+
+        def get_length(self):
+            return self._midifile.get_length()
+
+        def clone(self):
+            """Returns a copy of the MidiFile, which can be changed without affecting the viewed one"""
+            return copy.deepcopy(self._midifile)
+
+        def __str__(self):
+            return str(self._midifile)
+
+        def __repr__(self):
+            return repr(self._midifile)
+
     def __init__(self, name, filename):
-        """Opens a new midi file with given string filename"""
-        self._pattern = midi.read_midifile(filename)
+        """Opens a new midi file with given string filename. The notes are read directly from the file, the
+        pattern of midi events is only read once it is needed to manipulate or save the file."""
         self.name = name
         self.file_path = filename
+        self._loaded_pattern = None
 
-        if self._pattern.tick_relative is False:
-            self._pattern.make_ticks_rel()
+        bps = 120/60  # Get a default value, in case the midi Event is missing
 
-        self.bps = 120/60  # Get a default value, in case the midi Event is missing
-
-        self.notes = self.get_notes()
+        try:
+            self._resolution, self.notes, self.bps, track_info = self.NoteReader.read(filename, bps)
+        except Exception:
+            # Let the midi package read files the note reader does not support, or report why they are invalid
+            self.bps = bps
+            self._resolution = self._pattern.resolution
+            self.notes = self.get_notes()
+            track_info = self._track_info
 
         if len(self.notes[0]) == 0:
             raise Exception("File {} does not contain MIDI-Notes in track 0. "
                             "Only events in track 0 are used.".format(name))
 
-        self.rel_notelist = None
-        self.rel_poslist = None
-        self.rel_durlist = None
-
-        self.abs_notelist = None
-        self.abs_poslist = None
-        self.abs_durlist = None
+        self.tempo_map, self.time_signatures, n_of_ticks = track_info
+        self.duration = n_of_ticks/(self._resolution*self.bps)
+
+    @classmethod
+    def from_notes(cls, name, filename, notes, metadata):
+        """Creates a MidiFile from the notes and metadata of a file read before, without reading the file again.
+        The pattern is read from filename once it is needed.
+        :param name: name of the midi file
+        :param filename: path of the midi file
+        :param notes: list of note arrays for each track (see NOTE_DTYPE)
+        :param metadata: dict returned by get_metadata
+        :return: MidiFile"""
+        midifile = cls.__new__(cls)
+        midifile.name = name
+        midifile.file_path = filename
+        midifile._loaded_pattern = None
+        midifile.notes = notes
+        midifile._resolution = metadata["resolution"]
+        midifile.bps = metadata["bps"]
+        midifile.tempo_map = metadata["tempo_map"]
+        midifile.time_signatures = metadata["time_signatures"]
+        midifile.duration = metadata["duration"]
+        return midifile
+
+    def get_metadata(self):
+        """Returns the metadata, which is needed besides the notes to recreate the MidiFile with from_notes
+        :return: dict"""
+        return {
+            "resolution": self._resolution,
+            "bps": self.bps,
+            "tempo_map": self.tempo_map,
+            "time_signatures": self.time_signatures,
+            "duration": self.duration
+        }
+
+    def get_view(self):
+        """Returns a read-only view of the file, see MidiFile.View"""
+        return self.View(self)
+
+    @property
+    def _pattern(self):
+        """The pattern of midi events of the file, read on first access."""
+        if self._loaded_pattern is None:
+            pattern = midi.read_midifile(self.file_path)
+            if pattern.tick_relative is False:
+                pattern.make_ticks_rel()
+            self._loaded_pattern = pattern
+        return self._loaded_pattern
 
     def save(self, path, filename=None):
         """Saves the midifile to filename"""
@@ -52,7 +313,8 @@ class MidiFile:
         midi.write_midifile(store_path, self._pattern)
 
     def get_notes_for_fingerprints(self, track=0):
-        return np.delete(np.array(self.notes[track]), (1, 3), axis=1)
+        notes = self.notes[track]
+        return np.column_stack((notes["pitch"].astype(np.float64), notes["onset"]))
 
     def randomize_timings(self, deviation=0.2, probability=1.0):
         """Randomly change all notes length, a note is changed with the given
@@ -186,7 +448,7 @@ class MidiFile:
             return -1, -1
 
     def get_resolution(self):
-        return self._pattern.resolution
+        return self._resolution
 
     def get_time_signature(self):
         for track in self._pattern:
@@ -276,42 +538,94 @@ class MidiFile:
         self.notes = self.get_notes()
 
     def get_notes(self):
-        """Returns for each track a list of (note, duration)-pairs, where the pairs can
-        be a list itself, if more then one notes plays simultaneously"""
+        """Returns for each track a structured array of notes with the fields pitch, duration, onset and index
+        (see NOTE_DTYPE). The tracks are read in a single pass, every NoteOn-event is pending until the next
+        NoteOff-event of its pitch, which ends all pending notes of this pitch. Notes without NoteOff-event have
+        a duration of -1 tick."""
         tracks = []
+        track_infos = []
 
-        self.rel_notelist = None
-        self.rel_poslist = None
-        self.rel_durlist = None
-
-        self.abs_notelist = None
-        self.abs_poslist = None
-        self.abs_durlist = None
-
+        resolution = self._pattern.resolution
         for track in self._pattern:
-            tr = []
-            tracks.append(tr)
+            pitches = []
+            durations = []
+            onsets = []
             pos = 0
-            note_idx = 0
+            tick = 0
+            tempo_map = []
+            time_signatures = []
+            start_bps = self.bps
 
-            for idx, msg in enumerate(track):
+            # pitch -> numbers of the notes, whose NoteOff-event is pending, and the tick and ticks per second of
+            # the NoteOn-event of every note
+            pending = dict()
+            on_ticks = []
+            on_ticks_per_second = []
+
+            for msg in track:
 
                 if isinstance(msg, midi.SetTempoEvent):
                     self.bps = msg.bpm/60
 
-                pos += msg.tick/(self._pattern.resolution*self.bps)
-
-                if isinstance(msg, midi.NoteOnEvent) and msg.velocity > 0:
-                    _, offset = self._get_note_off_event(msg.get_pitch(), track, idx + 1)
-
-                    duration = offset/(self._pattern.resolution*self.bps)
-
-                    tr.append((msg.get_pitch(), duration, pos, note_idx))
-
-                    note_idx += 1
+                ticks_per_second = resolution*self.bps
+                pos += msg.tick/ticks_per_second
+                tick += msg.tick
+
+                if isinstance(msg, midi.MetaEvent):
+                    if isinstance(msg, midi.SetTempoEvent):
+                        tempo_map.append((pos, self.bps))
+                    elif isinstance(msg, midi.TimeSignatureEvent) and len(msg.data) >= 2:
+                        time_signatures.append((pos, (msg.get_numerator(), msg.get_denominator())))
+                elif isinstance(msg, midi.NoteEvent):
+                    pitch = msg.get_pitch()
+                    if isinstance(msg, midi.NoteOnEvent) and msg.velocity > 0:
+                        pending.setdefault(pitch, []).append(len(pitches))
+                        pitches.append(pitch)
+                        durations.append(-1/ticks_per_second)
+                        onsets.append(pos)
+                        on_ticks.append(tick)
+                        on_ticks_per_second.append(ticks_per_second)
+                    elif isinstance(msg, midi.NoteOffEvent) or msg.velocity == 0:
+                        for note_nr in pending.pop(pitch, ()):
+                            durations[note_nr] = (tick - on_ticks[note_nr])/on_ticks_per_second[note_nr]
+
+            tracks.append(self._create_note_array(pitches, durations, onsets))
+            track_infos.append(self._get_track_info(tempo_map, time_signatures, tick, start_bps))
+
+        if len(track_infos) > 0:
+            self._track_info = track_infos[0]
+            self.tempo_map, self.time_signatures, _ = self._track_info
 
         return tracks
 
+    @classmethod
+    def _create_note_array(cls, pitches, durations, onsets):
+        """Creates the note array of a track, the notes are numbered in the order of their onsets.
+        :param pitches: list of pitches
+        :param durations: list of durations in seconds
+        :param onsets: list of onsets in seconds
+        :return: structured array with NOTE_DTYPE"""
+        notes = np.empty(len(pitches), dtype=cls.NOTE_DTYPE)
+        notes["pitch"] = pitches
+        notes["duration"] = durations
+        notes["onset"] = onsets
+        notes["index"] = np.arange(len(pitches))
+        return notes
+
+    @classmethod
+    def _get_track_info(cls, tempo_map, time_signatures, n_of_ticks, start_bps):
+        """Completes the metadata of a track with the defaults for missing events.
+        :param tempo_map: list of (onset, beats per second) of the SetTempo-events
+        :param time_signatures: list of (onset, (numerator, denominator)) of the TimeSignature-events
+        :param n_of_ticks: number of ticks of the track
+        :param start_bps: beats per second at the start of the track
+        :return: (tempo_map, time_signatures, n_of_ticks)"""
+        if len(tempo_map) == 0:
+            tempo_map.append((0, start_bps))
+        if len(time_signatures) == 0:
+            time_signatures.append((0, cls.DEFAULT_TIME_SIGNATURE))
+        return tempo_map, time_signatures, n_of_ticks
+
     def get_notelist(self, track_number=0, note_representation=NoteRepresentation.ABSOLUTE,
                      duration_representation=DurationRepresentation.ABSOLUTE):
         """returns a list of notes and a list of durations, if more then one track is present,
@@ -323,21 +637,13 @@ class MidiFile:
         if updown=True, get_notelist returns only 1 for note going up, 0 if the note stays the same and
         -1 if the note is lower"""
 
-        # ts = MeasureTime(True)
-
-        # ts.timestamp("NL Start")
-        if note_representation == NoteRepresentation.ABSOLUTE and self.abs_notelist is not None:
-            return self.abs_notelist, self.abs_durlist, self.abs_poslist
-        elif note_representation == NoteRepresentation.RELATIVE and self.rel_notelist is not None:
-            return self.rel_notelist, self.rel_durlist, self.rel_poslist
-
         track = self.notes[track_number]
         notes = []
         durations = []
         positions = []
         lastpitch = 0
 
-        for pitch, duration, pos, idx in track:
+        for pitch, duration, pos, idx in track.tolist():
             if note_representation == NoteRepresentation.RELATIVE:
                 p_diff = pitch - lastpitch
             elif note_representation == NoteRepresentation.UPDOWN:
@@ -354,40 +660,12 @@ class MidiFile:
             notes = notes[1:]
             positions = positions[1:]
 
-        if note_representation == NoteRepresentation.ABSOLUTE:
-            self.abs_notelist = notes
-            self.abs_poslist = positions
-            self.abs_durlist = durations
-        elif note_representation == NoteRepresentation.RELATIVE:
-            self.rel_notelist = notes
-            self.rel_poslist = positions
-            self.rel_durlist = durations
-
         return notes, durations, positions
 
     def get_bps_and_time_sig(self):
-        track = self._pattern[0]
-        bps = []
-        time_sig = []
-        pos = 0
-
-        for idx, msg in enumerate(track):
-            pos += msg.tick / (self._pattern.resolution * self.bps)
-
-            if isinstance(msg, midi.SetTempoEvent):
-                self.bps = msg.bpm/60
-                bps.append((pos, self.bps))
-
-            if isinstance(msg, midi.TimeSignatureEvent):
-                time_sig.append((pos, (msg.get_numerator(), msg.get_denominator())))
-
-        if len(bps) == 0:
-            bps.append((0, self.bps))
-
-        if len(time_sig) == 0:
-            time_sig.append((0, (4, 4)))
-
-        return bps, time_sig
+        """Returns the tempo map and the time signatures of track 0 as lists of (onset, beats per second) and
+        (onset, (numerator, denominator))"""
+        return list(self.tempo_map), list(self.time_signatures)
 
     def get_nr_of_notes(self, track=0):
         return len(self.notes[track])
@@ -399,9 +677,7 @@ class MidiFile:
         return self.name + "\n"
 
     def get_length(self):
-        mf = midi.read_midifile(self.file_path)
-        mf.make_ticks_abs()
-        return mf[0][-1].tick /(mf.resolution*self.bps)
+        return self.duration
 
 def main():
     pass
@@ -2,6 +2,9 @@ from library.midifile import MidiFile
 import os
 import numpy as np
 import copy
+import itertools
+import multiprocessing
+import pickle
 
 
 class MidiLibrary:
@@ -12,6 +15,14 @@ class MidiLibrary:
 
     TEST_SPECIFICATION_FILE = 'test_specification.dict'
 
+    # Default number of processes reading the midi files of the library, None uses all cpu cores
+    DEFAULT_LOAD_WORKERS = 1
+    # Number of files read by a worker at once
+    LOAD_WORKER_BATCH_SIZE = 64
+    # The workers are started as new processes instead of forks, the library can be loaded while other threads run
+    # (e.g. in the gui), whose locks would be copied into forked workers
+    LOAD_WORKER_START_METHOD = "spawn"
+
     # Keys for test dictionary
     PITCH_DEVIATION = "PITCH_DEVIATION"
     DURATION_DEVIATION = "DURATION_DEVIATION"
@@ -162,12 +173,128 @@ class MidiLibrary:
         }
     }
 
-    def __init__(self, path, notify_init_status=None):
+    class NoteCache:
+        """
+        Stores the notes and metadata of the loaded midi files in a single file, so unchanged files do not have to be
+        parsed again, when the library is opened the next time. The entries are keyed by the absolute path of a file
+        and are only used as long as its size and modification time are unchanged.
+        """
+
+        # Cache layout, the version has to be increased whenever the stored notes or metadata change
+        VERSION = 1
+
+        def __init__(self, path):
+            """
+            :param path: path of the cache file, it is loaded if it exists
+            """
+            self.path = path
+            # absolute path -> (size, modification time, metadata, list of note arrays)
+            self.entries = dict()
+            self.changed = False
+            self.hits = 0
+            self.misses = 0
+
+            if os.path.exists(path):
+                try:
+                    self._load()
+                except Exception as e:
+                    print(e)
+                    self.entries.clear()
+
+        def _load(self):
+            with open(self.path, 'rb') as f:
+                cache = pickle.load(f)
+
+            if cache.get("version", None) != self.VERSION or cache["dtype"] != MidiFile.NOTE_DTYPE.descr:
+                raise Exception("Note cache {} has version {}, expected {}".format(self.path,
+                                                                                 cache.get("version", None),
+                                                                                 self.VERSION))
+
+            # The notes of all files are stored in a single array, every file gets views of its tracks
+            offsets = np.cumsum([n_of_notes for _, _, _, track_lengths in cache["entries"]
+                                 for n_of_notes in track_lengths])
+            tracks = np.split(cache["notes"], offsets[:-1]) if len(offsets) > 0 else []
+            track_idx = 0
+            for path, (size, mtime, metadata, track_lengths) in zip(cache["paths"], cache["entries"]):
+                self.entries[path] = (size, mtime, metadata, tracks[track_idx:track_idx + len(track_lengths)])
+                track_idx += len(track_lengths)
+
+        @staticmethod
+        def get_key(path):
+            """
+            :param path: path of a midi file
+            :return: (absolute path, size, modification time in ns) of the file
+            """
+            stat = os.stat(path)
+            return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+        def get(self, key):
+            """
+            Returns the notes and metadata of a cached file
+            :param key: key of the file returned by get_key
+            :return: (list of note arrays, metadata) or None, if the file is not cached or was changed
+            """
+            path, size, mtime = key
+            entry = self.entries.get(path, None)
+            if entry is None or entry[0] != size or entry[1] != mtime:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry[3]), entry[2]
+
+        def put(self, key, notes, metadata):
+            """
+            Adds the notes and metadata of a parsed file
+            :param key: key of the file returned by get_key before it was parsed
+            :param notes: list of note arrays
+            :param metadata: metadata returned by MidiFile.get_metadata
+            :return: None
+            """
+            path, size, mtime = key
+            self.entries[path] = (size, mtime, metadata, list(notes))
+            self.changed = True
+
+        def save(self):
+            """
+            Writes the cache file, if entries were added. Entries of files, which do not exist anymore, are dropped.
+            :return: None
+            """
+            for path in [path for path in self.entries if not os.path.exists(path)]:
+                del self.entries[path]
+                self.changed = True
+
+            if not self.changed:
+                return
+
+            paths = list(self.entries)
+            entries = [self.entries[path] for path in paths]
+            tracks = [notes for _, _, _, file_tracks in entries for notes in file_tracks]
+            cache = {
+                "version": self.VERSION,
+                "dtype": MidiFile.NOTE_DTYPE.descr,
+                "paths": paths,
+                "entries": [(size, mtime, metadata, [len(notes) for notes in file_tracks])
+                            for size, mtime, metadata, file_tracks in entries],
+                "notes": np.concatenate(tracks) if len(tracks) > 0 else np.empty(0, dtype=MidiFile.NOTE_DTYPE)
+            }
+
+            # Write a temporary file first, an incomplete cache file is never loaded
+            with open(self.path + ".tmp", 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.path + ".tmp", self.path)
+            self.changed = False
+
+    def __init__(self, path, notify_init_status=None, note_cache=None, load_workers=DEFAULT_LOAD_WORKERS):
         """Initializes the library, if a path is a directory,
         load all midifiles in that directory
         if path specifies a midifile, only that file is loaded.
-        :param path: Path to a folder containing midi-files"""
+        :param path: Path to a folder containing midi-files
+        :param note_cache: Optional path of a file, which caches the notes of the loaded midi-files, so only new or
+        changed files are parsed when the library is opened again
+        :param load_workers: Number of processes reading the midi-files, None uses all cpu cores"""
         self._database = dict()
+        self._note_cache = self.NoteCache(note_cache) if note_cache is not None else None
+        self.load_workers = load_workers
 
         self._load_library(path, notify_init_status)
         self.test_specification = {}
@@ -185,35 +312,85 @@ class MidiLibrary:
         if not os.path.exists(path):
             return False
 
-        max_files = 1
-
-        # load all midi files in this dir
+        # Collect the files first, so they can be read by several processes
         if os.path.isdir(path):
-            dir_entries = os.listdir(path)
-            max_files = len(dir_entries)
-
-            for idx, file in enumerate(dir_entries):
-                if notify_init_status is not None:
-                    notify_init_status("lib", idx, max_files, file)
-                if os.path.isdir(path + "/" + file):
-                    self._load_recursive(path + "/" + file, file, notify_init_status)
-                if file.endswith(".mid"):
-                    self._add_file_to_library(path + "/" + file, file, notify_init_status)
+            files = self._find_midifiles(path)
         elif os.path.isfile(path):
-            self._add_file_to_library(path, notify_init_status)
+            files = [(path, None)]
+        else:
+            files = []
+
+        max_files = len(files)
+        for idx, ((file_path, name), parsed) in enumerate(zip(files, self._read_midifiles(
+                [file_path for file_path, _ in files]))):
+            if notify_init_status is not None:
+                notify_init_status("lib", idx, max_files, name if name is not None else file_path)
+            self._add_file_to_library(file_path, name, parsed, notify_init_status)
 
         if notify_init_status is not None:
             notify_init_status("lib", max_files, max_files, "")
 
+        if self._note_cache is not None:
+            try:
+                self._note_cache.save()
+            except OSError as e:
+                print(e)
+
         return True
 
-    def _load_recursive(self, path, name_prefix, notify_init_status=None):
-        # load all midi files in this dir
+    def _find_midifiles(self, path, name_prefix=None):
+        """Finds all midi-files in a directory and its subdirectories
+        :param path: Path to a folder containing midi-files
+        :param name_prefix: Name of the folder inside of the library, None for the top folder
+        :return: list of (path, name) of the midi-files"""
+        files = []
         for file in os.listdir(path):
+            name = file if name_prefix is None else name_prefix + "/" + file
             if os.path.isdir(path + "/" + file):
-                self._load_recursive(path + "/" + file, name_prefix + "/" + file, notify_init_status)
+                files.extend(self._find_midifiles(path + "/" + file, name))
             if file.endswith(".mid"):
-                self._add_file_to_library(path + "/" + file, name_prefix + "/" + file, notify_init_status)
+                files.append((path + "/" + file, name))
+        return files
+
+    def _read_midifiles(self, paths):
+        """Reads the notes of midi-files. Files, which are not in the note cache, are read in batches, which are
+        distributed over self.load_workers processes if more than one batch has to be read.
+        :param paths: list of paths of midi-files
+        :return: generator of (list of note arrays, metadata) in the order of paths, the raised exception is
+                 returned instead for files that could not be read"""
+        keys = [None] * len(paths)
+        results = [None] * len(paths)
+        if self._note_cache is not None:
+            for idx, path in enumerate(paths):
+                try:
+                    keys[idx] = self._note_cache.get_key(path)
+                    results[idx] = self._note_cache.get(keys[idx])
+                except OSError as e:
+                    results[idx] = e
+
+        missing = [path for path, result in zip(paths, results) if result is None]
+        batches = [missing[start:start + self.LOAD_WORKER_BATCH_SIZE]
+                   for start in range(0, len(missing), self.LOAD_WORKER_BATCH_SIZE)]
+
+        workers = min(self.load_workers or os.cpu_count() or 1, len(batches))
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.get_context(self.LOAD_WORKER_START_METHOD).Pool(workers)
+            parsed = pool.imap(_read_midifile_batch, batches)
+        else:
+            parsed = map(_read_midifile_batch, batches)
+
+        try:
+            parsed = itertools.chain.from_iterable(parsed)
+            for key, result in zip(keys, results):
+                if result is None:
+                    result = next(parsed)
+                    if key is not None and not isinstance(result, Exception):
+                        self._note_cache.put(key, *result)
+                yield result
+        finally:
+            if pool is not None:
+                pool.terminate()
 
     def get_midifiles(self, idx=None, get_copy=False):
         """Returns a numpy-array of midifiles, selected by idx, or all of them if no indices are provided.
@@ -234,32 +411,79 @@ class MidiLibrary:
         return self._database.keys()
 
     def get_midifile(self, key):
-        """Returns the copy of a midifile specified by its name as key.
+        """Returns the copy of a midifile specified by its name as key, which can be changed without affecting the
+        library. Use get_midifile_view to only read the midifile.
         :param key: name of a midi-file"""
         try:
             return copy.deepcopy(self._database[key])
         except KeyError:
             return None
 
-    def _add_file_to_library(self, path, filename=None, notify_init_status=None):
+    def get_midifile_view(self, key):
+        """Returns a read-only view of a midifile specified by its name as key, without copying it.
+        :param key: name of a midi-file
+        :return: MidiFile.View or None, if the library does not contain the midifile"""
+        midifile = self._database.get(key, None)
+        if midifile is None:
+            return None
+        return midifile.get_view()
+
+    def contains_midifile(self, key):
+        """Returns True, if the library contains a midifile with the name key
+        :param key: name of a midi-file"""
+        return key in self._database
+
+    def _add_file_to_library(self, path, filename, parsed, notify_init_status=None):
         """Adds a file to the library. Qualifies by path, if
         entry with same name is already inside.
-        :param path: path to midi-file or a folder containing midifiles.
-        :param filename: Optional filename for a given path"""
+        :param path: path to midi-file
+        :param filename: Optional filename for a given path
+        :param parsed: (list of note arrays, metadata) of the midi-file, or the exception raised while reading it
+        :return: True, if the file was added"""
         if filename is None:
-            with open(path, 'rb') as f:
-                filename = f.name
+            filename = path
 
-        m = self.get_midifile(filename)
-        if m is not None:
+        if self.contains_midifile(filename):
             filename = path
 
-        try:
-            # ignore io-errors, or if the file actually isn't a midi-file
-            mf = MidiFile(filename, path)
-            self._database[filename] = mf
-        except:
-            notify_init_status("excpetion", -1, -1, "{} containts too few notes".format(filename))
+        # report io-errors, or if the file actually isn't a midi-file
+        if isinstance(parsed, Exception):
+            if notify_init_status is not None:
+                notify_init_status("excpetion", -1, -1, "{} could not be loaded: {}".format(filename, parsed))
+            else:
+                print(parsed)
+            return False
+
+        notes, metadata = parsed
+        self._database[filename] = MidiFile.from_notes(filename, path, notes, metadata)
+        return True
+
+    def remove_midifile(self, key):
+        """Removes a midifile from the library.
+        :param key: name of a midi-file
+        :return: True, if the midifile was in the library"""
+        return self._database.pop(key, None) is not None
+
+    def update_midifile(self, key, path=None):
+        """Loads a changed midifile again and replaces it in the library.
+        :param key: name of a midi-file
+        :param path: path of the changed midi-file, if None the path it was loaded from is used"""
+        if path is None:
+            path = self._database[key].file_path
+
+        # the changed file is parsed again, as its size or modification time differs from the cached entry
+        parsed = next(self._read_midifiles([path]))
+        if isinstance(parsed, Exception):
+            raise parsed
+
+        notes, metadata = parsed
+        self._database[key] = MidiFile.from_notes(key, path, notes, metadata)
+
+        if self._note_cache is not None:
+            try:
+                self._note_cache.save()
+            except OSError as e:
+                print(e)
 
     def get_length(self):
         """returns the amount of midifiles stored in the database"""
@@ -583,6 +807,20 @@ class MidiLibrary:
         self.evaluation_queries.clear()
 
 
+def _read_midifile_batch(paths):
+    """ Reads the notes and metadata of a batch of midi-files, also inside of a worker process
+    :param paths: list of paths of midi-files
+    :return: list of (list of note arrays, metadata), the exception is returned instead for files that failed"""
+    results = []
+    for path in paths:
+        try:
+            midifile = MidiFile(path, path)
+            results.append((midifile.notes, midifile.get_metadata()))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 def main():
     print(np.ceil(-1.5))
 
@@ -36,14 +36,22 @@ class ApplicationWindow(QMainWindow):
         FingerPrinting.TDR_RANGE: 8.0,
         FingerPrinting.USE_VERIFICATION: False,
         FingerPrinting.ELIMINATE_TOP_PERCENTILE: 99,
+        FingerPrinting.PRUNE_STOP_LIST: True,
         FingerPrinting.SPLIT_QUERIES_LONGER_THAN: 20,
         FingerPrinting.SPLIT_QUERIES_SLIDING_WINDOW: 5,
-        FingerPrinting.SPLIT_QUERY_LENGTH: 20
+        FingerPrinting.SPLIT_QUERY_LENGTH: 20,
+        FingerPrinting.INDEX_WORKERS: None,
+        FingerPrinting.SEARCH_WORKERS: None,
+        FingerPrinting.RESULT_CACHE_SIZE: 32 * 2**20
     }
 
     library_msg = pyqtSignal(str, str, int)
 
     TMP_QUERY_NAME = "new_query_{}.wav"
+    TMP_CHUNK_NAME = "record_chunk_{}.wav"
+
+    # While recording, the recorded audio is searched in chunks, which overlap the previous chunk by some seconds
+    RECORD_CHUNK_OVERLAP = 0.5
 
     DEFAULT_PLAYER_TEXT = "Please select a query"
 
@@ -67,6 +75,7 @@ class ApplicationWindow(QMainWindow):
         self.tmp_dir = tempfile.TemporaryDirectory()
         self.tmp_dir_path = self.tmp_dir.name
         self.tmp_query_path = self.tmp_dir_path + "/" + self.TMP_QUERY_NAME
+        self.tmp_chunk_path = self.tmp_dir_path + "/" + self.TMP_CHUNK_NAME
 
         self.query_path = ""
         self.last_query_path = "."
@@ -81,6 +90,8 @@ class ApplicationWindow(QMainWindow):
         self.music_slider_is_pressed = False
 
         self.select_notes = None
+        # results of the last search, they are received with the search_complete signal of the library worker
+        self.search_result = []
 
         self.library_load_dialog = None
         self.library_worker = AsyncLibraryClass(self.FINGERPRINTING_PARAMETERS)
@@ -102,6 +113,8 @@ class ApplicationWindow(QMainWindow):
         self.record_stream = None
         self.pyaudio = pyaudio.PyAudio()
         self.recorded_frames = []
+        self.streamed_frames = 0
+        self.n_of_chunks = 0
         self.record_length = 0
         self.record_timer = QTimer(self)
         self.record_timer_interval = 1.0
@@ -211,7 +224,7 @@ class ApplicationWindow(QMainWindow):
         """ Callback after an item in the database list was double clicked.
         Loads the clicked item into the view"""
         db_item = self.ui.database_item_list_widget.item(item.row()).text()
-        mf = self.midi_library.get_midifile(db_item)
+        mf = self.midi_library.get_midifile_view(db_item)
         self.ui.currently_playing_label.setText(db_item)
         self.select_notes = None
         self.query_path = mf.file_path
@@ -345,6 +358,8 @@ class ApplicationWindow(QMainWindow):
             self.record_stream.stop_stream()
             self.record_stream.close()
             self.set_view_to_recording(False)
+            if self.midi_library is not None:
+                self.library_msg.emit(AsyncLibraryClass.MSG_SESSION_STOP, "", 0)
             self.create_new_query()
         else:
             self.ui.music_position_slider.setSliderPosition(0)
@@ -438,6 +453,10 @@ class ApplicationWindow(QMainWindow):
                 self.set_view_to_recording(True)
                 self.update_music_duration_label(0, 0)
                 self.recorded_frames.clear()
+                self.streamed_frames = 0
+                # search the recording while it is recorded
+                if self.midi_library is not None:
+                    self.library_msg.emit(AsyncLibraryClass.MSG_SESSION_START, "", self.DISPLAY_N_RESULTS)
                 # use settings from MAIN
                 self.record_stream = self.pyaudio.open(format=self.FORMAT,
                                                        channels=self.CHANNELS,
@@ -470,13 +489,14 @@ class ApplicationWindow(QMainWindow):
         self.library_msg.emit(AsyncLibraryClass.MSG_SEARCH, self.query_path, self.DISPLAY_N_RESULTS)
         self.search_spinner.start()
 
-    def search_completed(self, succes, err_msg):
+    def search_completed(self, succes, err_msg, search_result):
         """ Callback after search was completed."""
         self.search_spinner.stop()
         if succes:
             # When successfully searched, load results into the result table
+            self.search_result = search_result
             self.ui.result_table.setRowCount(0)
-            for rank, (name, (score, perc_score), (start, end)) in enumerate(self.library_worker.search_result, 1):
+            for rank, (name, (score, perc_score), (start, end)) in enumerate(self.search_result, 1):
                 self.ui.result_table.insertRow(self.ui.result_table.rowCount())
                 item = QTableWidgetItem(str(rank))
                 item.setTextAlignment(Qt.AlignHCenter)
@@ -501,10 +521,10 @@ class ApplicationWindow(QMainWindow):
     def result_selected(self, item):
         """ Callback after double click result. Load result of query into view and player"""
         db_item = self.ui.result_table.item(item.row(), 4).text()
-        mf = self.midi_library.get_midifile(db_item)
+        mf = self.midi_library.get_midifile_view(db_item)
         self.ui.currently_playing_label.setText(db_item)
 
-        self.select_notes = self.library_worker.search_result[item.row()][2]
+        self.select_notes = self.search_result[item.row()][2]
         self.query_path = mf.file_path
         self.player.load(mf.file_path)
         self.search_spinner.start()
@@ -543,6 +563,27 @@ class ApplicationWindow(QMainWindow):
         """ Callback of Timerthread to update recording time"""
         self.record_length += self.record_timer_interval
         self.update_music_duration_label(self.record_length, 0)
+        if self.midi_library is not None:
+            self.search_recorded_chunk()
+
+    def search_recorded_chunk(self):
+        """ Save the audio recorded since the last chunk into the tmp directory and search it"""
+        n_of_frames = len(self.recorded_frames)
+        if n_of_frames == self.streamed_frames:
+            return
+
+        first_frame = max(0, self.streamed_frames - int(self.RECORD_CHUNK_OVERLAP * self.RATE / self.CHUNK))
+        self.n_of_chunks += 1
+        path = self.tmp_chunk_path.format(self.n_of_chunks)
+        with wave.open(path, 'w') as wav:
+            wav.setnchannels(self.CHANNELS)
+            wav.setsampwidth(self.pyaudio.get_sample_size(self.FORMAT))
+            wav.setframerate(self.RATE)
+            wav.writeframes(b''.join(self.recorded_frames[first_frame:n_of_frames]))
+
+        self.streamed_frames = n_of_frames
+        self.library_msg.emit(AsyncLibraryClass.MSG_SESSION_CHUNK, path,
+                              int(first_frame * self.CHUNK / self.RATE * 1000))
 
 
 def main():
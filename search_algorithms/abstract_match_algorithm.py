@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from library.midilibrary import MidiLibrary
+from library.midifile import MidiFile
 import numpy as np
 from search_algorithms.timemeasure import MeasureTime
 
@@ -36,6 +37,36 @@ class AbstractMatchClass(ABC):
         query_name: optional give a name to the query, if query is no MidiFile-Object
         """
 
+    def search_rank(self, query, query_name=""):
+        """Returns only the result of the file the query was taken from, as tuple of (score, rank, start_of_best_match)
+        like the entry in the dictionary returned by search(evaluate=True), or None if the file was not found.
+        Algorithms can override this to avoid ranking all files of the database.
+        query_name: name of the file the query was taken from, if query is no MidiFile-Object
+        """
+        if isinstance(query, MidiFile):
+            query_name = query.name
+        return self.search(query, query_name=query_name, evaluate=True).get(query_name, None)
+
+    def search_ranks(self, queries, query_names=None):
+        """Returns a generator of the search_rank results of several queries.
+        Algorithms can override this to process the queries together.
+        query_names: names of the files the queries were taken from, if the queries are no MidiFile-Objects
+        """
+        if query_names is None:
+            query_names = [""] * len(queries)
+        for query, query_name in zip(queries, query_names):
+            yield self.search_rank(query, query_name)
+
+    def search_many(self, queries, query_names=None, evaluate=False, get_top_x=1):
+        """Returns the search results of several queries as list, see search.
+        Algorithms can override this to process the queries together.
+        query_names: optional names of the queries, if the queries are no MidiFile-Objects
+        """
+        if query_names is None:
+            query_names = [""] * len(queries)
+        return [self.search(query, query_name=query_name, evaluate=evaluate, get_top_x=get_top_x)
+                for query, query_name in zip(queries, query_names)]
+
     @abstractmethod
     def get_algorithm_name(self):
         pass
@@ -105,14 +136,16 @@ class AbstractMatchClass(ABC):
                       "------------------------------------------------|")
         self._print_v(self.timestamp_level == 0 and verbose, "|", end="")
 
-        # call search for every query specified for this test
+        # call search for every query specified for this test, every query is searched on its own, so the measured
+        # time of a query only contains its own search (search_ranks would charge a whole batch to one query)
         for idx, query in enumerate(queries):
             self._print_v(
                 self.timestamp_level == 0 and verbose, "\r" + "|" + "=" * (1 + int(idx / len(queries) * 100 + 0.5)), end="")
 
-            try:
-                (score, _), rank, _ = self.search(query, evaluate=True)[query.name]
-            except KeyError:
+            result = self.search_rank(query)
+            if result is not None:
+                (score, _), rank, _ = result
+            else:
                 score = 0
                 rank = 0xFFFFFFFF
 
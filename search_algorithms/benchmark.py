@@ -0,0 +1,856 @@
+"""
+Benchmarks for the fingerprint index and search.
+
+Usage: python -m search_algorithms.benchmark <benchmark> <library path>
+"""
+from library.midilibrary import MidiLibrary
+from library.midifile import MidiFile
+from search_algorithms.fingerprinting import FingerPrinting
+from search_algorithms.fingerprint_index import FingerPrintIndex
+from search_algorithms.sharded_fingerprinting import ShardedFingerPrinting
+from search_algorithms.timemeasure import MeasureTime
+import midi
+import numpy as np
+import os
+import sys
+import tempfile
+import tracemalloc
+
+NOTTINGHAM_PATH = "midifiles/nottingham-dataset-master/MIDI"
+
+
+def index_memory(library_path, params=FingerPrinting.PARAM_SETTING_3):
+    """
+    Measures the memory allocated for the fingerprint-index of a library with tracemalloc and
+    prints the bytes used per stored posting.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :return: (number of postings, allocated bytes per posting, array bytes per posting)
+    """
+    library = MidiLibrary(library_path)
+
+    ts = MeasureTime()
+    tracemalloc.start()
+    ts.timestamp("Start")
+    fingerprinting = FingerPrinting(library, **params)
+    ts.timestamp("Index")
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    postings = fingerprinting.get_hash_value_lengths().sum()
+    array_bytes = fingerprinting.get_index().get_nbytes()
+
+    print("Postings: {:d}, hashes: {:d}, build time: {:.2f}s".format(int(postings),
+                                                                    len(fingerprinting.get_hash_value_lengths()),
+                                                                    ts.get_whole_time_span()))
+    print("Allocated: {:.1f} MB, {:.1f} bytes/posting".format(allocated / 2**20, allocated / postings))
+    print("Index arrays: {:.1f} MB, {:.1f} bytes/posting".format(array_bytes / 2**20, array_bytes / postings))
+
+    # the same index with the postings of the stop list dropped
+    if params.get(FingerPrinting.ELIMINATE_TOP_PERCENTILE, None) is not None:
+        pruned_params = dict(params)
+        pruned_params[FingerPrinting.PRUNE_STOP_LIST] = True
+        pruned = FingerPrinting(library, **pruned_params)
+        pruned_buckets, pruned_postings, freed = pruned.get_stop_list_statistics()
+        print("Pruned stop list: {:d} buckets, {:d} postings ({:.1f}%), freed: {:.1f} MB".format(
+            pruned_buckets, pruned_postings, pruned_postings / postings * 100, freed / 2**20))
+        print("Pruned index arrays: {:.1f} MB".format(pruned.get_index().get_nbytes() / 2**20))
+
+    return postings, allocated / postings, array_bytes / postings
+
+
+def _select_next_events_loop(fingerprinting, notes, start_idx, n_events):
+    """
+    Reference for fingerprint_creation: selects the following events of a note like
+    FingerPrinting._select_next_events did before, by stepping through the notes one after the other
+    :param fingerprinting: FingerPrinting with the settings
+    :param notes: notes of a file
+    :param start_idx: index of the note
+    :param n_events: number of events to select
+    :return: the index of the first selected event, or -1 if there is none
+    """
+    p, pos = notes[start_idx]
+    idx = start_idx + 1
+    while idx < len(notes):
+        p_next, pos_next = notes[idx]
+        if abs(pos_next - pos) >= fingerprinting.d and abs(p_next - p) <= fingerprinting.pitch_diff:
+            return idx, notes[idx:idx + n_events]
+        idx += 1
+    return -1, []
+
+
+def _create_fingerprint_loop(fingerprint, events):
+    """
+    Reference for fingerprint_creation: calculates the hash of a single fingerprint like the FingerPrint-class did
+    before create_hashes
+    :param fingerprint: FingerPrinting.FingerPrint with the settings of the hash function
+    :param events: list of the N (pitch, position) events of the fingerprint
+    :return: (hash, pos1, td12)
+    """
+    td12 = events[1][1] - events[0][1]
+    td23 = events[2][1] - events[1][1]
+
+    if td23 > td12:
+        tdr = abs(td23 / td12)
+    else:
+        tdr = abs(td12 / td23)
+
+    tdr = tdr * fingerprint.TDR_K + fingerprint.TDR_D
+
+    if td23 > td12:
+        tdr = fingerprint.TDR_RESOLUTION / 2 + tdr
+    else:
+        tdr = fingerprint.TDR_RESOLUTION / 2 - tdr
+
+    tdr = int(max(min(tdr, fingerprint.TDR_RESOLUTION - 1), 0)) & fingerprint.TDR_MASK
+
+    p = [event[0] for event in events]
+    if fingerprint.TDR_HASH_TYPE == fingerprint.TDR_HASH_1:
+        h = ((int(p[0]) & 0x7F) << 25) | ((int(p[1]) & 0x7F) << 18) | ((int(p[2]) & 0x7F) << 11) | tdr
+    elif fingerprint.TDR_HASH_TYPE == fingerprint.TDR_HASH_2:
+        h = ((int(p[1] - p[0]) & 0xFF) << 24) | ((int(p[2] - p[1]) & 0xFF) << 16) | tdr
+    else:
+        h = ((int(p[1] - p[0]) & 0xFF) << 24) | ((int(p[2] - p[1]) & 0xFF) << 16) | \
+            ((int(p[3] - p[2]) & 0xFF) << 8) | tdr
+
+    return h, events[0][1], td12
+
+
+def _create_fingerprints_loops(fingerprinting, notes, remove_doubles):
+    """
+    Reference for fingerprint_creation: creates the fingerprints of a file like create_fingerprints did before it
+    was vectorized, by enumerating the note combinations in nested loops
+    :param fingerprinting: FingerPrinting with the settings
+    :param notes: notes of a file
+    :param remove_doubles: only the first fingerprint of every hash value is kept if True
+    :return: list of (hash, pos1, td12) and the number of created fingerprints
+    """
+    notes = notes.tolist()
+    fingerprints = []
+    seen = set()
+    created = 0
+
+    def add(events):
+        fingerprint = _create_fingerprint_loop(fingerprinting.fingerprint, events)
+        if not remove_doubles or fingerprint[0] not in seen:
+            fingerprints.append(fingerprint)
+            seen.add(fingerprint[0])
+
+    for idx, e1 in enumerate(notes):
+        idx2, evt2 = _select_next_events_loop(fingerprinting, notes, idx, fingerprinting.n[0])
+        for offset2, e2 in enumerate(evt2):
+            idx3, evt3 = _select_next_events_loop(fingerprinting, notes, idx2 + offset2, fingerprinting.n[1])
+            for offset3, e3 in enumerate(evt3):
+                if fingerprinting.N == 3:
+                    created += 1
+                    add((e1, e2, e3))
+                else:
+                    _, evt4 = _select_next_events_loop(fingerprinting, notes, idx3 + offset3, fingerprinting.n[2])
+                    for e4 in evt4:
+                        created += 1
+                        add((e1, e2, e3, e4))
+
+    return fingerprints, created
+
+
+def fingerprint_creation(library_path, params=FingerPrinting.PARAM_SETTING_3, max_reference_files=100):
+    """
+    Measures the time needed to create the fingerprints of all files of a library and checks for the first files,
+    that hashes, pos1 and td12 equal the ones of the loops, which created the fingerprints before
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param max_reference_files: number of files, which are compared with the loops
+    :return: (number of created fingerprints, fingerprints per second)
+    """
+    library = MidiLibrary(library_path)
+    fingerprinting = FingerPrinting(MidiLibrary(None), **params)
+    notes = [(midifile.name, midifile.get_notes_for_fingerprints()) for midifile in library.get_midifiles()]
+
+    ts = MeasureTime()
+    ts.timestamp("Start")
+    created = 0
+    for name, file_notes in notes:
+        created += fingerprinting.create_fingerprints(file_notes, name)[1]
+    ts.timestamp("Fingerprints")
+
+    time_span = ts.get_whole_time_span()
+    print("Files: {:d}, fingerprints: {:d}, time: {:.2f}s, {:.0f} fingerprints/s".format(len(notes), created,
+                                                                                          time_span,
+                                                                                          created / time_span))
+
+    ts_reference = MeasureTime()
+    ts_reference.timestamp("Start")
+    identical = True
+    reference_files = notes[:max_reference_files]
+    for name, file_notes in reference_files:
+        for remove_doubles in (False, True):
+            fingerprints, file_created = fingerprinting.create_fingerprints(file_notes, name, remove_doubles)
+            reference, reference_created = _create_fingerprints_loops(fingerprinting, file_notes, remove_doubles)
+            identical = identical and file_created == reference_created and \
+                list(zip(fingerprints["hash"].tolist(), fingerprints["pos1"].tolist(),
+                         fingerprints["td12"].tolist())) == reference
+    ts_reference.timestamp("Reference")
+    print("Reference files: {:d}, loops: {:.2f}s, identical fingerprints: {}".format(
+        len(reference_files), ts_reference.get_whole_time_span(), identical))
+
+    return created, created / time_span
+
+
+def query_time(library_path, params=FingerPrinting.PARAM_SETTING_3, sample_size=20):
+    """
+    Measures the time per search for the default test queries of a library
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param sample_size: number of files from which queries are created for every test
+    :return: (number of queries, mean time per query, median time per query)
+    """
+    library = MidiLibrary(library_path)
+    fingerprinting = FingerPrinting(library, **params)
+    library.create_test_samples(sample_size, 1, 10, 80)
+    queries = [query for test_queries in library.evaluation_queries.values() for query in test_queries]
+
+    ts = MeasureTime()
+    ts.timestamp("Start")
+    results = []
+    for query in queries:
+        results.append(fingerprinting.search(query, get_top_x=10))
+        ts.timestamp(query.name)
+
+    mean, min, _25_quartile, median, _75_quartile, max = ts.get_time_stats()
+    print("Queries: {:d}, total: {:.2f}s".format(len(queries), ts.get_whole_time_span()))
+    print("Per query: mean {:.2f}ms, median {:.2f}ms, 75% {:.2f}ms, max {:.2f}ms".format(mean * 1000, median * 1000,
+                                                                                       _75_quartile * 1000,
+                                                                                       max * 1000))
+
+    # the same queries searched together
+    ts_many = MeasureTime()
+    ts_many.timestamp("Start")
+    identical = fingerprinting.search_many(queries, get_top_x=10) == results
+    ts_many.timestamp("search_many")
+    print("search_many: total {:.2f}s, identical results: {}".format(ts_many.get_whole_time_span(), identical))
+
+    return len(queries), mean, median
+
+
+def index_scaling(library_path, params=FingerPrinting.PARAM_SETTING_3, workers=(1, 2, 4, 8)):
+    """
+    Measures the time to create the fingerprint-index of a library with different numbers of worker processes
+    and checks, that all created indexes are identical.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param workers: numbers of workers to measure
+    :return: list of (workers, time)
+    """
+    library = MidiLibrary(library_path)
+    times = []
+    reference = None
+
+    for n_of_workers in workers:
+        worker_params = dict(params)
+        worker_params[FingerPrinting.INDEX_WORKERS] = n_of_workers
+
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        index = FingerPrinting(library, **worker_params).get_index()
+        ts.timestamp("Index")
+
+        arrays = [index.hashes, index.offsets] + [getattr(index, field) for field, _ in index.POSTING_FIELDS]
+        if reference is None:
+            reference = (index.names, arrays)
+        identical = reference[0] == index.names and all(np.array_equal(a, b) for a, b in zip(reference[1], arrays))
+
+        times.append((n_of_workers, ts.get_whole_time_span()))
+        print("Workers: {:d}, time: {:.2f}s, speedup: {:.2f}, identical index: {}".format(
+            n_of_workers, times[-1][1], times[0][1] / times[-1][1], identical))
+
+    return times
+
+
+def library_scaling(library_path, workers=(1, 2, 4, 8)):
+    """
+    Measures the time to load a library with different numbers of worker processes reading the midi files and
+    checks, that all loaded libraries are identical.
+    :param library_path: path to the midi library
+    :param workers: numbers of workers to measure
+    :return: list of (workers, time)
+    """
+    times = []
+    reference = None
+
+    for n_of_workers in workers:
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        library = MidiLibrary(library_path, load_workers=n_of_workers)
+        ts.timestamp("Library")
+
+        midifiles = library.get_midifiles()
+        if reference is None:
+            reference = midifiles
+        identical = len(reference) == len(midifiles) and all(
+            a.name == b.name and a.get_metadata() == b.get_metadata() and
+            all(np.array_equal(x, y) for x, y in zip(a.notes, b.notes)) for a, b in zip(reference, midifiles))
+
+        times.append((n_of_workers, ts.get_whole_time_span()))
+        print("Workers: {:d}, files: {:d}, time: {:.2f}s, speedup: {:.2f}, identical library: {}".format(
+            n_of_workers, len(midifiles), times[-1][1], times[0][1] / times[-1][1], identical))
+
+    return times
+
+
+def window_workers(library_path, params=FingerPrinting.PARAM_SETTING_3, workers=(1, 2, 4), sample_size=10):
+    """
+    Measures the time per search of long queries, whose windows are scored by different numbers of search workers,
+    and checks, that the results equal the ones of a single worker.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param workers: numbers of search workers to measure
+    :param sample_size: number of files from which queries are created for every test
+    :return: list of (workers, mean time per query)
+    """
+    library = MidiLibrary(library_path)
+    library.create_test_samples(sample_size, 1, 200, 400)
+    queries = [query for test_queries in library.evaluation_queries.values() for query in test_queries]
+
+    fingerprinting = FingerPrinting(library, **params)
+    times = []
+    reference = None
+    for n_of_workers in workers:
+        fingerprinting.search_workers = n_of_workers
+
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        results = []
+        for query in queries:
+            results.append(fingerprinting.search(query, evaluate=True))
+            ts.timestamp(query.name)
+
+        if reference is None:
+            reference = results
+        mean = ts.get_time_stats()[0]
+        times.append((n_of_workers, mean))
+        print("Search workers: {:d}, per query: mean {:.2f}ms, speedup: {:.2f}, identical results: {}".format(
+            n_of_workers, mean * 1000, times[0][1] / mean, results == reference))
+
+    return times
+
+
+def sharded_search(library_path, params=FingerPrinting.PARAM_SETTING_3, shards=(1, 2, 4), sample_size=5):
+    """
+    Measures the time per search of a library partitioned over local shard processes and checks, that the
+    results of search, search_ranks and search_many equal the ones of a single index.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param shards: numbers of shards to measure
+    :param sample_size: number of files from which queries are created for every test
+    :return: list of (shards, mean time per query)
+    """
+    library = MidiLibrary(library_path)
+    library.create_test_samples(sample_size, 1, 10, 80)
+    queries = [query for test_queries in library.evaluation_queries.values() for query in test_queries]
+
+    fingerprinting = FingerPrinting(library, **params)
+    reference = fingerprinting.search_many(queries, evaluate=True)
+    reference_ranks = list(fingerprinting.search_ranks(queries))
+    reference_top = fingerprinting.search_many(queries, get_top_x=10)
+
+    times = []
+    for n_of_shards in shards:
+        shard_params = dict(params)
+        shard_params[ShardedFingerPrinting.SHARDS] = n_of_shards
+        sharded = ShardedFingerPrinting(library, **shard_params)
+
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        identical = True
+        for query, expected in zip(queries, reference):
+            identical = identical and sharded.search(query, evaluate=True) == expected
+            ts.timestamp(query.name)
+        identical_ranks = list(sharded.search_ranks(queries)) == reference_ranks
+        identical_top = sharded.search_many(queries, get_top_x=10) == reference_top
+        sharded.close()
+
+        mean = ts.get_time_stats()[0]
+        times.append((n_of_shards, mean))
+        print("Shards: {:d}, per query: mean {:.2f}ms, identical results: {}, identical ranks: {}, identical top "
+              "results: {}".format(n_of_shards, mean * 1000, identical, identical_ranks, identical_top))
+
+    return times
+
+
+def posting_compression(library_path, params=FingerPrinting.PARAM_SETTING_3, position_steps=(2**-16, 2**-8, 1 / 48),
+                        block_sizes=(16, 64, 256), sample_size=20, library_size=10**6):
+    """
+    Compares the size of compressed postings with the time needed to decode the postings of test queries for
+    several quantization steps and block sizes, and the search time of a compressed index with the one of plain
+    arrays. Asserts, that the compressed index ranks all files of the test queries like the plain arrays. The index
+    size of a library with library_size files is extrapolated from the postings per file.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param position_steps: quantization steps of the positions to measure
+    :param block_sizes: block sizes to measure
+    :param sample_size: number of files from which queries are created for every test
+    :param library_size: number of files of the extrapolated library
+    :return: list of (position step, block size, bytes per posting, decode time per query)
+    """
+    library = MidiLibrary(library_path)
+    library.create_test_samples(sample_size, 1, 10, 80)
+    queries = [query for test_queries in library.evaluation_queries.values() for query in test_queries]
+
+    fingerprinting = FingerPrinting(library, **params)
+    index = fingerprinting.get_index()
+    n_of_postings = index.get_nr_of_postings()
+    posting_bytes = sum(np.dtype(dtype).itemsize for _, dtype in index.POSTING_FIELDS)
+    postings_per_file = n_of_postings / max(len(index.names), 1)
+
+    # positions of the postings read by every query
+    query_positions = []
+    for query in queries:
+        fingerprints, _ = fingerprinting.create_fingerprints(query.get_notes_for_fingerprints(), query.name,
+                                                             remove_doubles=True)
+        _, buckets = fingerprinting.find_query_buckets(fingerprints)
+        starts = index.offsets[buckets]
+        query_positions.append(FingerPrintIndex.expand_ranges(starts, index.offsets[buckets + 1] - starts)[1])
+
+    ts = MeasureTime()
+    ts.timestamp("Start")
+    for positions in query_positions:
+        index.get_posting_columns(positions)
+    ts.timestamp("Plain")
+    plain_time = ts.get_whole_time_span() / len(queries)
+    print("Plain: {:.1f} bytes/posting, decode per query: {:.2f}ms, {:d} files: {:.1f} GB".format(
+        posting_bytes, plain_time * 1000, library_size, postings_per_file * library_size * posting_bytes / 2**30))
+
+    results = []
+    for position_step in position_steps:
+        columns = (index.pos1, index.td12, index.max_pos)
+        error = max(float(np.abs(np.rint(column / position_step) * position_step - column).max(initial=0))
+                    for column in columns)
+        for block_size in block_sizes:
+            compressed = FingerPrintIndex.CompressedPostings.encode(index.doc_ids, index.pos1, index.td12,
+                                                                    index.max_pos, position_step, block_size)
+            ts = MeasureTime()
+            ts.timestamp("Start")
+            for positions in query_positions:
+                compressed.decode(positions)
+            ts.timestamp("Compressed")
+            decode_time = ts.get_whole_time_span() / len(queries)
+            bytes_per_posting = compressed.get_nbytes() / n_of_postings
+            results.append((position_step, block_size, bytes_per_posting, decode_time))
+            print("Step: {:.6f}, block size: {:d}, {:.2f} bytes/posting, decode per query: {:.2f}ms, max position "
+                  "error: {:.6f}, {:d} files: {:.1f} GB".format(position_step, block_size, bytes_per_posting,
+                                                                decode_time * 1000, error, library_size,
+                                                                postings_per_file * library_size *
+                                                                bytes_per_posting / 2**30))
+
+    # whole searches with the default compression, its quantization of the positions is lossy, so the rankings
+    # of all files are compared with the ones of the plain arrays
+    compressed_params = dict(params)
+    compressed_params[FingerPrinting.COMPRESS_POSTINGS] = True
+    compressed_fingerprinting = FingerPrinting(library, **compressed_params)
+    for name, searched_fingerprinting in (("plain", fingerprinting), ("compressed", compressed_fingerprinting)):
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        search_results = [searched_fingerprinting.search(query, get_top_x=10) for query in queries]
+        ts.timestamp("Searches")
+        rankings = searched_fingerprinting.search_many(queries, evaluate=True)
+        if name == "plain":
+            reference = search_results
+            reference_rankings = rankings
+        print("Search {}: index arrays {:.1f} MB, per query {:.2f}ms, identical results: {}".format(
+            name, searched_fingerprinting.get_index().get_nbytes() / 2**20,
+            ts.get_whole_time_span() / len(queries) * 1000, search_results == reference))
+        assert rankings == reference_rankings, "The rankings of the {} index differ from the plain index".format(name)
+
+    return results
+
+
+def tdr_expansion(library_path, params=FingerPrinting.PARAM_SETTING_3, sample_size=10):
+    """
+    Compares an index with expanded tdr-keys (EXPAND_TDR_INDEX) with the default index on the default evaluation
+    tests: the memory of the keys, the time to look up the buckets of the query fingerprints and the time per
+    search. The results of both indexes have to be identical.
+    :param library_path: path to the midi library
+    :param params: fingerprinting parameters
+    :param sample_size: number of files from which queries are created for every test
+    :return: list of (test name, lookup time per query, expanded lookup time per query, search time per query,
+             expanded search time per query)
+    """
+    library = MidiLibrary(library_path)
+    library.create_test_samples(sample_size, 1, 10, 80)
+
+    expanded_params = dict(params)
+    expanded_params[FingerPrinting.EXPAND_TDR_INDEX] = True
+    fingerprinting = FingerPrinting(library, **params)
+    expanded = FingerPrinting(library, **expanded_params)
+
+    ts = MeasureTime()
+    ts.timestamp("Start")
+    expanded._expand_tdr_keys()
+    ts.timestamp("Expand")
+
+    index, expanded_index = fingerprinting.get_index(), expanded.get_index()
+    key_bytes = index.hashes.nbytes
+    expanded_key_bytes = expanded_index.expanded_hashes.nbytes + expanded_index.expanded_buckets.nbytes
+    print("Keys: {:d} hashes, {:.2f} MB, expanded: {:d} keys, {:.2f} MB, expansion time: {:.2f}s".format(
+        index.hashes.shape[0], key_bytes / 2**20, expanded_index.expanded_hashes.shape[0],
+        expanded_key_bytes / 2**20, ts.get_whole_time_span()))
+    print("Index arrays: {:.1f} MB, expanded: {:.1f} MB".format(index.get_nbytes() / 2**20,
+                                                              expanded_index.get_nbytes() / 2**20))
+
+    results = []
+    for test_name, queries in sorted(library.evaluation_queries.items()):
+        fingerprints = [fingerprinting.create_fingerprints(query.get_notes_for_fingerprints(), query.name,
+                                                           remove_doubles=True)[0] for query in queries]
+        times = []
+        search_results = []
+        for searched_fingerprinting in (fingerprinting, expanded):
+            ts_lookup = MeasureTime()
+            ts_lookup.timestamp("Start")
+            for query_fingerprints in fingerprints:
+                searched_fingerprinting.find_query_buckets(query_fingerprints)
+            ts_lookup.timestamp("Lookup")
+
+            ts_search = MeasureTime()
+            ts_search.timestamp("Start")
+            search_results.append([searched_fingerprinting.search(query, evaluate=True) for query in queries])
+            ts_search.timestamp("Search")
+            times += [ts_lookup.get_whole_time_span() / len(queries), ts_search.get_whole_time_span() / len(queries)]
+
+        results.append((test_name, times[0], times[2], times[1], times[3]))
+        print("{}: lookup per query {:.3f}ms, expanded {:.3f}ms, search per query {:.2f}ms, expanded {:.2f}ms, "
+              "identical results: {}".format(test_name, times[0] * 1000, times[2] * 1000, times[1] * 1000,
+                                             times[3] * 1000, search_results[0] == search_results[1]))
+
+    return results
+
+
+def _get_notes_scanning(midifile):
+    """
+    Reference for note_extraction: extracts the notes of track 0 like MidiFile.get_notes did before, by scanning
+    the rest of the track for the NoteOff-event of every NoteOn-event
+    :param midifile: MidiFile
+    :return: list of (pitch, duration, onset, index)
+    """
+    pattern = midifile._pattern
+    bps = 120/60
+    notes = []
+    pos = 0
+    track = pattern[0]
+    for idx, msg in enumerate(track):
+        if isinstance(msg, midi.SetTempoEvent):
+            bps = msg.bpm/60
+
+        pos += msg.tick/(pattern.resolution*bps)
+
+        if isinstance(msg, midi.NoteOnEvent) and msg.velocity > 0:
+            _, offset = MidiFile._get_note_off_event(msg.get_pitch(), track, idx + 1)
+            notes.append((msg.get_pitch(), offset/(pattern.resolution*bps), pos, len(notes)))
+
+    return notes
+
+
+def _get_notes_single_pass(midifile):
+    """
+    Extracts the notes of track 0 with MidiFile.get_notes, starting with the default tempo like the reference
+    :param midifile: MidiFile
+    :return: list of (pitch, duration, onset, index)
+    """
+    midifile.bps = 120/60
+    return midifile.get_notes()[0].tolist()
+
+
+def _create_sustained_notes_file(path, n_of_notes):
+    """
+    Writes a midi file, whose notes are all released at the end, like with a held sustain pedal. Every NoteOn-event
+    is followed by all other NoteOn-events before its NoteOff-event.
+    :param path: path of the file
+    :param n_of_notes: number of notes
+    :return: None
+    """
+    track = midi.Track()
+    for note_nr in range(n_of_notes):
+        track.append(midi.NoteOnEvent(tick=1, velocity=80, pitch=note_nr % 128))
+    for note_nr in range(n_of_notes):
+        track.append(midi.NoteOffEvent(tick=1, velocity=0, pitch=note_nr % 128))
+    track.append(midi.EndOfTrackEvent(tick=1))
+    midi.write_midifile(path, midi.Pattern(tracks=[track]))
+
+
+def note_extraction(library_path, sustained_notes=(1000, 2000, 4000)):
+    """
+    Measures the time to extract the notes of all files of a library with MidiFile.get_notes and with the
+    scanning reference, and checks, that the notes of track 0 are identical. The same is measured for files,
+    whose notes are all released at the end.
+    :param library_path: path to the midi library
+    :param sustained_notes: numbers of notes of the files with sustained notes
+    :return: (number of notes, time of get_notes, time of the reference)
+    """
+    library = MidiLibrary(library_path)
+    midifiles = [midifile for midifile in library.get_midifiles() if isinstance(midifile, MidiFile)]
+    for midifile in midifiles:
+        # The pattern is read on first access, keep this out of the measurement
+        midifile.get_notes()
+
+    times = []
+    notes = []
+    for extract in (_get_notes_single_pass, _get_notes_scanning):
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        notes.append([extract(midifile) for midifile in midifiles])
+        ts.timestamp("Notes")
+        times.append(ts.get_whole_time_span())
+
+    n_of_notes = sum(len(file_notes) for file_notes in notes[0])
+    print("Files: {:d}, notes: {:d}, get_notes: {:.2f}s, scanning: {:.2f}s, identical notes: {}".format(
+        len(midifiles), n_of_notes, times[0], times[1], notes[0] == notes[1]))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n_of_sustained_notes in sustained_notes:
+            path = os.path.join(directory, "sustained_{:d}.mid".format(n_of_sustained_notes))
+            _create_sustained_notes_file(path, n_of_sustained_notes)
+            midifile = MidiFile(os.path.basename(path), path)
+            midifile.get_notes()
+
+            sustained_times = []
+            sustained_results = []
+            for extract in (_get_notes_single_pass, _get_notes_scanning):
+                ts = MeasureTime()
+                ts.timestamp("Start")
+                sustained_results.append(extract(midifile))
+                ts.timestamp("Notes")
+                sustained_times.append(ts.get_whole_time_span())
+            print("Sustained notes: {:d}, get_notes: {:.2f}ms, scanning: {:.2f}ms, identical notes: {}".format(
+                n_of_sustained_notes, sustained_times[0] * 1000, sustained_times[1] * 1000,
+                sustained_results[0] == sustained_results[1]))
+
+    return n_of_notes, times[0], times[1]
+
+
+def _read_notes_from_pattern(path):
+    """
+    Reference for file_loading: reads the notes like MidiFile did before, from the pattern of the midi package
+    :param path: path of the midi file
+    :return: (list of note arrays, beats per second after the last SetTempo-event)
+    """
+    midifile = MidiFile.__new__(MidiFile)
+    midifile.file_path = path
+    midifile._loaded_pattern = None
+    midifile.bps = 120/60
+    return midifile.get_notes(), midifile.bps
+
+
+def _read_notes_from_bytes(path):
+    """
+    Reads the notes with MidiFile.NoteReader
+    :param path: path of the midi file
+    :return: (list of note arrays, beats per second after the last SetTempo-event)
+    """
+    _, notes, bps, _ = MidiFile.NoteReader.read(path, 120/60)
+    return notes, bps
+
+
+def file_loading(library_path):
+    """
+    Measures the throughput of reading the notes of all midi files of a library with MidiFile.NoteReader and from
+    the pattern of the midi package, and checks, that the notes are identical.
+    :param library_path: path to the midi library
+    :return: (number of files, files per second of the note reader, files per second of the pattern)
+    """
+    paths = []
+    for directory, _, files in os.walk(library_path):
+        paths.extend(os.path.join(directory, file) for file in sorted(files) if file.endswith(".mid"))
+
+    times = []
+    results = []
+    for read in (_read_notes_from_bytes, _read_notes_from_pattern):
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        file_results = []
+        for path in paths:
+            try:
+                file_results.append(read(path))
+            except Exception as e:
+                file_results.append(str(e))
+        ts.timestamp("Files")
+        times.append(ts.get_whole_time_span())
+        results.append(file_results)
+
+    identical = all(
+        isinstance(a, str) == isinstance(b, str) and
+        (isinstance(a, str) or (a[1] == b[1] and len(a[0]) == len(b[0]) and
+                                all(np.array_equal(x, y) for x, y in zip(a[0], b[0]))))
+        for a, b in zip(*results))
+
+    print("Files: {:d}, note reader: {:.2f}s ({:.0f} files/s), pattern: {:.2f}s ({:.0f} files/s), "
+          "identical notes: {}".format(len(paths), times[0], len(paths) / times[0], times[1],
+                                       len(paths) / times[1], identical))
+
+    return len(paths), len(paths) / times[0], len(paths) / times[1]
+
+
+def library_memory(library_path):
+    """
+    Measures the memory allocated for the entries of a library with tracemalloc, first with the note arrays and
+    metadata only and then with the event patterns, which MidiFile loads on demand, of all entries.
+    :param library_path: path to the midi library
+    :return: (number of files, allocated bytes of the entries, allocated bytes with the patterns)
+    """
+    tracemalloc.start()
+    library = MidiLibrary(library_path)
+    allocated, _ = tracemalloc.get_traced_memory()
+
+    midifiles = list(library.get_midifiles())
+    n_of_notes = sum(midifile.get_nr_of_notes() for midifile in midifiles)
+    for midifile in midifiles:
+        midifile.get_notes()
+    allocated_patterns, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("Files: {:d}, notes: {:d}".format(len(midifiles), n_of_notes))
+    print("Entries: {:.1f} MB, {:.1f} bytes/note".format(allocated / 2**20, allocated / n_of_notes))
+    print("Entries with patterns: {:.1f} MB, {:.1f} bytes/note".format(allocated_patterns / 2**20,
+                                                                       allocated_patterns / n_of_notes))
+
+    return len(midifiles), allocated, allocated_patterns
+
+
+def note_cache(library_path):
+    """
+    Measures the time to open a library without note cache, with an empty note cache and with the note cache
+    written by the first opening, and checks, that the notes are identical.
+    :param library_path: path to the midi library
+    :return: (time without cache, time with empty cache, time with filled cache)
+    """
+    times = []
+    libraries = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "notes.pickle")
+        for cache in (None, cache_path, cache_path):
+            ts = MeasureTime()
+            ts.timestamp("Start")
+            libraries.append(MidiLibrary(library_path, note_cache=cache))
+            ts.timestamp("Library")
+            times.append(ts.get_whole_time_span())
+        cache_size = os.path.getsize(cache_path)
+
+    reference = libraries[0].get_midifiles()
+    cached = libraries[2].get_midifiles()
+    identical = len(reference) == len(cached) and all(
+        a.name == b.name and a.get_metadata() == b.get_metadata() and len(a.notes) == len(b.notes) and
+        all(np.array_equal(x, y) for x, y in zip(a.notes, b.notes)) for a, b in zip(reference, cached))
+
+    print("Files: {:d}, no cache: {:.2f}s, empty cache: {:.2f}s, filled cache: {:.2f}s, cache file: {:.1f} MB, "
+          "identical notes: {}".format(len(reference), times[0], times[1], times[2], cache_size / 2**20, identical))
+
+    return tuple(times)
+
+
+def _create_cluster_points(n_of_points, random):
+    """
+    Creates datapoints like the ones search collects for a file: some diagonals with matching bins of the query
+    windows and noise, many points share the same database position
+    :param n_of_points: number of points
+    :param random: np.random.RandomState
+    :return: list of (x, y, score, start, end)
+    """
+    length = n_of_points / 10
+    n_of_diagonal = n_of_points // 3
+
+    x = np.round(random.uniform(0, length, n_of_points) * 4) / 4
+    y = random.uniform(0, length * 1.5, n_of_points)
+    y[:n_of_diagonal] = x[:n_of_diagonal] * random.choice((0.5, 1.0, 1.5), n_of_diagonal) + \
+        random.choice((0.0, length / 3), n_of_diagonal)
+    score = random.randint(1, 10, n_of_points)
+
+    return list(zip(x.tolist(), y.tolist(), score.tolist(), x.tolist(), (x + 2).tolist()))
+
+
+def _find_diagonals_pairwise(fingerprinting, data):
+    """ Reference clustering, which compares every point with every point of all clusters (get_closest_cluster)"""
+    data.sort(key=lambda d: d[0])
+    clusters = []
+    for x, y, score, start, end in data:
+        _, closest_cluster, closest_point = fingerprinting.get_closest_cluster(clusters, x, y)
+        if closest_cluster is None or ((closest_point[0] >= x or closest_point[1] >= y) and
+                                       (closest_point[0] != x or closest_point[1] != y)):
+            closest_cluster = None
+        else:
+            x_dist = x - closest_point[0]
+            y_dist = y - closest_point[1]
+            if max(x_dist, y_dist) / max(min(x_dist, y_dist), 0.00001) > 3:
+                closest_cluster = None
+
+        if closest_cluster is None:
+            closest_cluster = fingerprinting.Cluster()
+            clusters.append(closest_cluster)
+        closest_cluster.append((x, y, score, start, end))
+    return clusters
+
+
+def clustering(library_path=None, sizes=(1000, 5000, 10000, 50000), max_reference_size=5000):
+    """
+    Measures the time of find_diagonals for files with many datapoints and checks for the smaller sizes, that the
+    clusters equal the ones of the pairwise comparison.
+    :param library_path: unused, the points are generated
+    :param sizes: numbers of points
+    :param max_reference_size: largest number of points, which is compared with the pairwise clustering
+    :return: list of (number of points, time)
+    """
+    fingerprinting = FingerPrinting(MidiLibrary(None))
+    random = np.random.RandomState(23)
+    times = []
+
+    for n_of_points in sizes:
+        data = _create_cluster_points(n_of_points, random)
+
+        ts = MeasureTime()
+        ts.timestamp("Start")
+        clusters = fingerprinting.find_diagonals(list(data))
+        ts.timestamp("Clusters")
+        times.append((n_of_points, ts.get_whole_time_span()))
+
+        text = "Points: {:d}, clusters: {:d}, time: {:.2f}s".format(n_of_points, len(clusters), times[-1][1])
+        if n_of_points <= max_reference_size:
+            ts_reference = MeasureTime()
+            ts_reference.timestamp("Start")
+            reference = _find_diagonals_pairwise(fingerprinting, list(data))
+            ts_reference.timestamp("Reference")
+            identical = [(list(c), c.score, c.start, c.end) for c in clusters] == \
+                [(list(c), c.score, c.start, c.end) for c in reference]
+            text += ", pairwise: {:.2f}s, identical clusters: {}".format(ts_reference.get_whole_time_span(),
+                                                                          identical)
+        print(text)
+
+    return times
+
+
+BENCHMARKS = {
+    "memory": index_memory,
+    "fingerprints": fingerprint_creation,
+    "query": query_time,
+    "scaling": index_scaling,
+    "library_scaling": library_scaling,
+    "windows": window_workers,
+    "shards": sharded_search,
+    "compression": posting_compression,
+    "tdr_expansion": tdr_expansion,
+    "notes": note_extraction,
+    "loading": file_loading,
+    "library_memory": library_memory,
+    "note_cache": note_cache,
+    "clustering": clustering
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        print("Benchmarks: {}".format(", ".join(BENCHMARKS)))
+        return
+
+    library_path = sys.argv[2] if len(sys.argv) > 2 else NOTTINGHAM_PATH
+    BENCHMARKS[sys.argv[1]](library_path)
+
+
+if __name__ == "__main__":
+    main()
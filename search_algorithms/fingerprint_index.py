@@ -0,0 +1,945 @@
+import numpy as np
+import os
+import collections
+
+
+class FingerPrintIndex:
+    """
+    Columnar storage of the database fingerprints.
+
+    The postings are kept in CSR-layout: hashes holds every stored hash value once and in ascending order,
+    the postings of hashes[i] are found in the posting-arrays between offsets[i] and offsets[i + 1].
+    Every posting consists of the document id, the position of the first note, the time difference between the first
+    two notes and the position of the last note of the fingerprint. Document names are stored once in the names list,
+    the document id is the index into this list.
+
+    The postings of over-frequent buckets can be dropped (prune). These buckets keep their hash and for every document
+    the number of its dropped postings, so their lengths stay the same.
+
+    Optionally the postings are stored compressed (see CompressedPostings), they are decoded block-wise when they are
+    read. Changes of a compressed index decode and encode again only the blocks from the first changed posting on,
+    chunk by chunk, so the decoded postings never take more memory than one chunk (see CompressedPostings.update).
+    """
+
+    # Posting arrays with their datatype, in the order they are stored
+    POSTING_FIELDS = (("doc_ids", np.uint32), ("pos1", np.float64), ("td12", np.float64), ("max_pos", np.float64))
+
+    # Arrays holding the number of dropped postings of pruned buckets
+    PRUNED_FIELDS = ("pruned_hashes", "pruned_doc_ids", "pruned_counts")
+
+    Posting = collections.namedtuple("Posting", ("doc_id", "pos1", "td12", "max_pos"))
+
+    # Postings of removed documents are dropped, when they exceed this share of all postings
+    COMPACT_RATIO = 0.25
+
+    class CompressedPostings:
+        """
+        Compressed storage of the posting-arrays.
+
+        The positions are quantized to integer multiples of position_step, which is lossy: positions, which are no
+        multiples of the step (e.g. of tempo changes or tuplets), are rounded by up to half a step, so scores of
+        close matches can differ from the ones of the plain arrays. The postings are split into blocks of
+        block_size postings, inside of a block every posting is stored as the difference of its document id and
+        start position to the previous posting, followed by its time difference td12 and the distance from its start
+        to its end position. The values are zigzag-encoded and stored as variable-byte integers (7 bits per byte, the
+        highest bit marks every byte but the last one of a value). The byte offset of every block is kept as skip
+        data, so single blocks can be decoded without decoding the blocks before.
+
+        Every block only depends on its own postings, so the postings are encoded in chunks of whole blocks, which
+        are joined afterwards, and changes only encode the blocks again, which hold or follow a changed posting.
+        """
+
+        # Number of encoded values of every posting
+        VALUES_PER_POSTING = 4
+
+        DEFAULT_POSITION_STEP = 2**-16
+        DEFAULT_BLOCK_SIZE = 32
+
+        # Number of postings, which are encoded or decoded at once by encode and update
+        CHUNK_SIZE = 2**16
+
+        # Arrays with their file names in a snapshot
+        FIELDS = ("posting_bytes", "block_offsets", "posting_settings")
+
+        def __init__(self, posting_bytes, block_offsets, n_of_postings, position_step, block_size):
+            """
+            :param posting_bytes: uint8 array with the encoded postings
+            :param block_offsets: int64 array with the first byte of every block and the end of posting_bytes
+            :param n_of_postings: number of stored postings
+            :param position_step: quantization step of the positions
+            :param block_size: number of postings of every block
+            """
+            self.posting_bytes = posting_bytes
+            self.block_offsets = block_offsets
+            self.n_of_postings = n_of_postings
+            self.position_step = position_step
+            self.block_size = block_size
+
+        @classmethod
+        def encode(cls, doc_ids, pos1, td12, max_pos, position_step=DEFAULT_POSITION_STEP,
+                   block_size=DEFAULT_BLOCK_SIZE):
+            """
+            Compresses the posting-arrays chunk-wise
+            :param doc_ids: array of document ids
+            :param pos1: array of fingerprint start positions
+            :param td12: array of time differences between the first two notes
+            :param max_pos: array of the positions of the last notes
+            :param position_step: quantization step of the positions
+            :param block_size: number of postings of every block
+            :return: CompressedPostings
+            """
+            chunk_size = max(cls.CHUNK_SIZE // block_size, 1) * block_size
+            parts = [cls._encode_chunk(*(column[start:start + chunk_size] for column in (doc_ids, pos1, td12, max_pos)),
+                                       position_step=position_step, block_size=block_size)
+                     for start in range(0, len(doc_ids), chunk_size)]
+            return cls.join(parts, position_step, block_size)
+
+        @classmethod
+        def _encode_chunk(cls, doc_ids, pos1, td12, max_pos, position_step, block_size):
+            """
+            Compresses the posting-arrays at once, see encode
+            :return: CompressedPostings
+            """
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            n_of_postings = doc_ids.shape[0]
+            quantized_pos1 = np.rint(np.asarray(pos1) / position_step).astype(np.int64)
+
+            # document id and start position are stored relative to the previous posting of the block
+            values = np.empty((n_of_postings, cls.VALUES_PER_POSTING), dtype=np.int64)
+            values[:, 0] = np.diff(doc_ids, prepend=0)
+            values[::block_size, 0] = doc_ids[::block_size]
+            values[:, 1] = np.diff(quantized_pos1, prepend=0)
+            values[::block_size, 1] = quantized_pos1[::block_size]
+            values[:, 2] = np.rint(np.asarray(td12) / position_step)
+            values[:, 3] = np.rint(np.asarray(max_pos) / position_step) - quantized_pos1
+
+            values = values.ravel()
+            zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+            # number of bytes of every value and the first byte of every value
+            n_of_bytes = np.ones(zigzag.shape[0], dtype=np.int64)
+            for shift in range(7, 64, 7):
+                n_of_bytes += zigzag >= (np.uint64(1) << np.uint64(shift))
+            value_starts = np.cumsum(n_of_bytes) - n_of_bytes
+
+            posting_bytes = np.zeros(int(n_of_bytes.sum()), dtype=np.uint8)
+            for byte_nr in range(int(n_of_bytes.max(initial=0))):
+                has_byte = n_of_bytes > byte_nr
+                byte = (zigzag[has_byte] >> np.uint64(7 * byte_nr)) & np.uint64(0x7F)
+                byte |= np.where(n_of_bytes[has_byte] > byte_nr + 1, np.uint64(0x80), np.uint64(0))
+                posting_bytes[value_starts[has_byte] + byte_nr] = byte
+
+            block_starts = np.arange(0, n_of_postings, block_size) * cls.VALUES_PER_POSTING
+            block_offsets = np.append(value_starts[block_starts], posting_bytes.shape[0]).astype(np.int64)
+
+            return cls(posting_bytes, block_offsets, n_of_postings, position_step, block_size)
+
+        @classmethod
+        def join(cls, parts, position_step, block_size):
+            """
+            Joins compressed postings, every part but the last one has to hold a multiple of block_size postings
+            :param parts: list of CompressedPostings
+            :param position_step: quantization step of the positions
+            :param block_size: number of postings of every block
+            :return: CompressedPostings
+            """
+            byte_starts = np.cumsum([0] + [part.posting_bytes.shape[0] for part in parts])
+            posting_bytes = np.concatenate([np.zeros(0, dtype=np.uint8)] + [part.posting_bytes for part in parts])
+            block_offsets = np.concatenate([part.block_offsets[:-1] + byte_start
+                                            for part, byte_start in zip(parts, byte_starts)] + [byte_starts[-1:]])
+            return cls(posting_bytes, block_offsets.astype(np.int64), sum(part.n_of_postings for part in parts),
+                       position_step, block_size)
+
+        def get_blocks(self, first, last):
+            """
+            Returns the blocks from first up to last (exclusive) without decoding them
+            :param first: number of the first block
+            :param last: number of the block behind the last block
+            :return: CompressedPostings
+            """
+            byte_start, byte_end = int(self.block_offsets[first]), int(self.block_offsets[last])
+            n_of_postings = min(last * self.block_size, self.n_of_postings) - first * self.block_size
+            return FingerPrintIndex.CompressedPostings(self.posting_bytes[byte_start:byte_end],
+                                                       self.block_offsets[first:last + 1] - byte_start,
+                                                       n_of_postings, self.position_step, self.block_size)
+
+        def update(self, delete_positions, insert_at, doc_ids, pos1, td12, max_pos):
+            """
+            Drops and inserts postings. The blocks in front of the first changed block are copied. From there on the
+            blocks are decoded, changed and encoded again chunk by chunk, until the following blocks are unchanged
+            and keep their place, then these are copied as well.
+            :param delete_positions: sorted array of the positions of the dropped postings
+            :param insert_at: sorted array with the position of the posting, in front of which a new posting is
+                              inserted, new postings behind the last posting have the number of postings
+            :param doc_ids: array of document ids of the new postings
+            :param pos1: array of fingerprint start positions of the new postings
+            :param td12: array of time differences between the first two notes of the new postings
+            :param max_pos: array of the positions of the last notes of the new postings
+            :return: CompressedPostings
+            """
+            if delete_positions.shape[0] == 0 and insert_at.shape[0] == 0:
+                return self
+
+            block_size = self.block_size
+            n_of_blocks = self.block_offsets.shape[0] - 1
+            chunk_blocks = max(self.CHUNK_SIZE // block_size, 1)
+            new_columns = (doc_ids, pos1, td12, max_pos)
+
+            # blocks holding a dropped posting or the place of a new posting, the end counts as changed block
+            changed = np.zeros(n_of_blocks + 1, dtype=bool)
+            changed[delete_positions // block_size] = True
+            changed[np.minimum(insert_at, max(self.n_of_postings - 1, 0)) // block_size] = True
+            changed[n_of_blocks] = True
+            changed_blocks = np.flatnonzero(changed)
+
+            parts = []
+            # decoded postings, which did not fill a whole block yet
+            rest = tuple(np.zeros(0, dtype=dtype) for dtype in (np.uint32, np.float64, np.float64, np.float64))
+            block = 0
+            while block < n_of_blocks:
+                if rest[0].shape[0] == 0 and not changed[block]:
+                    # unchanged blocks, which keep their place, are copied
+                    next_changed = int(changed_blocks[np.searchsorted(changed_blocks, block)])
+                    parts.append(self.get_blocks(block, next_changed))
+                    block = next_changed
+                    continue
+
+                end = min(block + chunk_blocks, n_of_blocks)
+                start, stop = block * block_size, min(end * block_size, self.n_of_postings)
+                columns = self.decode(np.arange(start, stop))
+
+                dropped = delete_positions[np.searchsorted(delete_positions, start):
+                                           np.searchsorted(delete_positions, stop)] - start
+                keep = np.ones(stop - start, dtype=bool)
+                keep[dropped] = False
+                first, last = (np.searchsorted(insert_at, start),
+                               np.searchsorted(insert_at, stop, side="right" if end == n_of_blocks else "left"))
+                inserted_at = insert_at[first:last] - start
+                inserted_at -= np.searchsorted(dropped, inserted_at)
+                columns = tuple(np.concatenate((rest_column,
+                                                np.insert(column[keep], inserted_at, new_column[first:last])))
+                                for rest_column, column, new_column in zip(rest, columns, new_columns))
+
+                # the postings behind the last whole block are encoded together with the next chunk
+                n_of_encoded = columns[0].shape[0] // block_size * block_size
+                parts.append(self._encode_chunk(*(column[:n_of_encoded] for column in columns),
+                                                position_step=self.position_step, block_size=block_size))
+                rest = tuple(column[n_of_encoded:] for column in columns)
+                block = end
+
+            if n_of_blocks == 0:
+                rest = new_columns
+            parts.append(self.encode(*rest, position_step=self.position_step, block_size=block_size))
+            return self.join(parts, self.position_step, block_size)
+
+        def decode(self, positions):
+            """
+            Decodes the postings at the given positions, only the blocks holding these postings are decoded
+            :param positions: array of posting positions
+            :return: (doc_ids, pos1, td12, max_pos)
+            """
+            positions = np.asarray(positions, dtype=np.int64)
+            blocks, block_nr = np.unique(positions // self.block_size, return_inverse=True)
+
+            byte_starts = self.block_offsets[blocks]
+            _, byte_positions = FingerPrintIndex.expand_ranges(byte_starts,
+                                                               self.block_offsets[blocks + 1] - byte_starts)
+            values = self._decode_values(self.posting_bytes[byte_positions])
+            values = values.reshape(-1, self.VALUES_PER_POSTING)
+
+            # undo the differences inside of every block
+            block_lengths = np.minimum(self.n_of_postings - blocks * self.block_size, self.block_size)
+            block_starts = np.cumsum(block_lengths) - block_lengths
+            sums = np.cumsum(values[:, :2], axis=0)
+            sums -= np.repeat(sums[block_starts] - values[block_starts, :2], block_lengths, axis=0)
+
+            selected = block_starts[block_nr.ravel()] + positions % self.block_size
+            doc_ids = sums[selected, 0].astype(np.uint32)
+            pos1 = sums[selected, 1]
+            td12 = values[selected, 2]
+            max_pos = pos1 + values[selected, 3]
+            return (doc_ids, pos1 * self.position_step, td12 * self.position_step,
+                    max_pos * self.position_step)
+
+        @staticmethod
+        def _decode_values(value_bytes):
+            """
+            Decodes zigzag-encoded variable-byte integers
+            :param value_bytes: uint8 array
+            :return: int64 array
+            """
+            last_bytes = value_bytes < 0x80
+            value_starts = np.flatnonzero(np.concatenate(([True], last_bytes[:-1])))
+            value_nr = np.cumsum(last_bytes) - last_bytes
+            shifts = (7 * (np.arange(value_bytes.shape[0]) - value_starts[value_nr])).astype(np.uint64)
+
+            zigzag = (value_bytes & 0x7F).astype(np.uint64) << shifts
+            if zigzag.shape[0] > 0:
+                zigzag = np.bitwise_or.reduceat(zigzag, value_starts)
+            return (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+
+        def decode_all(self):
+            """
+            Decodes all postings
+            :return: (doc_ids, pos1, td12, max_pos)
+            """
+            return self.decode(np.arange(self.n_of_postings))
+
+        def get_nbytes(self):
+            return self.posting_bytes.nbytes + self.block_offsets.nbytes
+
+        def save(self, path):
+            """
+            Stores the arrays as .npy files in the directory path
+            :param path: existing directory
+            :return: None
+            """
+            settings = np.array([self.n_of_postings, self.position_step, self.block_size], dtype=np.float64)
+            for name, array in zip(self.FIELDS, (self.posting_bytes, self.block_offsets, settings)):
+                np.save(os.path.join(path, name + ".tmp.npy"), array)
+                os.replace(os.path.join(path, name + ".tmp.npy"), os.path.join(path, name + ".npy"))
+
+        @classmethod
+        def load(cls, path):
+            """
+            Loads postings stored by save() using memory-mapping, None if the directory holds no compressed postings
+            :param path: directory of the stored index
+            :return: CompressedPostings or None
+            """
+            if not os.path.exists(os.path.join(path, cls.FIELDS[0] + ".npy")):
+                return None
+            posting_bytes, block_offsets = (np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                                            for name in cls.FIELDS[:2])
+            n_of_postings, position_step, block_size = np.load(os.path.join(path, cls.FIELDS[2] + ".npy"))
+            return cls(posting_bytes, block_offsets, int(n_of_postings), float(position_step), int(block_size))
+
+    def __init__(self, compress=False, position_step=CompressedPostings.DEFAULT_POSITION_STEP,
+                 block_size=CompressedPostings.DEFAULT_BLOCK_SIZE):
+        """
+        :param compress: store the postings compressed, see CompressedPostings
+        :param position_step: quantization step of the positions of compressed postings
+        :param block_size: number of postings of every block of compressed postings
+        """
+        # names[doc_id] is None for the ids of removed documents, which are given to the next added documents
+        self.names = []
+        self._name_ids = dict()
+        self._free_ids = []
+
+        self.hashes = np.zeros(0, dtype=np.uint32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.uint32)
+        self.pos1 = np.zeros(0, dtype=np.float64)
+        self.td12 = np.zeros(0, dtype=np.float64)
+        self.max_pos = np.zeros(0, dtype=np.float64)
+
+        # postings of added documents, which are not yet merged into the sorted arrays
+        self._pending = []
+
+        # Removed documents are only marked, their postings stay in the arrays until the next compaction
+        self._removed = np.zeros(0, dtype=bool)
+        self._removed_postings = 0
+
+        # Number of postings of not removed documents for every bucket, None if nothing is removed,
+        # the histogram of these lengths and the buckets with at least one of these postings
+        self._live_lengths = None
+        self._length_counts = np.zeros(1, dtype=np.int64)
+        self._live_buckets = None
+
+        # hash values with the bucket found for them, see set_expanded_keys, None until they are set
+        self.expanded_hashes = None
+        self.expanded_buckets = None
+
+        # number of dropped postings for every pruned hash and document, sorted by hash and document id
+        self.pruned_hashes = np.zeros(0, dtype=np.uint32)
+        self.pruned_doc_ids = np.zeros(0, dtype=np.uint32)
+        self.pruned_counts = np.zeros(0, dtype=np.uint32)
+
+        # CompressedPostings of the posting-arrays, which are empty while the postings are compressed
+        self.compress_postings = compress
+        self.position_step = position_step
+        self.block_size = block_size
+        self.compressed = None
+        self.set_compression(compress)
+
+    def intern_name(self, name):
+        """
+        Returns the id of a document name, unknown names get the id of a removed document or a new id
+        :param name: name of the document
+        :return: document id
+        """
+        doc_id = self._name_ids.get(name, None)
+        if doc_id is None:
+            if len(self._free_ids) > 0:
+                # the postings of the removed document are dropped by the compaction in freeze(), before the
+                # postings of the new document are merged
+                doc_id = self._free_ids.pop()
+                self.names[doc_id] = name
+            else:
+                doc_id = len(self.names)
+                self.names.append(name)
+            self._name_ids[name] = doc_id
+        return doc_id
+
+    def find_doc_id(self, name):
+        """
+        Returns the id of a document name or None, if the name is unknown
+        """
+        return self._name_ids.get(name, None)
+
+    def add_document(self, name, hashes, pos1, td12, max_pos):
+        """
+        Adds the fingerprints of a document. The postings become searchable after the next call of freeze().
+        :param name: name of the document
+        :param hashes: array of hash values
+        :param pos1: array of fingerprint start positions
+        :param td12: array of time differences between the first two notes
+        :param max_pos: array of the positions of the last notes
+        :return: document id
+        """
+        doc_id = self.intern_name(name)
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        self._pending.append((hashes, np.full(hashes.shape[0], doc_id, dtype=np.uint32),
+                              np.asarray(pos1, dtype=np.float64), np.asarray(td12, dtype=np.float64),
+                              np.asarray(max_pos, dtype=np.float64)))
+        return doc_id
+
+    def remove_document(self, name):
+        """
+        Removes all postings of a document. The postings are marked as removed and dropped with the next
+        compaction, which is done, when they exceed COMPACT_RATIO of all postings.
+        :param name: name of the document
+        :return: True, if the document was in the index
+        """
+        doc_id = self._name_ids.pop(name, None)
+        if doc_id is None:
+            return False
+
+        self.names[doc_id] = None
+        self._free_ids.append(doc_id)
+        self._pending = [columns for columns in self._pending if not np.any(columns[1] == doc_id)]
+
+        # the postings of an earlier document with this id may still be in the arrays, they are already removed
+        if doc_id < self._removed.shape[0] and self._removed[doc_id]:
+            return True
+
+        documents = np.zeros(len(self.names), dtype=bool)
+        documents[doc_id] = True
+        positions = self._find_postings(documents)
+        pruned = self.pruned_doc_ids == doc_id
+        if positions.shape[0] > 0 or np.any(pruned):
+            if self._removed.shape[0] < len(self.names):
+                self._removed = np.append(self._removed, np.zeros(len(self.names) - self._removed.shape[0],
+                                                                  dtype=bool))
+            self._removed[doc_id] = True
+            self._removed_postings += positions.shape[0]
+
+            # the dropped postings of the document are not counted anymore
+            buckets = np.concatenate((np.searchsorted(self.offsets, positions, side="right") - 1,
+                                      np.searchsorted(self.hashes, self.pruned_hashes[pruned])))
+            counts = np.concatenate((np.ones(positions.shape[0], dtype=np.int64),
+                                     self.pruned_counts[pruned].astype(np.int64)))
+            self.pruned_hashes, self.pruned_doc_ids, self.pruned_counts = (self.pruned_hashes[~pruned],
+                                                                           self.pruned_doc_ids[~pruned],
+                                                                           self.pruned_counts[~pruned])
+
+            # update the bucket lengths and their histogram
+            buckets, bucket_nr = np.unique(buckets, return_inverse=True)
+            removed = np.bincount(bucket_nr.ravel(), weights=counts).astype(np.int64)
+            lengths = np.array(self.get_bucket_lengths())
+            np.subtract.at(self._length_counts, lengths[buckets], 1)
+            lengths[buckets] -= removed
+            np.add.at(self._length_counts, lengths[buckets], 1)
+            self._live_lengths = lengths
+            self._live_buckets = None
+            self.expanded_hashes, self.expanded_buckets = None, None
+
+            if self._removed_postings > self.COMPACT_RATIO * self._get_n_of_stored_postings():
+                self.compact()
+
+        return True
+
+    def compact(self):
+        """
+        Drops the postings of all removed documents from the arrays
+        :return: None
+        """
+        if self._removed_postings == 0:
+            return
+
+        self._change_postings(self._take_removed_postings())
+
+    def freeze(self):
+        """
+        Merges all pending postings into the sorted arrays. Postings of the same hash keep the
+        order in which they were added. The postings of removed documents are dropped at the same time.
+        :return: None
+        """
+        if len(self._pending) == 0:
+            return
+
+        new_hashes, new_doc_ids, new_pos1, new_td12, new_max_pos = (np.concatenate(column)
+                                                                    for column in zip(*self._pending))
+        self._pending = []
+
+        order = np.argsort(new_hashes, kind="stable")
+        self._change_postings(self._take_removed_postings(), new_hashes[order],
+                              (new_doc_ids[order], new_pos1[order], new_td12[order], new_max_pos[order]))
+
+    def prune(self, min_length):
+        """
+        Drops the postings of all buckets with at least min_length postings. The buckets keep their hash and the
+        number of dropped postings of every document, so they are still found and have the same length, but
+        get_posting_indexes does not return any postings for them.
+        :param min_length: bucket length, from which on the postings are dropped
+        :return: number of bytes freed
+        """
+        self.freeze()
+        self.compact()
+
+        buckets = np.flatnonzero((self.get_bucket_lengths() >= min_length) & (np.diff(self.offsets) > 0))
+        if buckets.shape[0] == 0:
+            return 0
+
+        nbytes = self.get_nbytes()
+        bucket_idx, positions = self.get_posting_indexes(buckets)
+        chunk_size = self.CompressedPostings.CHUNK_SIZE
+        doc_ids = np.concatenate([np.zeros(0, dtype=np.uint32)] + [
+            self.get_posting_columns(positions[start:start + chunk_size])[0]
+            for start in range(0, positions.shape[0], chunk_size)])
+
+        # count the postings of every hash and document together with the ones dropped before
+        keys = np.concatenate((self.pruned_hashes.astype(np.uint64) << np.uint64(32) | self.pruned_doc_ids,
+                               self.hashes[buckets][bucket_idx].astype(np.uint64) << np.uint64(32) | doc_ids))
+        counts = np.concatenate((self.pruned_counts, np.ones(positions.shape[0], dtype=np.uint32)))
+        keys, key_nr = np.unique(keys, return_inverse=True)
+        self.pruned_counts = np.bincount(key_nr.ravel(), weights=counts).astype(np.uint32)
+        self.pruned_hashes = (keys >> np.uint64(32)).astype(np.uint32)
+        self.pruned_doc_ids = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+        self._change_postings(positions)
+
+        return nbytes - self.get_nbytes()
+
+    def _take_removed_postings(self):
+        """
+        Returns the positions of all postings of removed documents and unmarks the documents, the postings have
+        to be dropped afterwards
+        :return: sorted array of posting positions
+        """
+        if self._removed_postings == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        positions = self._find_postings(self._removed)
+        self._removed[:] = False
+        self._removed_postings = 0
+        return positions
+
+    def _find_postings(self, documents):
+        """
+        Returns the positions of all postings of the given documents, compressed postings are decoded chunk by chunk
+        :param documents: bool array, which is True at the ids of the documents
+        :return: sorted array of posting positions
+        """
+        if self.compressed is None:
+            return np.flatnonzero(documents[self.doc_ids])
+
+        n_of_postings, chunk_size = self.compressed.n_of_postings, self.CompressedPostings.CHUNK_SIZE
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            start + np.flatnonzero(documents[self.compressed.decode(np.arange(start, min(start + chunk_size,
+                                                                                         n_of_postings)))[0]])
+            for start in range(0, n_of_postings, chunk_size)])
+
+    def _change_postings(self, delete_positions, new_hashes=None, new_columns=None):
+        """
+        Drops postings and inserts new postings behind the postings of the same hash, then sets hashes and
+        offsets. Buckets without postings are dropped, but pruned hashes keep an empty bucket.
+        Compressed postings are changed by CompressedPostings.update.
+        :param delete_positions: sorted array with the positions of the dropped postings
+        :param new_hashes: sorted array with the hash of every new posting, None to insert nothing
+        :param new_columns: (doc_ids, pos1, td12, max_pos) of the new postings
+        :return: None
+        """
+        if new_hashes is None:
+            new_hashes = np.zeros(0, dtype=np.uint32)
+            new_columns = tuple(np.zeros(0, dtype=dtype) for _, dtype in self.POSTING_FIELDS)
+
+        # new postings are inserted behind the existing postings of the same hash
+        insert_at = self.offsets[np.searchsorted(self.hashes, new_hashes, side="right")]
+        if self.compressed is None:
+            keep = np.ones(self.doc_ids.shape[0], dtype=bool)
+            keep[delete_positions] = False
+            inserted_at = insert_at - np.searchsorted(delete_positions, insert_at)
+            for (field, _), new_column in zip(self.POSTING_FIELDS, new_columns):
+                setattr(self, field, np.insert(getattr(self, field)[keep], inserted_at, new_column))
+        else:
+            self.compressed = self.compressed.update(delete_positions, insert_at, *new_columns)
+
+        hashes = np.union1d(self.hashes, new_hashes).astype(np.uint32)
+        lengths = np.zeros(hashes.shape[0], dtype=np.int64)
+        lengths[np.searchsorted(hashes, self.hashes)] = np.diff(self.offsets) - np.bincount(
+            np.searchsorted(self.offsets, delete_positions, side="right") - 1, minlength=self.hashes.shape[0])
+        lengths += np.bincount(np.searchsorted(hashes, new_hashes), minlength=hashes.shape[0])
+
+        keep = (lengths > 0) | np.isin(hashes, self.pruned_hashes)
+        self.hashes = hashes[keep]
+        self.offsets = np.append(0, np.cumsum(lengths[keep])).astype(np.int64)
+        self._reset_lengths()
+
+    def set_compression(self, compress):
+        """
+        Stores the postings compressed or as plain posting-arrays from now on
+        :param compress: True to compress the postings
+        :return: None
+        """
+        self.compress_postings = compress
+        if compress and self.compressed is None:
+            self.compressed = self.CompressedPostings.encode(self.doc_ids, self.pos1, self.td12, self.max_pos,
+                                                             self.position_step, self.block_size)
+            for field, dtype in self.POSTING_FIELDS:
+                setattr(self, field, np.zeros(0, dtype=dtype))
+        elif not compress and self.compressed is not None:
+            self.doc_ids, self.pos1, self.td12, self.max_pos = self.compressed.decode_all()
+            self.compressed = None
+
+    def get_pruned_buckets(self):
+        """
+        Returns the numbers of all buckets, whose postings were dropped by prune
+        :return: array of bucket numbers
+        """
+        return np.unique(np.searchsorted(self.hashes, self.pruned_hashes))
+
+    def get_pruned_statistics(self):
+        """
+        Returns how many postings were dropped by prune and how many bytes they would take
+        :return: (number of pruned buckets, number of dropped postings, freed bytes)
+        """
+        n_of_postings = int(self.pruned_counts.sum())
+        posting_bytes = sum(np.dtype(dtype).itemsize for _, dtype in self.POSTING_FIELDS)
+        statistics_bytes = sum(array.nbytes for array in (self.pruned_hashes, self.pruned_doc_ids,
+                                                          self.pruned_counts))
+        return (self.get_pruned_buckets().shape[0], n_of_postings,
+                n_of_postings * posting_bytes - statistics_bytes)
+
+    def _reset_lengths(self):
+        """ Recalculates the histogram of the bucket lengths, after the buckets were changed"""
+        self._live_lengths = None
+        self._live_buckets = None
+        self.expanded_hashes, self.expanded_buckets = None, None
+
+        lengths = np.diff(self.offsets)
+        if self.pruned_hashes.shape[0] > 0:
+            # dropped postings of removed documents are not kept, see remove_document
+            lengths = lengths + np.bincount(np.searchsorted(self.hashes, self.pruned_hashes),
+                                            weights=self.pruned_counts,
+                                            minlength=self.hashes.shape[0]).astype(np.int64)
+            self._live_lengths = lengths
+        self._length_counts = np.bincount(lengths, minlength=1)
+
+    def find_bucket(self, hash_value):
+        """
+        Returns the bucket number of a hash value, or -1 if the hash is not stored
+        :param hash_value: hash to search for
+        :return: bucket number
+        """
+        bucket = int(np.searchsorted(self.hashes, hash_value))
+        if bucket < self.hashes.shape[0] and self.hashes[bucket] == hash_value:
+            return bucket
+        return -1
+
+    def find_nearest_buckets(self, hash_values, lower, upper):
+        """
+        Searches for every hash value the closest stored hash inside of the range [lower, upper].
+        If a stored hash above and one below the hash value have the same distance, the upper one is chosen.
+        :param hash_values: array of hashes to search for
+        :param lower: array with the lowest accepted hash for every hash value
+        :param upper: array with the highest accepted hash for every hash value
+        :return: array of bucket numbers, -1 where no hash is stored inside of the range
+        """
+        hash_values = np.asarray(hash_values, dtype=np.int64)
+
+        # buckets, which only hold postings of removed documents, are skipped
+        live_buckets = self._get_live_buckets()
+        hashes = self.hashes if live_buckets is None else self.hashes[live_buckets]
+
+        n_of_hashes = hashes.shape[0]
+        if n_of_hashes == 0:
+            return np.full(hash_values.shape[0], -1, dtype=np.int64)
+
+        # first stored hash >= hash value and last stored hash < hash value
+        above = np.searchsorted(hashes, hash_values.astype(np.uint32), side="left")
+        below = above - 1
+
+        above_hash = hashes[np.minimum(above, n_of_hashes - 1)].astype(np.int64)
+        below_hash = hashes[np.maximum(below, 0)].astype(np.int64)
+        above_valid = (above < n_of_hashes) & (above_hash <= upper)
+        below_valid = (below >= 0) & (below_hash >= lower)
+
+        use_above = above_valid & (~below_valid | (above_hash - hash_values <= hash_values - below_hash))
+        buckets = np.where(use_above, above, np.where(below_valid, below, -1))
+
+        if live_buckets is not None:
+            buckets[buckets >= 0] = live_buckets[buckets[buckets >= 0]]
+        return buckets
+
+    def set_expanded_keys(self, hash_values, lower, upper):
+        """
+        Stores for every hash value the bucket, which find_nearest_buckets finds for it, so it can be found with a
+        single exact lookup by find_expanded_buckets. Hash values without a bucket are not stored. The keys are
+        dropped, when the buckets change.
+        :param hash_values: array of hashes to store
+        :param lower: array with the lowest accepted hash for every hash value
+        :param upper: array with the highest accepted hash for every hash value
+        :return: None
+        """
+        hash_values = np.asarray(hash_values, dtype=np.int64)
+        order = np.argsort(hash_values, kind="stable")
+        hash_values, lower, upper = hash_values[order], np.asarray(lower)[order], np.asarray(upper)[order]
+
+        buckets = self.find_nearest_buckets(hash_values, lower, upper)
+        found = buckets >= 0
+        self.expanded_hashes = hash_values[found].astype(np.uint32)
+        self.expanded_buckets = buckets[found].astype(np.int32 if self.hashes.shape[0] < 2**31 else np.int64)
+
+    def find_expanded_buckets(self, hash_values):
+        """
+        Looks up the buckets stored by set_expanded_keys, the result equals the one of find_nearest_buckets with the
+        ranges given to set_expanded_keys
+        :param hash_values: array of hashes to search for
+        :return: array of bucket numbers, -1 where no bucket is stored for the hash value
+        """
+        hash_values = np.asarray(hash_values, dtype=np.int64)
+        n_of_keys = self.expanded_hashes.shape[0]
+        if n_of_keys == 0:
+            return np.full(hash_values.shape[0], -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.expanded_hashes, hash_values.astype(np.uint32)), n_of_keys - 1)
+        found = self.expanded_hashes[positions] == hash_values
+        return np.where(found, self.expanded_buckets[positions], -1).astype(np.int64)
+
+    def _get_live_buckets(self):
+        """
+        Returns the numbers of all buckets holding postings of not removed documents, None if nothing is removed
+        """
+        if self._live_lengths is None:
+            return None
+        if self._live_buckets is None:
+            self._live_buckets = np.flatnonzero(self._live_lengths > 0)
+        return self._live_buckets
+
+    def get_posting_indexes(self, buckets):
+        """
+        Returns the positions of all postings of the given buckets in the posting-arrays
+        :param buckets: array of bucket numbers
+        :return: (for every posting the index of its bucket in buckets, posting positions)
+        """
+        buckets = np.asarray(buckets, dtype=np.int64)
+        starts = self.offsets[buckets]
+        bucket_idx, positions = self.expand_ranges(starts, self.offsets[buckets + 1] - starts)
+
+        if self._removed_postings > 0:
+            doc_ids = self.doc_ids[positions] if self.compressed is None else self.compressed.decode(positions)[0]
+            live = ~self._removed[doc_ids]
+            bucket_idx, positions = bucket_idx[live], positions[live]
+
+        return bucket_idx, positions
+
+    def get_bucket_postings(self, buckets):
+        """
+        Returns all postings of the given buckets as arrays, postings of removed documents are skipped.
+        Compressed postings are decoded.
+        :param buckets: array of bucket numbers
+        :return: (for every posting the index of its bucket in buckets, doc_ids, pos1, td12, max_pos)
+        """
+        buckets = np.asarray(buckets, dtype=np.int64)
+        starts = self.offsets[buckets]
+        bucket_idx, positions = self.expand_ranges(starts, self.offsets[buckets + 1] - starts)
+        columns = self.get_posting_columns(positions)
+
+        if self._removed_postings > 0:
+            live = ~self._removed[columns[0]]
+            bucket_idx, columns = bucket_idx[live], tuple(column[live] for column in columns)
+
+        return (bucket_idx,) + tuple(columns)
+
+    def get_posting_columns(self, positions):
+        """
+        Returns the postings at the given positions of the posting-arrays, compressed postings are decoded
+        :param positions: array of posting positions
+        :return: (doc_ids, pos1, td12, max_pos)
+        """
+        if self.compressed is not None:
+            return self.compressed.decode(positions)
+        return self.doc_ids[positions], self.pos1[positions], self.td12[positions], self.max_pos[positions]
+
+    @staticmethod
+    def expand_ranges(starts, lengths):
+        """
+        Returns all positions of several ranges of positions
+        :param starts: array with the first position of every range
+        :param lengths: array with the length of every range
+        :return: (for every position the index of its range, positions)
+        """
+        range_idx = np.repeat(np.arange(lengths.shape[0]), lengths)
+        # position inside of each range, counted from the start of the range
+        inner = np.arange(range_idx.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return range_idx, starts[range_idx] + inner
+
+    def get_postings(self, bucket):
+        """
+        Returns all postings of a bucket as list of Posting-tuples
+        :param bucket: bucket number as returned by find_bucket
+        :return: list of postings
+        """
+        return self.get_postings_at(np.arange(self.offsets[bucket], self.offsets[bucket + 1]))
+
+    def get_postings_at(self, positions):
+        """
+        Returns the postings at the given positions of the posting-arrays as list of Posting-tuples
+        :param positions: array of posting positions
+        :return: list of postings
+        """
+        return [self.Posting(*posting) for posting in zip(*(column.tolist()
+                                                            for column in self.get_posting_columns(positions)))]
+
+    def get_bucket_lengths(self):
+        """
+        Returns the number of postings for every stored hash, postings of removed documents are not counted
+        :return: np.array
+        """
+        if self._live_lengths is not None:
+            return self._live_lengths
+        return np.diff(self.offsets)
+
+    def get_length_percentile(self, percentile):
+        """
+        Calculates the percentile of the lengths of all buckets holding postings from the histogram of the
+        bucket lengths. The result equals np.percentile(lengths, percentile) with linear interpolation.
+        :param percentile: percentile between 0 and 100
+        :return: percentile of the bucket lengths, nan if there are no buckets
+        """
+        cumulative = np.cumsum(self._length_counts[1:])
+        n_of_buckets = int(cumulative[-1]) if cumulative.shape[0] > 0 else 0
+        if n_of_buckets == 0:
+            return np.nan
+
+        virtual_index = (n_of_buckets - 1) * (percentile / 100)
+        previous_index = min(max(int(np.floor(virtual_index)), 0), n_of_buckets - 1)
+        next_index = min(previous_index + 1, n_of_buckets - 1)
+        gamma = virtual_index - previous_index
+
+        # length at a position of the sorted lengths, the histogram starts at length 1
+        previous_length, next_length = np.searchsorted(cumulative, (previous_index, next_index), side="right") + 1
+
+        # interpolate like numpy does
+        diff = next_length - previous_length
+        if gamma >= 0.5:
+            return np.float64(next_length - diff * (1 - gamma))
+        return np.float64(previous_length + diff * gamma)
+
+    def get_key_table(self):
+        """
+        Returns all hashes, which hold postings of not removed documents, with their bucket lengths
+        :return: (array of hashes, array of bucket lengths)
+        """
+        live_buckets = self._get_live_buckets()
+        if live_buckets is None:
+            return np.array(self.hashes), np.array(self.get_bucket_lengths())
+        return self.hashes[live_buckets], self.get_bucket_lengths()[live_buckets]
+
+    @classmethod
+    def from_key_tables(cls, key_tables):
+        """
+        Creates an index of the hashes and bucket lengths of several indexes, e.g. of all shards of a partitioned
+        index. Its buckets have the summed up lengths, but it holds no postings, so it can only be used to find
+        buckets and their lengths.
+        :param key_tables: list of (hashes, bucket lengths) as returned by get_key_table
+        :return: FingerPrintIndex
+        """
+        hashes = np.concatenate([np.zeros(0, dtype=np.uint32)] + [hashes for hashes, _ in key_tables])
+        lengths = np.concatenate([np.zeros(0, dtype=np.int64)] + [lengths for _, lengths in key_tables])
+
+        index = cls()
+        index.hashes, inverse = np.unique(hashes, return_inverse=True)
+        merged_lengths = np.zeros(index.hashes.shape[0], dtype=np.int64)
+        np.add.at(merged_lengths, inverse, lengths)
+        index.offsets = np.append(0, np.cumsum(merged_lengths)).astype(np.int64)
+        index._reset_lengths()
+
+        return index
+
+    def get_nr_of_postings(self):
+        return self._get_n_of_stored_postings() - self._removed_postings
+
+    def _get_n_of_stored_postings(self):
+        """ Returns the number of postings in the arrays, postings of removed documents are counted"""
+        return self.doc_ids.shape[0] if self.compressed is None else self.compressed.n_of_postings
+
+    def get_nbytes(self):
+        """
+        Returns the number of bytes used by the index arrays
+        """
+        nbytes = sum(array.nbytes for array in (self.hashes, self.offsets, self.doc_ids,
+                                                self.pos1, self.td12, self.max_pos, self.pruned_hashes,
+                                                self.pruned_doc_ids, self.pruned_counts))
+        if self.compressed is not None:
+            nbytes += self.compressed.get_nbytes()
+        if self.expanded_hashes is not None:
+            nbytes += self.expanded_hashes.nbytes + self.expanded_buckets.nbytes
+        return nbytes
+
+    def save(self, path):
+        """
+        Stores all arrays as .npy files in the directory path, compressed postings are stored compressed
+        :param path: existing directory
+        :return: None
+        """
+        self.freeze()
+        self.compact()
+
+        # the arrays may be memory-mapped from the files they replace, so every file is written
+        # under a temporary name first
+        arrays = [("hashes", self.hashes), ("offsets", self.offsets)]
+        arrays += [(field, getattr(self, field)) for field in self.PRUNED_FIELDS]
+        if self.compressed is None:
+            arrays += [(field, getattr(self, field)) for field, _ in self.POSTING_FIELDS]
+            stale_fields = self.CompressedPostings.FIELDS
+        else:
+            self.compressed.save(path)
+            stale_fields = [field for field, _ in self.POSTING_FIELDS]
+        for name, array in arrays:
+            np.save(os.path.join(path, name + ".tmp.npy"), array)
+            os.replace(os.path.join(path, name + ".tmp.npy"), os.path.join(path, name + ".npy"))
+
+        # files of the other posting layout are left from an earlier snapshot
+        for name in stale_fields:
+            if os.path.exists(os.path.join(path, name + ".npy")):
+                os.remove(os.path.join(path, name + ".npy"))
+
+    @classmethod
+    def load(cls, path, names):
+        """
+        Loads an index stored by save() using memory-mapping
+        :param path: directory of the stored index
+        :param names: list of document names, the position in the list is the document id, None for free ids
+        :return: FingerPrintIndex
+        """
+        index = cls()
+        index.names = list(names)
+        index._name_ids = dict((name, doc_id) for doc_id, name in enumerate(index.names) if name is not None)
+        index._free_ids = [doc_id for doc_id, name in enumerate(index.names) if name is None][::-1]
+
+        index.hashes = np.load(os.path.join(path, "hashes.npy"), mmap_mode="r")
+        index.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        index.compressed = cls.CompressedPostings.load(path)
+        if index.compressed is None:
+            for field, _ in cls.POSTING_FIELDS:
+                setattr(index, field, np.load(os.path.join(path, field + ".npy"), mmap_mode="r"))
+        else:
+            index.compress_postings = True
+            index.position_step = index.compressed.position_step
+            index.block_size = index.compressed.block_size
+        for field in cls.PRUNED_FIELDS:
+            setattr(index, field, np.load(os.path.join(path, field + ".npy")))
+        index._reset_lengths()
+
+        return index
@@ -1,8 +1,18 @@
 from search_algorithms.abstract_match_algorithm import AbstractMatchClass
+from search_algorithms.fingerprint_index import FingerPrintIndex
 from library.midilibrary import MidiLibrary
 from library.midifile import MidiFile
 import numpy as np
+import bisect
 import collections
+import concurrent.futures
+import hashlib
+import heapq
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
 
 
 class FingerPrinting(AbstractMatchClass):
@@ -15,23 +25,64 @@ class FingerPrinting(AbstractMatchClass):
     VERIFICATION_TIME_WINDOW = "verification_time_window"
 
     ELIMINATE_TOP_PERCENTILE = "eliminate_percentile"
+    PRUNE_STOP_LIST = "prune_stop_list"
+    COMPRESS_POSTINGS = "compress_postings"
 
     TDR_HASH_TYPE = "hash type"
     TDR_RANGE = "tdr_range"
     TDR_RESOLUTION = "tdr_resolution"
     TDR_WINDOW = "tdr_window"
     TDR_MASK = "tdr_tdr_mask"
+    EXPAND_TDR_INDEX = "expand_tdr_index"
 
     SPLIT_QUERIES_LONGER_THAN = "long_query_split"
     SPLIT_QUERY_LENGTH = "split_query_length"
     SPLIT_QUERIES_SLIDING_WINDOW = "query_split_sliding_window"
 
+    INDEX_SNAPSHOT = "index_snapshot"
+    INDEX_WORKERS = "index_workers"
+    SEARCH_WORKERS = "search_workers"
+    RESULT_CACHE_SIZE = "result_cache_size"
+
+    # Snapshot layout, the version has to be increased whenever the stored arrays change
+    SNAPSHOT_VERSION = 5
+    SNAPSHOT_META_FILE = "meta.pickle"
+    # Every save writes the arrays into a new directory, the meta file names the directory of the current snapshot
+    SNAPSHOT_GENERATION_DIR = "generation_{}"
+
+    # Fields of the fingerprint arrays returned by create_fingerprints
+    FINGERPRINT_DTYPE = np.dtype([("hash", np.uint32), ("pos1", np.float64), ("td12", np.float64),
+                                  ("max_pos", np.float64)])
+
     # Default parameters for Fingerprint Creation
     DEFAULT_N = 4
     DEFAULT_N_I = (3, 2, 2)
     DEFAULT_D = 0.05
     DEFAULT_PITCH_DIFF = 24
 
+    # Default number of processes creating the fingerprints of the library, None uses all cpu cores
+    DEFAULT_INDEX_WORKERS = 1
+    # Number of files fingerprinted by a worker at once
+    INDEX_WORKER_BATCH_SIZE = 16
+    # The workers are started as new processes instead of forks, forking a process with running threads (e.g. the
+    # gui) can copy locks held by other threads into the workers
+    INDEX_WORKER_START_METHOD = "spawn"
+
+    # Default number of threads scoring the windows of a search, None uses all cpu cores
+    DEFAULT_SEARCH_WORKERS = 1
+
+    # Default memory budget of the cache of search results in bytes, 0 disables the cache
+    DEFAULT_RESULT_CACHE_SIZE = 0
+
+    # Number of queries, whose fingerprints are looked up together by search_many
+    SEARCH_BATCH_SIZE = 64
+    # Maximal number of matched pairs, which are scored together by search_many
+    SEARCH_GROUP_PAIRS = 2000000
+
+    # Buckets, which are this factor longer than the quantile, lose their postings, if the stop list is pruned. The
+    # margin keeps small changes of the quantile from requiring the dropped postings again
+    STOP_LIST_PRUNE_FACTOR = 1.25
+
     # Default parameter for Verification
     DEFAULT_VERIFICATION_TIME_WINDOW = 0.5
 
@@ -96,121 +147,192 @@ class FingerPrinting(AbstractMatchClass):
         SPLIT_QUERY_LENGTH: 25
     }
 
-    class FingerPrintList(list):
+    class MatchHistograms(object):
         """
-        This FingerPrintList calculates automatically the diagonal score
-        of the fingerprint-algorithm, when a matched fingerprint-pair is appended
-        or removed.
+        Calculates the diagonal histograms of all files matched by a query at once.
+        For every matched pair of a database and a query fingerprint the speed ratio r is calculated
+        and the pair is counted in the bin round(db_pos1 - q_pos1 * r) of the histogram of its file.
+        For every bin the number of pairs, the database fingerprint with the lowest start position, the query fingerprint
+        with the lowest start position and the highest end position of the database fingerprints are kept.
         """
 
-        class BinFingerPrintList(list):
-            """ Stores all fingerprints for a bin, and stores the lowest start position and highest end position"""
-            def __init__(self):
-                super().__init__()
-                self.end = None
-                self.start = None
-
-            def append(self, obj):
-                super().append(obj)
-                if self.end is None or self.end.max_pos < obj.max_pos:
-                    self.end = obj
-                if self.start is None or self.start.pos1 > obj.pos1:
-                    self.start = obj
-
-        def __init__(self, db_name, query_fingerprints, query_notes, query_name, **kwargs):
+        def __init__(self, doc_ids, db_pos1, db_td12, q_pos1, q_td12, max_pos):
             """
-            Initialize function
-            :param midifile: The midifile in the database
-            :param query_fingerprints: fingerprints of the query
-            :param kwargs: for super-class
+            Initialize function, all parameters are arrays with one entry per matched pair, in the order the pairs
+            were matched
+            :param doc_ids: document ids of the database fingerprints
+            :param db_pos1: start positions of the database fingerprints
+            :param db_td12: time differences between the first two notes of the database fingerprints
+            :param q_pos1: start positions of the query fingerprints
+            :param q_td12: time differences between the first two notes of the query fingerprints
+            :param max_pos: end positions of the database fingerprints
             """
-            super().__init__(kwargs)
-            self.db_name = db_name
-            self.query_fingerprints = query_fingerprints
-            self.query_name = query_name
-            self.query_notes = query_notes
-            self.histogram = collections.Counter()
-            self.fps_in_bins = dict()
-            self.query_fps_in_bins = dict()
-            self.max_score = None
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            n_of_pairs = doc_ids.shape[0]
+
+            # calculate the speed ratio and the histogram-diagonal of every pair
+            r = db_td12 / q_td12
+            bins = np.rint(db_pos1 - q_pos1 * r).astype(np.int64)
+
+            # group the pairs by file and bin, inside of a group the pairs keep the order they were matched
+            order = self._group_order(doc_ids, bins)
+            sorted_docs, sorted_bins = doc_ids[order], bins[order]
+            new_group = np.ones(n_of_pairs, dtype=bool)
+            new_group[1:] = (sorted_docs[1:] != sorted_docs[:-1]) | (sorted_bins[1:] != sorted_bins[:-1])
+            starts = np.flatnonzero(new_group)
+
+            self.doc_ids = sorted_docs[starts]
+            self.bins = sorted_bins[starts]
+            self.scores = np.diff(np.append(starts, n_of_pairs))
+            self.first_match = order[starts]
+
+            # the first pair with the lowest start position of each bin
+            db_start = order[self._first_minimum(db_pos1[order], starts, self.scores)]
+            q_start = order[self._first_minimum(q_pos1[order], starts, self.scores)]
+            self.db_pos1, self.db_td12 = db_pos1[db_start], db_td12[db_start]
+            self.q_pos1, self.q_td12 = q_pos1[q_start], q_td12[q_start]
+            self.end = np.maximum.reduceat(max_pos[order], starts) if n_of_pairs > 0 else max_pos[:0]
+
+            # files are ordered by their first matched pair
+            self.doc_starts = np.flatnonzero(np.diff(self.doc_ids, prepend=-1))
+            self.doc_order = np.argsort(np.minimum.reduceat(self.first_match, self.doc_starts)) if n_of_pairs > 0 \
+                else self.doc_starts
 
-        def append(self, matched_pair):
+        @staticmethod
+        def _group_order(doc_ids, bins):
             """
-            Append new matched pair to the list
-            :param matched_pair: tuple of 2: first item is the database-fingerprint second item is the query-fingerprint
-            :return: None
+            Returns the stable sort order of the pairs by file and bin
+            :param doc_ids: document id of every pair
+            :param bins: bin of every pair
+            :return: array of pair indexes
             """
+            if doc_ids.shape[0] == 0:
+                return np.zeros(0, dtype=np.int64)
 
-            super().append(matched_pair)
-
-            mfp, qfp = matched_pair
+            # a single sort key is used, if file and bin fit into it
+            min_bin = bins.min()
+            span = int(bins.max()) - int(min_bin) + 1
+            if int(doc_ids.max()) < 2**62 // span:
+                return np.argsort(doc_ids * span + (bins - min_bin), kind="stable")
+            return np.lexsort((bins, doc_ids))
 
-            # calculate the speed ratio
-            r = float(mfp.td12) / float(qfp.td12)
-
-            # Update the histogram-diagonal score
-            hpos = int(round(mfp.pos1 - qfp.pos1 * r))
-            self.histogram[hpos] += 1
-            bin_x = self.fps_in_bins.get(hpos, None)
-            if bin_x is None:
-                bin_x = self.BinFingerPrintList()
-                self.fps_in_bins[hpos] = bin_x
-
-            bin_x.append(mfp)
-
-            bin_x = self.query_fps_in_bins.get(hpos, None)
-            if bin_x is None:
-                bin_x = self.BinFingerPrintList()
-                self.query_fps_in_bins[hpos] = bin_x
-
-            bin_x.append(qfp)
+        @staticmethod
+        def _first_minimum(values, starts, sizes):
+            """
+            Returns for every group of values the index of the first value, which is the minimum of the group
+            :param values: array of values, ordered by group
+            :param starts: start index of every group
+            :param sizes: number of values of every group
+            :return: array of indexes into values
+            """
+            if values.shape[0] == 0:
+                return starts
 
-            new_score = self.histogram[hpos]
+            is_minimum = values == np.repeat(np.minimum.reduceat(values, starts), sizes)
+            candidates = np.flatnonzero(is_minimum)
+            groups = np.repeat(np.arange(starts.shape[0]), sizes)[candidates]
+            return candidates[np.flatnonzero(np.diff(groups, prepend=-1))]
 
-            # update the maximum score, if a higher one is reached
-            if self.max_score is None or new_score > self.max_score[1]:
-                self.max_score = (hpos, new_score)
+        def get_doc_ids(self):
+            """
+            Returns the ids of all matched files, in the order they were matched first
+            :return: array of document ids
+            """
+            return self.doc_ids[self.doc_starts[self.doc_order]]
 
-        def remove(self, matched_pair):
-            super().remove(matched_pair)
+        def get_first_matches(self):
+            """
+            Returns the index of the first matched pair of every file
+            :return: array of pair indexes, in the order of get_doc_ids
+            """
+            if self.doc_starts.shape[0] == 0:
+                return self.doc_starts
+            return np.minimum.reduceat(self.first_match, self.doc_starts)[self.doc_order]
 
-            mfp, qfp = matched_pair
+        def get_top_bins(self, filter_factor):
+            """
+            Returns all bins, which scores are above filter_factor * average score of the histogram of their file.
+            The bins are ordered by file, like in get_doc_ids, and descending by score. Bins with the same score keep
+            the order in which they were matched first.
+            :param filter_factor: factor of the average bin-score
+            :return: array of bin indexes
+            """
+            bins_per_doc = np.diff(np.append(self.doc_starts, self.bins.shape[0]))
+            if bins_per_doc.shape[0] == 0:
+                return bins_per_doc
 
-            # calculate the speed ratio
-            r = float(mfp.td12) / float(qfp.td12)
+            mean_score = np.add.reduceat(self.scores, self.doc_starts) / bins_per_doc
+            top = np.flatnonzero(self.scores > np.repeat(mean_score * filter_factor, bins_per_doc))
 
-            hpos = int(round(mfp.pos1 - qfp.pos1 * r))
-            old_score = self.histogram[hpos]
+            doc_rank = np.empty_like(self.doc_order)
+            doc_rank[self.doc_order] = np.arange(self.doc_order.shape[0])
+            doc_rank = np.repeat(doc_rank, bins_per_doc)
 
-            self.histogram[hpos] -= 1
+            return top[np.lexsort((self.first_match[top], -self.scores[top], doc_rank[top]))]
 
-            # Score needs to be reevaluated
-            if old_score == self.max_score[1]:
-                self.max_score = None  # clear max_score, so it has to be recalculated
+    class ResultCache:
+        """
+        LRU cache of search results. The results are stored pickled, so a cached result can not be changed by the
+        caller and the size of the pickled result is used as size of an entry. The least recently used entries are
+        dropped, when the entries exceed the memory budget.
+        """
 
-        def get_score(self):
+        def __init__(self, max_bytes):
             """
-            Returns the highest diagonal score of the histogram
-            :return: Highest score
+            :param max_bytes: memory budget of the cached results in bytes
             """
-            if self.max_score is None:
-                highest_score = self.histogram.most_common(1)
-                if len(highest_score) > 0:
-                    self.max_score = highest_score[0]
-                else:
-                    return (-1, -1)
-
-            return self.max_score
+            self.max_bytes = max_bytes
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self._entries = collections.OrderedDict()
 
-        def get_top_bins(self, filter_factor):
-            scores = np.array(self.histogram.most_common())
-            return scores[scores[:, 1] > scores[:, 1].mean() * filter_factor]
+        def get(self, key):
+            """
+            Returns the cached result of a key and counts the hit or miss
+            :param key: key of the result
+            :return: the result or None, if it is not cached
+            """
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
 
-        def __str__(self):
-            return self.db_name + str(self.get_score()[1])
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return pickle.loads(entry)
 
-        def __repr__(self):
-            return self.db_name + str(self.get_score()[1])
+        def put(self, key, result):
+            """
+            Caches a result, results larger than the memory budget are not cached
+            :param key: key of the result
+            :param result: search result
+            :return: None
+            """
+            entry = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(entry) > self.max_bytes:
+                return
+
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            self._entries[key] = entry
+            self.nbytes += len(entry)
+
+            while self.nbytes > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.nbytes -= len(dropped)
+
+        def clear(self):
+            """ Drops all cached results, the hit and miss counters are kept"""
+            self._entries.clear()
+            self.nbytes = 0
+
+        def get_statistics(self):
+            """
+            :return: (number of hits, number of misses, number of cached results, bytes of the cached results)
+            """
+            return self.hits, self.misses, len(self._entries), self.nbytes
 
     def __init__(self, database: MidiLibrary, notify_init_status=None, **kwargs):
         """
@@ -221,9 +343,12 @@ class FingerPrinting(AbstractMatchClass):
 
         np.random.seed(23)
 
-        # Create Fingerprint-Database
-        self._fingerprints = dict()
+        # Create Fingerprint-Database, the postings are stored compressed, if COMPRESS_POSTINGS is set
+        self.compress_postings = kwargs.get(self.COMPRESS_POSTINGS, False)
+        self._fingerprints = FingerPrintIndex(self.compress_postings)
         self._in_db = set()
+        # (size, modification time) of every indexed file, when it was fingerprinted
+        self._file_stamps = dict()
 
         # Use custom parameters
         self.N = kwargs.get(self.N_OF_NOTES, self.DEFAULT_N)
@@ -232,67 +357,369 @@ class FingerPrinting(AbstractMatchClass):
         self.d = kwargs.get(self.NOTE_DISTANCE, self.DEFAULT_D)
         self.verification_time_window = kwargs.get(self.VERIFICATION_TIME_WINDOW, self.DEFAULT_VERIFICATION_TIME_WINDOW)
         self.percentile = kwargs.get(self.ELIMINATE_TOP_PERCENTILE, None)
+        self.prune_stop_list = kwargs.get(self.PRUNE_STOP_LIST, False)
         self.split_queries_longer_than = kwargs.get(self.SPLIT_QUERIES_LONGER_THAN,
                                                     self.DEFAULT_SPLIT_QUERIES_LONGER_THAN)
         self.split_query_length = kwargs.get(self.SPLIT_QUERY_LENGTH, self.DEFAULT_SPLIT_QUERIES_LONGER_THAN)
         self.split_queries_sliding_window = kwargs.get(self.SPLIT_QUERIES_SLIDING_WINDOW,
                                                        self.DEFAULT_SPLIT_QUERIES_SLIDING_WINDOW)
-
-        # Set settings for the FingerPrint Class
-        self.FingerPrint.update_class_variables(kwargs.get(self.TDR_HASH_TYPE, self.DEFAULT_HASH),
-                                                kwargs.get(self.TDR_RANGE, self.DEFAULT_TDR_RANGE),
-                                                kwargs.get(self.TDR_RESOLUTION, self.DEFAULT_TDR_RESOLUTION),
-                                                kwargs.get(self.TDR_WINDOW, self.DEFAULT_TDR_WINDOW),
-                                                kwargs.get(self.TDR_MASK, self.DEFAULT_TDR_MASK))
+        self.index_workers = kwargs.get(self.INDEX_WORKERS, self.DEFAULT_INDEX_WORKERS)
+        self.search_workers = kwargs.get(self.SEARCH_WORKERS, self.DEFAULT_SEARCH_WORKERS)
+        self._search_pool = None
+        self._search_pool_size = 0
+
+        # Results of search are cached until the index changes, the version is increased with every change
+        result_cache_size = kwargs.get(self.RESULT_CACHE_SIZE, self.DEFAULT_RESULT_CACHE_SIZE)
+        self._result_cache = self.ResultCache(result_cache_size) if result_cache_size > 0 else None
+        self._index_version = 0
+
+        # Settings of the hash function of this index
+        self.fingerprint = self.FingerPrint(kwargs.get(self.TDR_HASH_TYPE, self.DEFAULT_HASH),
+                                            kwargs.get(self.TDR_RANGE, self.DEFAULT_TDR_RANGE),
+                                            kwargs.get(self.TDR_RESOLUTION, self.DEFAULT_TDR_RESOLUTION),
+                                            kwargs.get(self.TDR_WINDOW, self.DEFAULT_TDR_WINDOW),
+                                            kwargs.get(self.TDR_MASK, self.DEFAULT_TDR_MASK))
+
+        # Store the neighbouring tdr-values of the database hashes in the index, so every query hash is looked up
+        # exactly instead of searching the closest hash of its tdr-range
+        self.expand_tdr_index = kwargs.get(self.EXPAND_TDR_INDEX, False)
+        if self.expand_tdr_index and self.fingerprint.TDR_RESOLUTION > self.fingerprint.TDR_MASK + 1:
+            raise Exception("{} needs a tdr mask covering the tdr resolution".format(self.EXPAND_TDR_INDEX))
 
         self.quantile = None
 
+        # Try to start from a stored index snapshot, only files missing in the snapshot or changed since it was
+        # stored are fingerprinted and files, which are not in the library anymore, are removed from the index
+        snapshot = kwargs.get(self.INDEX_SNAPSHOT, None)
+        if snapshot is not None and os.path.exists(snapshot):
+            try:
+                self.load_index(snapshot)
+            except Exception as e:
+                print(e)
+                self._reset_index()
+
+        indexed_files = dict(self._file_stamps)
+
         self.create_fp_from_library(notify_init_status)
 
+        if snapshot is not None and self._file_stamps != indexed_files:
+            try:
+                self.save_index(snapshot)
+            except OSError as e:
+                print(e)
+
+    def _reset_index(self):
+        """ Removes all stored fingerprints"""
+        self._fingerprints = FingerPrintIndex(self.compress_postings)
+        self._in_db = set()
+        self._file_stamps = dict()
+        self.quantile = None
+
+    def get_index_parameters(self):
+        """
+        Returns all parameters which influence the content of the fingerprint-index.
+        An index snapshot can only be used with the exact same parameters.
+        :return: dictionary of parameters
+        """
+        return {
+            self.N_OF_NOTES: self.N,
+            self.FINGERPRINT_PER_NOTES: tuple(self.n),
+            self.NOTE_DISTANCE: self.d,
+            self.PITCH_DIFF: self.pitch_diff,
+            self.TDR_HASH_TYPE: self.fingerprint.TDR_HASH_TYPE,
+            self.TDR_RANGE: self.fingerprint.TDR_RANGE,
+            self.TDR_RESOLUTION: self.fingerprint.TDR_RESOLUTION,
+            self.TDR_WINDOW: self.fingerprint.TDR_WINDOW,
+            self.TDR_MASK: self.fingerprint.TDR_MASK,
+            self.ELIMINATE_TOP_PERCENTILE: self.percentile
+        }
+
+    def save_index(self, path):
+        """
+        Stores the fingerprint-index as a snapshot in the directory path. Every array of the index
+        is stored as a separate .npy-file, so it can be memory-mapped when loading.
+        The arrays are written into a new generation directory and the meta file, which names it, is replaced
+        afterwards, so an interrupted save leaves the previous snapshot complete.
+        :param path: directory of the snapshot, is created if it does not exist
+        :return: None
+        """
+        generation = self.SNAPSHOT_GENERATION_DIR.format(os.urandom(8).hex())
+        os.makedirs(os.path.join(path, generation))
+
+        self._fingerprints.save(os.path.join(path, generation))
+
+        meta = {
+            "version": self.SNAPSHOT_VERSION,
+            "generation": generation,
+            "parameters": self.get_index_parameters(),
+            "quantile": self.quantile,
+            "names": self._fingerprints.names,
+            "in_db": sorted(self._in_db),
+            "file_stamps": self._file_stamps
+        }
+        meta_path = os.path.join(path, self.SNAPSHOT_META_FILE)
+        with open(meta_path + ".tmp", 'wb') as f:
+            pickle.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+        # Remove the earlier generations, the ones of interrupted saves and the arrays of snapshots without
+        # generations, memory-mapped arrays stay readable until they are closed
+        for name in os.listdir(path):
+            if name != generation and name.startswith(self.SNAPSHOT_GENERATION_DIR.format("")):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            elif name.endswith(".npy"):
+                try:
+                    os.remove(os.path.join(path, name))
+                except OSError as e:
+                    print(e)
+
+    def load_index(self, path):
+        """
+        Loads a fingerprint-index snapshot created by save_index. The arrays are memory-mapped.
+        A snapshot created with different parameters or with another snapshot version is refused.
+        :param path: directory of the snapshot
+        :return: None
+        """
+        with open(os.path.join(path, self.SNAPSHOT_META_FILE), 'rb') as f:
+            meta = pickle.load(f)
+
+        if meta.get("version", None) != self.SNAPSHOT_VERSION:
+            raise Exception("Index snapshot {} has version {}, expected {}".format(path, meta.get("version", None),
+                                                                                   self.SNAPSHOT_VERSION))
+
+        if meta["parameters"] != self.get_index_parameters():
+            raise Exception("Index snapshot {} was created with parameters {}, but {} are used".format(
+                path, meta["parameters"], self.get_index_parameters()))
+
+        self._fingerprints = FingerPrintIndex.load(os.path.join(path, meta["generation"]), meta["names"])
+        self._fingerprints.set_compression(self.compress_postings)
+        self._in_db = set(meta["in_db"])
+        self._file_stamps = dict(meta["file_stamps"])
+        self.quantile = meta["quantile"]
+        self._index_changed()
+
+    @staticmethod
+    def get_file_stamp(midifile):
+        """
+        :param midifile: MidiFile
+        :return: (size, modification time in ns) of the file of midifile, None if it can not be read
+        """
+        try:
+            stat = os.stat(midifile.file_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
     def create_fp_from_library(self, notify_init_status=None):
-        max_midi = self.database.get_length() - len(self._in_db)
-        current = 0
+        # Remove files, which were removed from the library
+        removed_files = self._in_db.difference(self.database.get_midifile_names())
+
+        # Files, which were changed since they were fingerprinted, are fingerprinted again
+        for midifile in self.database.get_midifiles():
+            if isinstance(midifile, MidiFile) and midifile.name in self._in_db and \
+                    self._file_stamps.get(midifile.name, None) != self.get_file_stamp(midifile):
+                removed_files.add(midifile.name)
+
+        for name in removed_files:
+            self._in_db.discard(name)
+            self._file_stamps.pop(name, None)
+            self._fingerprints.remove_document(name)
+
+        midifiles = [midifile for midifile in self.database.get_midifiles()
+                     if isinstance(midifile, MidiFile) and midifile.name not in self._in_db]
+        max_midi = len(midifiles)
 
         # Are there new items to add?
         if max_midi > 0:
-            # Create fingerprints for each midifile in the database
-            for midifile in self.database.get_midifiles():
+            self._add_midifiles(midifiles, notify_init_status)
 
-                if notify_init_status is not None:
-                    notify_init_status("fp", current, max_midi, midifile.name)
-
-                if isinstance(midifile, MidiFile):
-                    try:
-                        if midifile.name not in self._in_db:
-                            current += 1
-                            self._in_db.add(midifile.name)
-
-                            for fp in self.create_fingerprints(midifile.get_notes_for_fingerprints(), midifile.name)[0]:
-                                fplist = self._fingerprints.get(fp.hash, None)
-                                # check if hash is already in the list
-                                if fplist is None:
-                                    # create new list
-                                    self._fingerprints[fp.hash] = [fp]
-                                else:
-                                    # otherwise append fingerprint to existing list
-                                    fplist.append(fp)
-                    except Exception as e:
-                        if notify_init_status is not None:
-                            notify_init_status("excpetion", -1, -1, "{} containts too few notes".format(midifile.name))
-                        else:
-                            print(e)
-
-            if self.percentile is not None:
-                lens = np.zeros(len(self._fingerprints))
-                for idx, key in enumerate(self._fingerprints):
-                    lens[idx] = len(self._fingerprints[key])
-                self.quantile = np.percentile(lens, self.percentile)
-            else:
-                self.quantile = None
+        if max_midi > 0 or len(removed_files) > 0:
+            self._update_stop_list(notify_init_status)
+            self._index_changed()
 
         if notify_init_status is not None:
             notify_init_status("fp", max_midi, max_midi, "")
 
+    def _add_midifiles(self, midifiles, notify_init_status=None):
+        """
+        Creates the fingerprints of midifiles and adds them to the index
+        :param midifiles: list of MidiFiles, which are not in the index
+        :param notify_init_status: optional callback for progress
+        :return: None
+        """
+        max_midi = len(midifiles)
+        self._in_db.update(midifile.name for midifile in midifiles)
+        self._file_stamps.update((midifile.name, self.get_file_stamp(midifile)) for midifile in midifiles)
+
+        # Create fingerprints for each new midifile in the database, the fingerprints are added
+        # in the order of the library, no matter how many workers are used
+        for current, (midifile, fps) in enumerate(self._create_library_fingerprints(midifiles)):
+            if notify_init_status is not None:
+                notify_init_status("fp", current, max_midi, midifile.name)
+
+            if isinstance(fps, Exception):
+                if notify_init_status is not None:
+                    notify_init_status("excpetion", -1, -1, "{} containts too few notes".format(midifile.name))
+                else:
+                    print(fps)
+            else:
+                self._fingerprints.add_document(midifile.name, fps["hash"], fps["pos1"], fps["td12"],
+                                                fps["max_pos"])
+
+        self._fingerprints.freeze()
+
+    def remove_midifile(self, name):
+        """
+        Removes the fingerprints of a file from the index. The postings are removed lazily by the index.
+        :param name: name of the midifile
+        :return: True, if the file was in the index
+        """
+        if name not in self._in_db:
+            return False
+
+        self._in_db.discard(name)
+        self._file_stamps.pop(name, None)
+        self._fingerprints.remove_document(name)
+        self._update_stop_list()
+        self._index_changed()
+        return True
+
+    def update_midifile(self, name, notify_init_status=None):
+        """
+        Creates the fingerprints of a changed file of the library again, the file has to be updated in the
+        library first (MidiLibrary.update_midifile). A file not in the library anymore is removed from the index.
+        :param name: name of the midifile
+        :param notify_init_status: optional callback for progress
+        :return: None
+        """
+        self.remove_midifile(name)
+        self.create_fp_from_library(notify_init_status)
+
+    def _update_stop_list(self, notify_init_status=None):
+        """
+        Updates the quantile and prunes the index, if PRUNE_STOP_LIST is set: the postings of buckets, which are
+        STOP_LIST_PRUNE_FACTOR times longer than the quantile, are dropped. These buckets are still found and have
+        the same length, so find_query_buckets ignores them like before. If a pruned bucket became shorter than the
+        quantile, its postings are needed again and the index is created again.
+        :param notify_init_status: optional callback for progress
+        :return: None
+        """
+        self._update_quantile()
+        index = self._fingerprints
+
+        pruned = index.get_pruned_buckets()
+        if pruned.shape[0] > 0 and (self.quantile is None or
+                                    np.any(index.get_bucket_lengths()[pruned] < self.quantile)):
+            # the files are added in the order of their document ids, so the postings of every bucket keep their
+            # order, files without fingerprints are added last
+            doc_order = dict((name, doc_id) for doc_id, name in enumerate(index.names) if name is not None)
+            midifiles = sorted((midifile for midifile in self.database.get_midifiles()
+                                if isinstance(midifile, MidiFile) and midifile.name in self._in_db),
+                               key=lambda midifile: doc_order.get(midifile.name, len(doc_order)))
+            self._reset_index()
+            self._add_midifiles(midifiles, notify_init_status)
+            self._update_stop_list(notify_init_status)
+            return
+
+        if self.prune_stop_list and self.quantile is not None and not np.isnan(self.quantile):
+            index.prune(max(math.ceil(self.quantile * self.STOP_LIST_PRUNE_FACTOR), 1))
+
+    def _index_changed(self):
+        """ Invalidates the cached search results after the index has changed and expands the index again"""
+        self._index_version += 1
+        if self._result_cache is not None:
+            self._result_cache.clear()
+        if self.expand_tdr_index:
+            self._expand_tdr_keys()
+
+    def _expand_tdr_keys(self):
+        """
+        Stores every hash value, whose tdr-range contains a database hash, with the bucket find_query_buckets
+        chooses for it in the index (EXPAND_TDR_INDEX). The postings are not copied, only the keys are expanded.
+        :return: None
+        """
+        index = self._fingerprints
+        hash_values = np.unique(self.fingerprint.get_neighbour_hashes(index.hashes))
+        lower, upper = self.fingerprint.get_hash_ranges(hash_values)
+        index.set_expanded_keys(hash_values, lower, upper)
+
+    def get_result_cache_statistics(self):
+        """
+        Returns the hits and misses of the cache of search results, see RESULT_CACHE_SIZE
+        :return: (number of hits, number of misses, number of cached results, bytes of the cached results)
+        """
+        if self._result_cache is None:
+            return 0, 0, 0, 0
+        return self._result_cache.get_statistics()
+
+    def get_stop_list_statistics(self):
+        """
+        Returns how many postings of the stop list were dropped from the index, see PRUNE_STOP_LIST
+        :return: (number of pruned buckets, number of dropped postings, freed bytes)
+        """
+        return self._fingerprints.get_pruned_statistics()
+
+    def _update_quantile(self):
+        """ Updates the bucket length, above which hashes are ignored, from the histogram of the bucket lengths"""
+        if self.percentile is not None:
+            self.quantile = self._fingerprints.get_length_percentile(self.percentile)
+        else:
+            self.quantile = None
+
+    def _create_library_fingerprints(self, midifiles):
+        """
+        Creates the fingerprints of midifiles in batches. If more than one batch has to be processed,
+        the batches are distributed over self.index_workers processes.
+        :param midifiles: list of MidiFiles
+        :return: generator of (midifile, fingerprints) in the order of midifiles, fingerprints is the raised
+                 exception, if no fingerprints could be created
+        """
+        batch = []
+        batches = [batch]
+        for midifile in midifiles:
+            if len(batch) == self.INDEX_WORKER_BATCH_SIZE:
+                batch = []
+                batches.append(batch)
+            try:
+                batch.append((midifile.name, midifile.get_notes_for_fingerprints()))
+            except Exception as e:
+                batch.append((midifile.name, e))
+
+        workers = min(self.index_workers or os.cpu_count() or 1, len(batches))
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.get_context(self.INDEX_WORKER_START_METHOD).Pool(
+                workers, initializer=_init_index_worker, initargs=(self.get_index_parameters(), ))
+            results = pool.imap(_create_batch_fingerprints, batches)
+        else:
+            results = map(self.create_batch_fingerprints, batches)
+
+        try:
+            files = iter(midifiles)
+            for batch_fingerprints in results:
+                for fingerprints in batch_fingerprints:
+                    yield next(files), fingerprints
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def create_batch_fingerprints(self, batch):
+        """
+        Creates the fingerprints of a batch of files
+        :param batch: list of (name, notes), notes is the exception raised, if the notes could not be read
+        :return: list of fingerprint arrays, the exception is returned instead for files that failed
+        """
+        batch_fingerprints = []
+        for name, notes in batch:
+            fingerprints = notes
+            if not isinstance(notes, Exception):
+                try:
+                    fingerprints = self.create_fingerprints(notes, name)[0]
+                except Exception as e:
+                    fingerprints = e
+            batch_fingerprints.append(fingerprints)
+        return batch_fingerprints
+
     def create_fingerprints(self, query_notes, query_name, remove_doubles=False):
         """
         Creates all fingerprints for a given query: MidiFile. Optionally, fingerprints with the
@@ -300,74 +727,161 @@ class FingerPrinting(AbstractMatchClass):
         self.N determines the used events per fingerprint.
         self.n[] determines how many fingerprints per note in the midifile will be generated
 
+        All note combinations are created at once with numpy, the fingerprints are returned in the same order as
+        the combinations are enumerated note by note.
+
         :param query_notes: MidiFile from which fingerprints should be created
         :param query_name: MidiFile from which fingerprints should be created
         :param remove_doubles: only unique fingerprints are generated if True
-        :return: List of fingerprints
-        """
-        prev_hashes = dict()
-        fingerprints = []
-        created = 0
-
-        # First iterate over all notes
-        for idx, e1 in enumerate(query_notes):
-            # for each note, generate n1 follow up events
-            idx2, evt2 = self._select_next_events(query_notes, idx, self.n[0])
-            if evt2 is not None:
-                # iterate all follow up events
-                for offset2, e2 in enumerate(evt2):
-                    # for each event selected for the second value, select n2 follow up events
-                    idx3, evt3 = self._select_next_events(query_notes, idx2 + offset2, self.n[1])
-                    if evt3 is not None:
-                        # iterate over all selected events
-                        for offset3, e3 in enumerate(evt3):
-                            # generate fingerprint, if N=3
-                            if self.N == 3:
-                                fp = self.FingerPrint(query_name, e1, e2, e3, None)
-                                created += 1
-                                if not remove_doubles or prev_hashes.get(fp.hash, True):
-                                    fingerprints.append(fp)
-                                    prev_hashes[fp.hash] = False
-                            else:
-                                # select next followup events if N=4
-                                _, evt4 = self._select_next_events(query_notes, idx3 + offset3, self.n[2])
-                                if evt4 is not None:
-                                    for e4 in evt4:
-                                        # generate fingerprint
-                                        fp = self.FingerPrint(query_name, e1, e2, e3, e4)
-                                        created += 1
-                                        if not remove_doubles or prev_hashes.get(fp.hash, True):
-                                            fingerprints.append(fp)
-                                            prev_hashes[fp.hash] = False
-
-        return fingerprints, created
-
-    def _select_next_events(self, query, start_idx, n_events):
-        """
-        Select from the given query n_events, starting from start_idx+1.
-        The selected events have to be self.d later positionwise then the
-        start_idx position, and the first pitch-value has to be smaller then
-        self.pitch_diff
-        :param query: The midi eventlist
-        :param start_idx: index where to start the selection
-        :param n_events: number of events to select
-        :return: the index of the first picked event and the list of all selected events
-        """
-
-        p, pos = query[start_idx]
-        try:
-            idx = start_idx + 1
+        :return: structured array of fingerprints with the fields of FINGERPRINT_DTYPE and the number of created
+                 fingerprints
+        """
+        pitches = np.asarray(query_notes[:, 0], dtype=np.float64)
+        positions = np.asarray(query_notes[:, 1], dtype=np.float64)
+
+        combinations = self._create_combinations(pitches, positions)
+        fingerprints = self._create_combination_fingerprints(pitches, positions, combinations, remove_doubles)
+
+        return fingerprints, combinations.shape[0]
+
+    def _create_combinations(self, pitches, positions):
+        """
+        Enumerates the note combinations of all fingerprints note by note
+        :param pitches: pitches of the midi eventlist
+        :param positions: positions of the midi eventlist
+        :return: array of shape (fingerprints, N) with the note indexes of every fingerprint, the rows are ordered by
+                 their first note and the note indexes of a row are ascending
+        """
+        n_of_notes = positions.shape[0]
 
-            p_next, pos_next = query[idx]
+        successors = self._select_next_events(pitches, positions)
 
-            # iterate until position self.d and pitch_diff self.pitch_diff requirements are met
-            while (abs(pos_next - pos) < self.d) or (abs(p_next - p) > self.pitch_diff):
-                idx += 1
-                p_next, pos_next = query[idx]
-        except IndexError:
-            return -1, None
+        # every row of combinations holds the note indexes of one fingerprint, start with all notes, which have a
+        # successor and append for each following note the n[] selected events
+        combinations = np.flatnonzero(successors >= 0)[:, np.newaxis]
+        for n_events in self.n[:self.N - 1]:
+            first_events = successors[combinations[:, -1]]
+            combinations = combinations[first_events >= 0]
+            first_events = first_events[first_events >= 0]
 
-        return idx, query[idx:idx + n_events]
+            selected = first_events[:, np.newaxis] + np.arange(n_events)
+            valid = (selected < n_of_notes).ravel()
+            rows = np.repeat(np.arange(combinations.shape[0]), n_events)[valid]
+            combinations = np.column_stack((combinations[rows], selected.ravel()[valid]))
+
+        return combinations
+
+    def _create_combination_fingerprints(self, pitches, positions, combinations, remove_doubles):
+        """
+        Creates the fingerprints of note combinations
+        :param pitches: pitches of the midi eventlist
+        :param positions: positions of the midi eventlist
+        :param combinations: array of shape (fingerprints, N) with the note indexes of every fingerprint
+        :param remove_doubles: only the first fingerprint of every hashvalue is kept if True
+        :return: structured array of fingerprints with the fields of FINGERPRINT_DTYPE
+        """
+        fingerprints = np.zeros(combinations.shape[0], dtype=self.FINGERPRINT_DTYPE)
+        fingerprints["hash"] = self.fingerprint.create_hashes(pitches[combinations], positions[combinations])
+        fingerprints["pos1"] = positions[combinations[:, 0]]
+        fingerprints["td12"] = positions[combinations[:, 1]] - positions[combinations[:, 0]]
+        last_event = 3 if self.fingerprint.TDR_HASH_TYPE == self.FingerPrint.TDR_HASH_3 else 2
+        fingerprints["max_pos"] = positions[combinations[:, last_event]]
+
+        if remove_doubles:
+            _, first_occurrences = np.unique(fingerprints["hash"], return_index=True)
+            fingerprints = fingerprints[np.sort(first_occurrences)]
+
+        return fingerprints
+
+    def create_window_fingerprints(self, query_notes):
+        """
+        Creates the fingerprints of all windows of a query like create_fingerprints(split_query, "", True) does for
+        every window of _split_query. The note combinations are enumerated once for the whole query, a window gets
+        the combinations, whose notes all lie inside of it. The fingerprints themselves are calculated from the
+        positions of the window, which start from 0 time.
+        :param query_notes: notes of the query
+        :return: generator of (index of the first note, fingerprints of the window, number of created fingerprints)
+        """
+        pitches = np.asarray(query_notes[:, 0], dtype=np.float64)
+        positions = np.asarray(query_notes[:, 1], dtype=np.float64)
+        split_ranges = list(self._get_split_ranges(query_notes.shape[0]))
+
+        # a window selects the same successors as the whole query, unless the distance of two notes is that close to
+        # d, that shifting the positions of the window could change the comparison
+        if len(split_ranges) == 1 or self._has_borderline_distances(query_notes[:, 1]):
+            for split_idx, split_query in self._split_query(query_notes):
+                fingerprints, created = self.create_fingerprints(split_query, "", remove_doubles=True)
+                yield split_idx, fingerprints, created
+            return
+
+        combinations = self._create_combinations(pitches, positions)
+        window_bounds = np.searchsorted(combinations[:, 0], np.array(split_ranges).ravel()).reshape(-1, 2)
+        window_rows = [np.arange(first, last)[combinations[first:last, -1] < split_end]
+                       for (_, split_end), (first, last) in zip(split_ranges, window_bounds.tolist())]
+        created = [rows.shape[0] for rows in window_rows]
+        windows = np.repeat(np.arange(len(split_ranges)), created)
+        combinations = combinations[np.concatenate(window_rows)]
+
+        # the positions of every window start from 0 time, they are shifted like _split_query does
+        split_starts = np.array([split_idx for split_idx, _ in split_ranges], dtype=np.int64)
+        window_positions = np.asarray(query_notes[:, 1][combinations] -
+                                      query_notes[split_starts[windows], 1][:, np.newaxis], dtype=np.float64)
+        fingerprints = self._create_combination_fingerprints(pitches[combinations].ravel(), window_positions.ravel(),
+                                                             np.arange(combinations.size).reshape(combinations.shape),
+                                                             False)
+
+        # keep the first fingerprint of every hashvalue in each window
+        _, first_occurrences = np.unique(windows.astype(np.uint64) << np.uint64(32) |
+                                         fingerprints["hash"].astype(np.uint64), return_index=True)
+        first_occurrences.sort()
+        fingerprints, windows = fingerprints[first_occurrences], windows[first_occurrences]
+
+        window_ends = np.searchsorted(windows, np.arange(1, len(split_ranges)))
+        for split_idx, window_fingerprints, window_created in zip(split_starts.tolist(),
+                                                                  np.split(fingerprints, window_ends), created):
+            yield split_idx, window_fingerprints, window_created
+
+    def _has_borderline_distances(self, positions):
+        """
+        Checks, if the distance of two positions is within some floating point steps of d
+        :param positions: positions of the midi eventlist
+        :return: True if there are such positions
+        """
+        if self.d <= 0 or positions.shape[0] == 0:
+            return False
+
+        tolerance = 8 * np.spacing(max(float(np.max(np.abs(positions))), float(self.d)))
+        sorted_positions = np.sort(np.asarray(positions, dtype=np.float64))
+        lower = np.searchsorted(sorted_positions, sorted_positions + (self.d - tolerance))
+        upper = np.searchsorted(sorted_positions, sorted_positions + (self.d + tolerance), side="right")
+        return bool(np.any(upper > lower))
+
+    def _select_next_events(self, pitches, positions):
+        """
+        Select for every note the first following event, which is self.d later positionwise
+        and whose pitch-value differs at most self.pitch_diff. The events following it are selected
+        together with it as fingerprint events.
+        :param pitches: pitches of the midi eventlist
+        :param positions: positions of the midi eventlist
+        :return: array with the index of the first selectable event for every note, -1 if there is none
+        """
+        n_of_notes = positions.shape[0]
+        successors = np.full(n_of_notes, -1, dtype=np.int64)
+
+        # step all notes, whose successor is not found yet, one event further
+        notes = np.arange(n_of_notes)
+        candidates = notes + 1
+        while notes.shape[0] > 0:
+            in_range = candidates < n_of_notes
+            notes, candidates = notes[in_range], candidates[in_range]
+
+            found = ((np.abs(positions[candidates] - positions[notes]) >= self.d) &
+                     (np.abs(pitches[candidates] - pitches[notes]) <= self.pitch_diff))
+            successors[notes[found]] = candidates[found]
+
+            notes, candidates = notes[~found], candidates[~found] + 1
+
+        return successors
 
     def get_algorithm_name(self):
         return "FingerPrinting"
@@ -385,74 +899,72 @@ class FingerPrinting(AbstractMatchClass):
         (name, (score, percent_score), (start_of_best_match, end_of_best_match)) of the best matching database item.
         get_top_x determines the size of the results, if evaluate = False
         query_name: optional give a name to the query, if query is no MidiFile-Object
+        If RESULT_CACHE_SIZE is set, the results of queries with the same notes are cached until the index changes.
         """
+        if self._result_cache is None:
+            return self._search(query, query_name, evaluate, get_top_x)
 
         if isinstance(query, MidiFile):
-            query_name = query.name
-            query_notes = query.get_notes_for_fingerprints()
-        else:
-            query_notes = query
+            query = query.get_notes_for_fingerprints()
 
-        dict_result = dict()
-        created_fingerprints = 0
+        key = self._get_result_cache_key(query, evaluate, get_top_x)
+        results = self._result_cache.get(key)
+        if results is None:
+            results = self._search(query, query_name, evaluate, get_top_x)
+            self._result_cache.put(key, results)
+        return results
 
-        # create splitable windows, if split_queries_longer_than is none or < 0, don't split
-        no_split = self.split_queries_longer_than is None or self.split_queries_longer_than < 0 or self.split_query_length >= query_notes.shape[0]
-        if no_split:
-            split_indexes = (0, )
-        else:
-            split_indexes = range(0, query_notes.shape[0] - self.split_query_length + 1, self.split_queries_sliding_window)
+    def _search(self, query, query_name="", evaluate=False, get_top_x=1):
+        """
+        Searches a query without the result cache, see search
+        """
+        matchdict, created_fingerprints = next(self._match_queries([query]))
 
-        matchdict = dict()
+        return self._get_results(matchdict, created_fingerprints, evaluate, get_top_x, query_name)
 
-        for idx, split_idx in enumerate(split_indexes):
-            if no_split or split_idx + self.split_query_length > query_notes.shape[0] - self.split_queries_sliding_window:
-                split_end = query_notes.shape[0]
-            else:
-                split_end = split_idx + self.split_query_length
+    def _get_result_cache_key(self, query_notes, evaluate, get_top_x):
+        """
+        Returns the key of a search in the result cache. It consists of a hash of the query notes, the version of
+        the index and all settings, which change the results.
+        :param query_notes: notes of the query
+        :param evaluate: see search
+        :param get_top_x: see search
+        :return: tuple
+        """
+        query_notes = np.ascontiguousarray(query_notes, dtype=np.float64)
+        notes_hash = hashlib.sha1(str(query_notes.shape).encode() + query_notes.tobytes()).hexdigest()
+        return (notes_hash, self._index_version, bool(evaluate), get_top_x, self.split_queries_longer_than,
+                self.split_query_length, self.split_queries_sliding_window)
 
-            # perform a query for every split and save all results in matchdict,
-            split_query = query_notes[split_idx:split_end].copy()
-            # adopt the starting position for all split queries, so they start from 0 time
-            split_query[:, 1] = split_query[:, 1] - split_query[0, 1]
-
-            fp, histograms, created, _ = self.perform_query(split_query, query_name)
-
-            # count total amount of created fingerprints
-            created_fingerprints += created
-
-            # check every FingerPrintList from the performed query
-            for hist in histograms:
-                # create a list for every histogram in the result dictionary
-                top_bins = matchdict.get(hist.db_name, None)
-                if top_bins is None:
-                    top_bins = []
-                    matchdict[hist.db_name] = top_bins
-
-                # Add for the top bins in each histogram an entry in the list
-                # All bins above 1.25*bin_avg are added
-                for bin_pos, score in hist.get_top_bins(filter_factor=1.25):
-                    qfp = hist.query_fps_in_bins[bin_pos].start
-                    mfp = hist.fps_in_bins[bin_pos].start
-
-                    # Calculate a time ratio between the first matched query and database fingerprint
-                    # to scale the query position for the final evaluation
-                    r = float(mfp.td12) / float(qfp.td12)
-                    y_pos = (qfp.pos1 + query_notes[split_idx, 1]) * r
-                    x_pos = mfp.pos1
-                    top_bins.append((x_pos, y_pos, score, hist.fps_in_bins[bin_pos]))
+    def search_many(self, queries, query_names=None, evaluate=False, get_top_x=1):
+        """
+        Searches several queries, the results equal [search(query, ...) for query in queries]. The fingerprints of
+        SEARCH_BATCH_SIZE queries are looked up together, so the postings of a bucket are only gathered once for all
+        of them.
+        :param queries: list of MidiFiles or notes of the queries
+        :param query_names: optional names of the queries
+        :param evaluate: see search
+        :param get_top_x: see search
+        :return: list of search results
+        """
+        if query_names is None:
+            query_names = [""] * len(queries)
 
-        results = []
-        # Find for every database item a diagonal and calculate the maximum score (e.g. cluster
-        # with highest score
-        for name in matchdict:
-            data = matchdict[name]
-            clusters = self.find_diagonals(data)
-            top_cluster = max(clusters, key=lambda cluster: cluster.score, default=self.Cluster())
-            results.append((name, top_cluster, clusters))
+        return [self._get_results(matchdict, created_fingerprints, evaluate, get_top_x, query_name)
+                for (matchdict, created_fingerprints), query_name in zip(self._match_queries(queries), query_names)]
 
-        # sort after score, including partially used neighbors
-        results = sorted(results, key=lambda itm: itm[1].score, reverse=True)
+    def _get_results(self, matchdict, created_fingerprints, evaluate, get_top_x, query_name=""):
+        """
+        Clusters the matched files of a query and creates the results of search
+        :param matchdict: dictionary of file name to list of datapoints
+        :param created_fingerprints: number of fingerprints created for the query
+        :return: see search
+        """
+        if evaluate or get_top_x is None:
+            # sort after score, including partially used neighbors
+            results = sorted(self.cluster_matches(matchdict), key=lambda itm: itm[1].score, reverse=True)
+        else:
+            results = self.cluster_top_matches(matchdict, get_top_x)
 
         ####################################################
         # UNCOMMENT to view some clusters of the top results as plots
@@ -469,9 +981,565 @@ class FingerPrinting(AbstractMatchClass):
         #     plot_(query_name, res[0], res[2], res[1])
         ####################################################
 
+        return self._format_results(results, created_fingerprints, evaluate, get_top_x)
+
+    def search_rank(self, query, query_name=""):
+        """
+        Returns only the result of the file the query was taken from, like search(query, evaluate=True)[query_name].
+        Files are only clustered, if they can be ranked before this file.
+        :param query: MidiFile or notes of the query
+        :param query_name: name of the file the query was taken from, if query is no MidiFile-Object
+        :return: ((score, percent_score), rank, (start_of_best_match, end_of_best_match)) or None, if the file was not
+                 matched
+        """
+        return next(self.search_ranks([query], [query_name]))
+
+    def search_ranks(self, queries, query_names=None):
+        """
+        Returns the result of search_rank for every query, the queries are looked up together like in search_many
+        :param queries: list of MidiFiles or notes of the queries
+        :param query_names: names of the files the queries were taken from, if the queries are no MidiFile-Objects
+        :return: generator of the search_rank results
+        """
+        if query_names is None:
+            query_names = [""] * len(queries)
+
+        for query, query_name, (matchdict, created_fingerprints) in zip(queries, query_names,
+                                                                        self._match_queries(queries)):
+            if isinstance(query, MidiFile):
+                query_name = query.name
+            yield self._rank_target(matchdict, created_fingerprints, query_name)
+
+    def _rank_target(self, matchdict, created_fingerprints, target_name):
+        """
+        Calculates the result of a single file, files are only clustered, if they can be ranked before it
+        :param matchdict: dictionary of file name to list of datapoints
+        :param created_fingerprints: number of fingerprints created for the query
+        :param target_name: name of the file
+        :return: see search_rank
+        """
+        if target_name not in matchdict:
+            return None
+
+        names = list(matchdict)
+        target_order = names.index(target_name)
+        target = self.cluster_matches({target_name: matchdict[target_name]})[0][1]
+
+        # files with the same score are ranked in the order they were matched
+        rank = 1
+        for order, name in enumerate(names):
+            if order == target_order:
+                continue
+
+            bound = self._get_score_bound(matchdict[name])
+            if bound < target.score or (bound == target.score and order > target_order):
+                continue
+
+            score = self.cluster_matches({name: matchdict[name]})[0][1].score
+            if score > target.score or (score == target.score and order < target_order):
+                rank += 1
+
+        return target.get_score(created_fingerprints), rank, target.get_pos()
+
+    def _match_queries(self, queries):
+        """
+        Matches all windows of the queries against the index, SEARCH_BATCH_SIZE queries are looked up together
+        :param queries: list of MidiFiles or notes of the queries
+        :return: generator of (dictionary of file name to list of datapoints, number of created fingerprints)
+                 for every query
+        """
+        batch = []
+        for query in queries:
+            if isinstance(query, MidiFile):
+                batch.append(query.get_notes_for_fingerprints())
+            else:
+                batch.append(query)
+
+            if len(batch) == self.SEARCH_BATCH_SIZE:
+                yield from self._match_batch(batch)
+                batch = []
+
+        if len(batch) > 0:
+            yield from self._match_batch(batch)
+
+    def _match_batch(self, batch):
+        """
+        Matches the windows of several queries. The note combinations of a query are enumerated once for all of its
+        windows (create_window_fingerprints). The closest buckets of the fingerprints of all windows are searched
+        at once and the postings of every bucket are gathered once, they are scattered to the windows afterwards.
+        The histograms of every window equal the ones of perform_query.
+        :param batch: list of query notes
+        :return: list of (dictionary of file name to list of datapoints, number of created fingerprints)
+        """
+        window_queries = []
+        split_offsets = []
+        window_fingerprints = []
+        created_fingerprints = [0] * len(batch)
+        for query_nr, query_notes in enumerate(batch):
+            for split_idx, fingerprints, created in self.create_window_fingerprints(query_notes):
+                created_fingerprints[query_nr] += created
+                window_queries.append(query_nr)
+                split_offsets.append(query_notes[split_idx, 1])
+                window_fingerprints.append(fingerprints)
+
+        matchdicts = self._match_windows(window_fingerprints, window_queries, split_offsets, len(batch))
+        return list(zip(matchdicts, created_fingerprints))
+
+    def _match_windows(self, window_fingerprints, window_queries, split_offsets, n_of_queries):
+        """
+        Matches query windows against the index and collects the datapoints of every query
+        :param window_fingerprints: list with the fingerprints of every window
+        :param window_queries: list with the number of the query of every window, ascending
+        :param split_offsets: list with the position of the first note of every window in its query
+        :param n_of_queries: number of queries
+        :return: list with a dictionary of file name to list of datapoints for every query
+        """
+        index = self._fingerprints
+
+        if len(window_fingerprints) == 0:
+            return [dict() for _ in range(n_of_queries)]
+
+        window_queries = np.array(window_queries, dtype=np.int64)
+        split_offsets = np.array(split_offsets, dtype=np.float64)
+        fingerprint_windows = np.repeat(np.arange(window_queries.shape[0]),
+                                        [fingerprints.shape[0] for fingerprints in window_fingerprints])
+        fingerprints = np.concatenate(window_fingerprints)
+
+        # search the buckets of all fingerprints and gather the postings of every bucket once
+        query_idx, buckets = self.find_query_buckets(fingerprints)
+        unique_buckets, bucket_nr = np.unique(buckets, return_inverse=True)
+        bucket_idx, doc_ids, pos1, td12, max_pos = index.get_bucket_postings(unique_buckets)
+        bucket_lengths = np.bincount(bucket_idx, minlength=unique_buckets.shape[0])
+        bucket_starts = np.cumsum(bucket_lengths) - bucket_lengths
+
+        # the pairs of a group of windows are scored together, the windows are told apart by window keys, which
+        # combine the window and the document id
+        n_of_names = max(len(index.names), 1)
+        matched_windows = fingerprint_windows[query_idx]
+        pairs_per_window = np.bincount(matched_windows, weights=bucket_lengths[bucket_nr],
+                                       minlength=window_queries.shape[0])
+
+        def score_windows(window_range):
+            matched = slice(*np.searchsorted(matched_windows, window_range))
+            pair_idx, pairs = FingerPrintIndex.expand_ranges(bucket_starts[bucket_nr[matched]],
+                                                             bucket_lengths[bucket_nr[matched]])
+            pair_query_idx = query_idx[matched][pair_idx]
+
+            window_keys = fingerprint_windows[pair_query_idx] * n_of_names + doc_ids[pairs]
+            return self.MatchHistograms(window_keys, pos1[pairs], td12[pairs], fingerprints["pos1"][pair_query_idx],
+                                        fingerprints["td12"][pair_query_idx], max_pos[pairs])
+
+        # the groups are scored by the search workers, the top bins are added in the order of the windows, so the
+        # datapoints do not depend on the number of workers
+        matchdicts = [dict() for _ in range(n_of_queries)]
+        for histograms in self._map_search_workers(score_windows, self._group_windows(pairs_per_window)):
+            self._add_window_top_bins(matchdicts, histograms, n_of_names, window_queries, split_offsets)
+
+        return matchdicts
+
+    def _group_windows(self, pairs_per_window):
+        """
+        Groups consecutive windows, whose pairs are scored together. A group holds at most SEARCH_GROUP_PAIRS pairs
+        or a single window, with several search workers the pairs are spread over at least as many groups as there
+        are workers.
+        :param pairs_per_window: array with the number of matched pairs of every window
+        :return: list of (first window, window after the last window) of every group
+        """
+        workers = self.search_workers or os.cpu_count() or 1
+        max_pairs = min(self.SEARCH_GROUP_PAIRS, max(math.ceil(pairs_per_window.sum() / workers), 1))
+
+        groups = []
+        first = 0
+        while first < pairs_per_window.shape[0]:
+            last = first + 1
+            group_pairs = pairs_per_window[first]
+            while last < pairs_per_window.shape[0] and group_pairs + pairs_per_window[last] <= max_pairs:
+                group_pairs += pairs_per_window[last]
+                last += 1
+            groups.append((first, last))
+            first = last
+
+        return groups
+
+    def _map_search_workers(self, function, items):
+        """
+        Applies a function to all items, with several search workers the items are processed by a thread pool, which
+        shares the index
+        :param function: function of one item
+        :param items: list of items
+        :return: iterator of the results in the order of the items
+        """
+        workers = self.search_workers or os.cpu_count() or 1
+        if workers <= 1 or len(items) <= 1:
+            return map(function, items)
+
+        if self._search_pool is None or self._search_pool_size != workers:
+            if self._search_pool is not None:
+                self._search_pool.shutdown()
+            self._search_pool = concurrent.futures.ThreadPoolExecutor(workers)
+            self._search_pool_size = workers
+        return self._search_pool.map(function, items)
+
+    def _split_query(self, query_notes):
+        """
+        Splits a long query into overlapping windows, if split_queries_longer_than is none or < 0, the query is not
+        split
+        :param query_notes: notes of the query
+        :return: generator of (index of the first note, notes of the window), the positions of every window
+                 start from 0 time
+        """
+        for split_idx, split_end in self._get_split_ranges(query_notes.shape[0]):
+            yield split_idx, self._get_split_notes(query_notes, split_idx, split_end)
+
+    @staticmethod
+    def _get_split_notes(query_notes, split_idx, split_end):
+        """
+        Returns the notes of a query window
+        :param query_notes: notes of the query
+        :param split_idx: index of the first note of the window
+        :param split_end: index after the last note of the window
+        :return: copy of the notes of the window, whose positions start from 0 time
+        """
+        split_query = query_notes[split_idx:split_end].copy()
+        # adopt the starting position for all split queries, so they start from 0 time
+        split_query[:, 1] = split_query[:, 1] - split_query[0, 1]
+
+        return split_query
+
+    def _get_split_ranges(self, n_of_notes):
+        """
+        Returns the note ranges of the windows of a query
+        :param n_of_notes: number of notes of the query
+        :return: generator of (index of the first note, index after the last note) of every window
+        """
+        no_split = self.split_queries_longer_than is None or self.split_queries_longer_than < 0 or self.split_query_length >= n_of_notes
+        if no_split:
+            split_indexes = (0, )
+        else:
+            split_indexes = range(0, n_of_notes - self.split_query_length + 1, self.split_queries_sliding_window)
+
+        for split_idx in split_indexes:
+            if no_split or split_idx + self.split_query_length > n_of_notes - self.split_queries_sliding_window:
+                split_end = n_of_notes
+            else:
+                split_end = split_idx + self.split_query_length
+
+            yield split_idx, split_end
+
+    def _is_final_split_range(self, split_idx, n_of_notes):
+        """
+        Checks, if a window of a query keeps its notes, when further notes are appended to the query
+        :param split_idx: index of the first note of the window
+        :param n_of_notes: number of notes of the query
+        :return: True if the window ends after split_query_length notes for all longer queries
+        """
+        if self.split_queries_longer_than is None or self.split_queries_longer_than < 0:
+            return False
+        return split_idx + self.split_query_length <= n_of_notes - self.split_queries_sliding_window
+
+    def create_query_session(self, query_name="", get_top_x=1):
+        """
+        Creates a QuerySession, which searches a query, whose notes arrive in chunks
+        :param query_name: optional name of the query
+        :param get_top_x: number of results after every chunk
+        :return: QuerySession
+        """
+        return self.QuerySession(self, query_name, get_top_x)
+
+    class QuerySession(object):
+        """
+        Incremental search of a query, whose notes arrive in chunks, e.g. while it is recorded.
+        The windows of the query (see _split_query), which can not change anymore, are matched once and the
+        datapoints of their top bins are kept for all following chunks. Only the windows at the end of the query,
+        which still grow with the next notes, are matched again after every chunk, so the matching cost of a chunk
+        does not grow with the length of the query.
+        The diagonals of the kept datapoints are kept for every file as well. A chunk only clusters the files again,
+        which got datapoints of the chunk, and new datapoints behind the ones of a file are added to its diagonals.
+        The results equal search(all notes so far, evaluate=False, get_top_x=get_top_x).
+        """
+
+        class FileDiagonals(object):
+            """
+            Datapoints of a file from the windows, which can not change anymore, and their diagonals
+            """
+
+            def __init__(self):
+                # datapoints sorted by x like find_diagonals sorts them
+                self.data = []
+                self.bound = 0
+                # diagonals of data, None until the file is ranked
+                self.clusters = None
+                self.points = None
+                self.top_cluster = None
+
+            def add(self, fingerprinting, data):
+                """
+                Adds datapoints of a chunk, they are added to the diagonals, if they do not lie before the datapoints
+                so far, otherwise the diagonals are found again, when the file is ranked the next time
+                :param fingerprinting: FingerPrinting of the session
+                :param data: list of datapoints in the order they were matched
+                :return: None
+                """
+                if len(data) == 0:
+                    return
+
+                self.bound += fingerprinting._get_score_bound(data)
+                data = sorted(data, key=lambda d: d[0])
+                if len(self.data) > 0 and data[0][0] < self.data[-1][0]:
+                    # the kept datapoints come first in find_diagonals, if they have the same x
+                    self.data = sorted(self.data + data, key=lambda d: d[0])
+                    self.clusters = None
+                else:
+                    self.data.extend(data)
+                    if self.clusters is not None:
+                        fingerprinting.extend_diagonals(self.clusters, self.points, data)
+                self.top_cluster = None
+
+            def get_top_cluster(self, fingerprinting):
+                """
+                :param fingerprinting: FingerPrinting of the session
+                :return: top cluster and all clusters of the datapoints
+                """
+                if self.clusters is None:
+                    self.clusters = []
+                    self.points = fingerprinting.ClusterPoints()
+                    fingerprinting.extend_diagonals(self.clusters, self.points, self.data)
+                if self.top_cluster is None:
+                    self.top_cluster = max(self.clusters, key=lambda c: c.score, default=fingerprinting.Cluster())
+                return self.top_cluster, self.clusters
+
+        def __init__(self, fingerprinting, query_name="", get_top_x=1):
+            """
+            Initialize function
+            :param fingerprinting: FingerPrinting, whose index is searched
+            :param query_name: optional name of the query
+            :param get_top_x: number of results after every chunk
+            """
+            self.fingerprinting = fingerprinting
+            self.query_name = query_name
+            self.get_top_x = get_top_x
+
+            self.notes = None
+            self.results = []
+
+            # FileDiagonals and created fingerprints of the windows, which can not change anymore
+            self._files = dict()
+            self._created_fingerprints = 0
+            self._n_of_final_windows = 0
+            # datapoints and created fingerprints of the windows, which still grow
+            self._growing_matchdict = dict()
+            self._growing_fingerprints = 0
+
+        def add_notes(self, notes, update_results=True):
+            """
+            Appends notes to the query and searches the changed windows
+            :param notes: MidiFile or array of (pitch, position) rows, the positions are relative to the start of the
+                          query and do not lie before the ones of the previous chunks
+            :param update_results: rank the files after this chunk, if False, the results are only updated with a
+                                   later chunk or get_results, e.g. if further chunks are already waiting
+            :return: the results of the query so far, see search with evaluate=False
+            """
+            fingerprinting = self.fingerprinting
+
+            if isinstance(notes, MidiFile):
+                notes = notes.get_notes_for_fingerprints()
+            self.notes = np.array(notes) if self.notes is None else np.concatenate((self.notes, notes))
+            n_of_notes = self.notes.shape[0]
+
+            split_ranges = list(fingerprinting._get_split_ranges(n_of_notes)) if n_of_notes > 0 else []
+            n_of_final_windows = sum(1 for split_idx, _ in split_ranges
+                                     if fingerprinting._is_final_split_range(split_idx, n_of_notes))
+
+            # the new final windows are matched as first query, the growing windows as second one
+            window_queries = []
+            split_offsets = []
+            window_fingerprints = []
+            created_fingerprints = [0, 0]
+            for window_nr in range(self._n_of_final_windows, len(split_ranges)):
+                split_idx, split_end = split_ranges[window_nr]
+                query_nr = 0 if window_nr < n_of_final_windows else 1
+                fingerprints, created = fingerprinting.create_fingerprints(
+                    fingerprinting._get_split_notes(self.notes, split_idx, split_end), "", remove_doubles=True)
+                created_fingerprints[query_nr] += created
+                window_queries.append(query_nr)
+                split_offsets.append(self.notes[split_idx, 1])
+                window_fingerprints.append(fingerprints)
+
+            final_matches, self._growing_matchdict = fingerprinting._match_windows(window_fingerprints,
+                                                                                   window_queries, split_offsets, 2)
+            for name, data in final_matches.items():
+                if name not in self._files:
+                    self._files[name] = self.FileDiagonals()
+                self._files[name].add(fingerprinting, data)
+            self._created_fingerprints += created_fingerprints[0]
+            self._growing_fingerprints = created_fingerprints[1]
+            self._n_of_final_windows = n_of_final_windows
+
+            if update_results:
+                return self.get_results()
+            return self.results
+
+        def get_results(self):
+            """
+            Ranks the files with the datapoints of all windows of the query so far, the kept diagonals are used for
+            files, which have no datapoints of the growing windows
+            :return: see search with evaluate=False
+            """
+            fingerprinting = self.fingerprinting
+            files = self._files
+            growing = self._growing_matchdict
+
+            # the files are ordered like search matches them, the growing windows are matched last
+            names = list(files) + [name for name in growing if name not in files]
+            bounds = [(files[name].bound if name in files else 0) +
+                      (fingerprinting._get_score_bound(growing[name]) if name in growing else 0) for name in names]
+
+            def cluster(name):
+                if name in files and len(growing.get(name, [])) == 0:
+                    return files[name].get_top_cluster(fingerprinting)
+                data = (files[name].data if name in files else []) + growing.get(name, [])
+                clusters = fingerprinting.find_diagonals(data)
+                return max(clusters, key=lambda c: c.score, default=fingerprinting.Cluster()), clusters
+
+            get_top_x = self.get_top_x if self.get_top_x is not None else len(names)
+            results = fingerprinting._select_top_matches(names, bounds, cluster, get_top_x)
+            self.results = fingerprinting._format_results(results,
+                                                          self._created_fingerprints + self._growing_fingerprints,
+                                                          False, self.get_top_x)
+            return self.results
+
+    def add_top_bins(self, matchdict, histograms, split_offset):
+        """
+        Adds the top bins of the histograms of a query window as datapoints to the lists of their files
+        :param matchdict: dictionary of file name to list of datapoints, a list is created for every matched file
+        :param histograms: MatchHistograms of the query window
+        :param split_offset: position of the first note of the query window in the query
+        :return: None
+        """
+        self._add_window_top_bins([matchdict], histograms, max(len(self._fingerprints.names), 1),
+                                  np.zeros(1, dtype=np.int64), np.array([split_offset], dtype=np.float64))
+
+    def _add_window_top_bins(self, matchdicts, histograms, n_of_names, window_queries, split_offsets):
+        """
+        Adds the top bins of histograms of several query windows as datapoints to the lists of their files
+        :param matchdicts: dictionary of file name to list of datapoints for every query
+        :param histograms: MatchHistograms, which are calculated with the window keys window * n_of_names + doc_id
+                           instead of the document ids
+        :param n_of_names: number of document names of the index
+        :param window_queries: array with the number of the query of every window
+        :param split_offsets: array with the position of the first note of every window in its query
+        :return: None
+        """
+        names = self._fingerprints.names
+
+        # create a list for every matched file in the result dictionary
+        windows, doc_ids = np.divmod(histograms.get_doc_ids(), n_of_names)
+        for query_nr, doc_id in zip(window_queries[windows].tolist(), doc_ids.tolist()):
+            matchdicts[query_nr].setdefault(names[doc_id], [])
+
+        # Add for the top bins in each histogram an entry in the list
+        # All bins above 1.25*bin_avg are added
+        top_bins = histograms.get_top_bins(filter_factor=1.25)
+        windows, doc_ids = np.divmod(histograms.doc_ids[top_bins], n_of_names)
+
+        # Calculate a time ratio between the first matched query and database fingerprint
+        # to scale the query position for the final evaluation
+        r = histograms.db_td12[top_bins] / histograms.q_td12[top_bins]
+        y_pos = (histograms.q_pos1[top_bins] + split_offsets[windows]) * r
+        x_pos = histograms.db_pos1[top_bins]
+
+        for query_nr, doc_id, x, y, score, start, end in zip(window_queries[windows].tolist(), doc_ids.tolist(),
+                                                             x_pos.tolist(), y_pos.tolist(),
+                                                             histograms.scores[top_bins].tolist(),
+                                                             histograms.db_pos1[top_bins].tolist(),
+                                                             histograms.end[top_bins].tolist()):
+            matchdicts[query_nr][names[doc_id]].append((x, y, score, start, end))
+
+    def cluster_matches(self, matchdict):
+        """
+        Find for every database item a diagonal and calculate the maximum score (e.g. cluster
+        with highest score
+        :param matchdict: dictionary of file name to list of datapoints
+        :return: list of (name, top cluster, all clusters) in the order of matchdict
+        """
+        results = []
+        for name in matchdict:
+            data = matchdict[name]
+            clusters = self.find_diagonals(data)
+            top_cluster = max(clusters, key=lambda cluster: cluster.score, default=self.Cluster())
+            results.append((name, top_cluster, clusters))
+        return results
+
+    def cluster_top_matches(self, matchdict, get_top_x):
+        """
+        Returns the get_top_x files with the highest cluster scores. The files are visited descending by the sum of
+        their datapoint scores, which no cluster can exceed, and files, which can not reach the top results anymore,
+        are not clustered.
+        :param matchdict: dictionary of file name to list of datapoints
+        :param get_top_x: number of results
+        :return: list of (name, top cluster, all clusters), sorted like search sorts all files
+        """
+        bounds = [self._get_score_bound(data) for data in matchdict.values()]
+
+        def cluster(name):
+            clusters = self.find_diagonals(matchdict[name])
+            return max(clusters, key=lambda c: c.score, default=self.Cluster()), clusters
+
+        return self._select_top_matches(list(matchdict), bounds, cluster, get_top_x)
+
+    @staticmethod
+    def _select_top_matches(names, bounds, cluster, get_top_x):
+        """
+        Returns the get_top_x files with the highest cluster scores, see cluster_top_matches
+        :param names: names of the matched files in the order they were matched
+        :param bounds: highest score a cluster of every file can have
+        :param cluster: function, which returns (top cluster, all clusters) of a file name
+        :param get_top_x: number of results
+        :return: list of (name, top cluster, all clusters), sorted like search sorts all files
+        """
+        if get_top_x <= 0:
+            return []
+
+        candidates = sorted(zip(bounds, range(len(bounds)), names), key=lambda c: (-c[0], c[1]))
+
+        # min-heap of the best files, files with the same score are ranked in the order they were matched
+        heap = []
+        for bound, order, name in candidates:
+            if len(heap) == get_top_x:
+                if bound < heap[0][0]:
+                    break
+                if (bound, -order) < heap[0][:2]:
+                    continue
+
+            top_cluster, clusters = cluster(name)
+            entry = (top_cluster.score, -order, name, top_cluster, clusters)
+
+            if len(heap) < get_top_x:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+
+        return [entry[2:] for entry in sorted(heap, key=lambda e: (-e[0], -e[1]))]
+
+    @staticmethod
+    def _get_score_bound(data):
+        """ Returns the highest score a cluster of the datapoints can have"""
+        return sum(datapoint[2] for datapoint in data)
+
+    @staticmethod
+    def _format_results(results, created_fingerprints, evaluate, get_top_x):
+        """
+        Creates the return value of search
+        :param results: list of (name, top cluster, ...) sorted by rank
+        :param created_fingerprints: number of fingerprints created for the query
+        :param evaluate: return the dictionary of all files instead of the top results
+        :param get_top_x: number of top results
+        :return: see search
+        """
         if evaluate:
-            for i, (name, match, _) in enumerate(results, 1):
-                dict_result[name] = (match.get_score(created_fingerprints), i, match.get_pos())
+            dict_result = dict()
+            for i, result in enumerate(results, 1):
+                dict_result[result[0]] = (result[1].get_score(created_fingerprints), i, result[1].get_pos())
             return dict_result
         else:
             ranked_result = []
@@ -479,15 +1547,18 @@ class FingerPrinting(AbstractMatchClass):
                 ranked_result.append((result[0], result[1].get_score(created_fingerprints), result[1].get_pos()))
             return ranked_result
 
+    def get_index(self):
+        """
+        Returns the FingerPrintIndex holding all database fingerprints
+        """
+        return self._fingerprints
+
     def get_hash_value_lengths(self):
         """
         Returns a numpy array that contains the amount of hash collisions for every hash stored.
         :return: np.array
         """
-        lens = np.zeros(len(self._fingerprints))
-        for idx, key in enumerate(self._fingerprints):
-            lens[idx] = len(self._fingerprints[key])
-        return lens
+        return self._fingerprints.get_bucket_lengths()
 
     def perform_query(self, query_notes, query_name):
         """
@@ -495,31 +1566,64 @@ class FingerPrinting(AbstractMatchClass):
         and then, for each fingerprint ask for a dictionary entry.
         :param query_notes:
         :param query_name:
-        :return: the created fingerprints, a list of matched fingerprints and the "true" match for analysis
-        """
-        query_fingerprints, created = self.create_fingerprints(query_notes, query_name, remove_doubles=True)
-        matched_queries = dict()
-        for fp in query_fingerprints:
-            for hash_val in fp.get_hash_iterator():
-                matched_fingerprint_list = self._fingerprints.get(hash_val, None)
-                if matched_fingerprint_list is not None:
-                    if self.quantile is None or len(matched_fingerprint_list) < self.quantile:
-                        for mfp in matched_fingerprint_list:  # query all files with this fingerprint
-                            matches = matched_queries.get(mfp.name, None)
-                            # create a new fingerprintlist, if there is a fingerprint from a new file
-                            if matches is None:
-                                matches = self.FingerPrintList(mfp.name, query_fingerprints,
-                                                               query_notes, query_name,
-                                                               ignore_doubles=self.split_queries_longer_than is not None
-                                                                              and self.split_queries_longer_than > 0)
-                                matched_queries[mfp.name] = matches
-
-                            matches.append((mfp, fp))
-                    break
+        :return: the created fingerprints, the MatchHistograms of all matched files, the number of created
+                 fingerprints and the document id of the "true" match for analysis (None if it was not matched)
+        """
+        fingerprints, created = self.create_fingerprints(query_notes, query_name, remove_doubles=True)
+        index = self._fingerprints
+
+        query_idx, buckets = self.find_query_buckets(fingerprints)
+        histograms, _ = self.match_buckets(fingerprints, query_idx, buckets)
+
+        should_match = index.find_doc_id(query_name)
+        if should_match is not None and should_match not in histograms.get_doc_ids():
+            should_match = None
+
+        return fingerprints, histograms, created, should_match
 
-        should_match = matched_queries.get(query_name, None)
+    def find_query_buckets(self, fingerprints):
+        """
+        Search for every fingerprint the closest stored hash within the tdr-range, smaller tempo errors
+        are preferred, this assumes, that they are more frequent than larger ones. Buckets longer than the
+        quantile are ignored. Every hash value is searched once, even if several fingerprints share it.
+        If EXPAND_TDR_INDEX is set, the chosen buckets are looked up exactly in the expanded keys of the index.
+        :param fingerprints: structured array of query fingerprints
+        :return: (indexes of the matched fingerprints, their bucket numbers)
+        """
+        index = self._fingerprints
+
+        hashes, hash_nr = np.unique(fingerprints["hash"], return_inverse=True)
+        if self.expand_tdr_index:
+            if index.expanded_hashes is None:
+                self._expand_tdr_keys()
+            buckets = index.find_expanded_buckets(hashes)[hash_nr.ravel()]
+        else:
+            lower, upper = self.fingerprint.get_hash_ranges(hashes)
+            buckets = index.find_nearest_buckets(hashes, lower, upper)[hash_nr.ravel()]
+
+        matched = buckets >= 0
+        if self.quantile is not None:
+            matched[matched] = index.get_bucket_lengths()[buckets[matched]] < self.quantile
+        query_idx = np.flatnonzero(matched)
 
-        return query_fingerprints, list(matched_queries.values()), created, should_match
+        return query_idx, buckets[query_idx]
+
+    def match_buckets(self, fingerprints, query_idx, buckets):
+        """
+        Query all files with the postings of the buckets and score every matched pair
+        :param fingerprints: structured array of query fingerprints
+        :param query_idx: indexes of the matched fingerprints
+        :param buckets: bucket number for every matched fingerprint
+        :return: (MatchHistograms of all matched files, index of the query fingerprint of every pair)
+        """
+        index = self._fingerprints
+
+        bucket_idx, doc_ids, pos1, td12, max_pos = index.get_bucket_postings(buckets)
+        query_idx = query_idx[bucket_idx]
+        histograms = self.MatchHistograms(doc_ids, pos1, td12, fingerprints["pos1"][query_idx],
+                                          fingerprints["td12"][query_idx], max_pos)
+
+        return histograms, query_idx
 
     class Cluster(list):
         """
@@ -535,7 +1639,7 @@ class FingerPrinting(AbstractMatchClass):
             """
             Append new datapoint to the list, tracks additionally the start and end position of
             the fingerprints.
-            :param datapoint:
+            :param datapoint: (x, y, score, start position, end position) of a top bin
             :return:
             """
             super().append(datapoint[0:2])
@@ -544,10 +1648,10 @@ class FingerPrinting(AbstractMatchClass):
             self.score += datapoint[2]
 
             # Update start and end positions.
-            if self.start > datapoint[3].start.pos1:
-                self.start = datapoint[3].start.pos1
-            if self.end < datapoint[3].end.max_pos:
-                self.end = datapoint[3].end.max_pos
+            if self.start > datapoint[3]:
+                self.start = datapoint[3]
+            if self.end < datapoint[4]:
+                self.end = datapoint[4]
 
         def calc_distance(self, other):
             """
@@ -600,14 +1704,25 @@ class FingerPrinting(AbstractMatchClass):
         Finally, for all clusters the one with the highest score (e.g. most fingerprints in it, is chosen"""
         data.sort(key=lambda d: d[0])
         clusters = []
-        for x, y, score, fps in data:
-            lowest_distance, closest_cluster, closest_point = self.get_closest_cluster(clusters, x, y)
+        self.extend_diagonals(clusters, self.ClusterPoints(), data)
+        return clusters
+
+    def extend_diagonals(self, clusters, points, data):
+        """
+        Adds datapoints to the diagonals found by find_diagonals so far, the result equals find_diagonals of all
+        datapoints, if the new datapoints do not lie before the added ones
+        :param clusters: list of the clusters so far, new clusters are appended
+        :param points: ClusterPoints of the clusters
+        :param data: list of datapoints sorted by x, x is at least the x of all points
+        :return: None
+        """
+        for x, y, score, start, end in data:
+            lowest_distance, cluster_nr, closest_point = points.find_closest(x, y)
             # If no matching cluster for this datapoint is found, create a new one
             # but allow if datapoint is exactly on the same position as another point (e.g. distance=0)
-            if closest_cluster is None or ((closest_point[0] >= x or closest_point[1] >= y) and (closest_point[0] != x or closest_point[1] != y)):
-                closest_cluster = self.Cluster()
-                clusters += [closest_cluster]
-                closest_cluster.append((x, y, score, fps))
+            if cluster_nr is None or ((closest_point[0] >= x or closest_point[1] >= y) and (closest_point[0] != x or closest_point[1] != y)):
+                cluster_nr = len(clusters)
+                clusters += [self.Cluster()]
             else:
                 # check the slope
                 x_dist = x - closest_point[0]
@@ -618,12 +1733,82 @@ class FingerPrinting(AbstractMatchClass):
 
                 # if the slope is larger then 3 create a new cluster, otherwise add to old
                 if y_dist < 0 or x_dist < 0 or slope > 3:
-                    new_cluster = self.Cluster()
-                    clusters += [new_cluster]
-                    new_cluster.append((x, y, score, fps))
-                else:
-                    closest_cluster.append((x, y, score, fps))
-        return clusters
+                    cluster_nr = len(clusters)
+                    clusters += [self.Cluster()]
+
+            clusters[cluster_nr].append((x, y, score, start, end))
+            points.append(x, y, cluster_nr)
+
+    class ClusterPoints(object):
+        """
+        Holds the points of all clusters of find_diagonals. The points are added ascending by x, points with the
+        same x form a column, in which they are kept sorted by y.
+        The weighted distance of two points is at least their x-distance and their y-distance, so the closest point
+        in the lower left of a new point is searched from the last column backwards and inside of the columns from
+        the y of the new point downwards, until these distances alone exceed the lowest weighted distance found.
+        The result equals get_closest_cluster for all clusters, but only points in a bounded range are visited.
+        """
+
+        def __init__(self):
+            self.column_xs = []
+            # every column is a list of (y, point number, cluster index) sorted by y
+            self.columns = []
+            self.n_of_points = 0
+
+        def append(self, x, y, cluster_nr):
+            """
+            Adds a point, x has to be at least the x of all added points
+            :param x:
+            :param y:
+            :param cluster_nr: index of the cluster of the point
+            :return: None
+            """
+            if len(self.column_xs) == 0 or self.column_xs[-1] != x:
+                self.column_xs.append(x)
+                self.columns.append([])
+            bisect.insort(self.columns[-1], (y, self.n_of_points, cluster_nr))
+            self.n_of_points += 1
+
+        def find_closest(self, x, y):
+            """
+            Searches the closest point in the lower left of (x, y), with the euclidean distance weighted by the slope
+            like Cluster.calc_distance. Of points with the same distance, the one of the first created cluster and of
+            this cluster the first added point is chosen, like get_closest_cluster does.
+            :param x:
+            :param y:
+            :return: distance, cluster index and closest point, (None, None, None) if there is no point
+            """
+            # (distance, cluster index, point number, point)
+            closest = None
+            # the weighted distance is at least the x- and y-distance, if they are not below 0.00001,
+            # rounding differences of the distance calculation are tolerated
+            limit = math.inf
+
+            for column_nr in range(len(self.column_xs) - 1, -1, -1):
+                x_dist = x - self.column_xs[column_nr]
+                if x_dist > limit:
+                    break
+
+                column = self.columns[column_nr]
+                idx = bisect.bisect_right(column, (y, math.inf))
+                while idx > 0:
+                    idx -= 1
+                    point_y, point_nr, cluster_nr = column[idx]
+                    y_dist = y - point_y
+                    if y_dist > limit:
+                        break
+
+                    # Calculate slope that is always >= 1 and weight the euclidean distance with it
+                    slope = max(x_dist, y_dist) / max(min(x_dist, y_dist), 0.00001)
+                    dist = math.sqrt(x_dist ** 2 + y_dist ** 2) * slope
+
+                    if closest is None or (dist, cluster_nr, point_nr) < closest[:3]:
+                        closest = (dist, cluster_nr, point_nr, (self.column_xs[column_nr], point_y))
+                        limit = max(dist * (1 + 1e-9), 0.00001)
+
+            if closest is None:
+                return None, None, None
+            return closest[0], closest[1], closest[3]
 
     @staticmethod
     def get_closest_cluster(clusters, x, y):
@@ -648,151 +1833,107 @@ class FingerPrinting(AbstractMatchClass):
 
         return closest_distance, closest_cluster, closest_point
 
-    class FingerPrint(object):
+    class FingerPrint(collections.namedtuple("FingerPrint", ("TDR_HASH_TYPE", "TDR_RANGE", "TDR_RESOLUTION",
+                                                             "TDR_WINDOW", "TDR_MASK"))):
         """
-        Fingerprint-Class
+        Fingerprint-Class, holds the settings of the hash function. Every FingerPrinting-instance has its own
+        immutable FingerPrint, so indexes with different settings can be used at the same time.
         """
+        __slots__ = ()
+
         TDR_HASH_1 = 1
         TDR_HASH_2 = 2
         TDR_HASH_3 = 3
 
-        PARAM_INIT = False
-
-        TDR_RANGE = 0
-        TDR_RESOLUTION = 0
-        TDR_WINDOW = 0
-        TDR_DELTA_VALUE = 0
-        TDR_MASK = 0
-        TDR_HASH_TYPE = 0
-
-        TDR_K = 0
-        TDR_D = 0
+        @property
+        def TDR_DELTA_VALUE(self):
+            return int(self.TDR_RESOLUTION * self.TDR_WINDOW)
 
-        __slots__ = ("name", "p1", "pos1", "td12", "hash", "max_pos")
+        @property
+        def TDR_K(self):
+            return (self.TDR_RESOLUTION / 2) / (self.TDR_RANGE - 1)
 
-        def __init__(self, name, e1, e2, e3, e4):
-            if not self.PARAM_INIT:
-                raise Exception("Call Fingerprint.update_class_variables() first")
+        @property
+        def TDR_D(self):
+            return - self.TDR_K
 
-            object.__setattr__(self, "name", name)
-            object.__setattr__(self, "p1", e1[0])
-            object.__setattr__(self, "pos1", e1[1])
-            object.__setattr__(self, "td12", e2[1] - e1[1])
-            object.__setattr__(self, "max_pos", e4[1] if self.TDR_HASH_TYPE == self.TDR_HASH_3 else e3[1])
+        def create_hashes(self, pitches, positions):
+            """
+            Calculates the hash values for note combinations
+            :param pitches: array of shape (fingerprints, N) with the pitches of the fingerprint events
+            :param positions: array of shape (fingerprints, N) with the positions of the fingerprint events
+            :return: array of hash values
+            """
+            td12 = positions[:, 1] - positions[:, 0]
+            td23 = positions[:, 2] - positions[:, 1]
+            longer = td23 > td12
 
-            td23 = e3[1] - e2[1]
-
-            if td23 > self.td12:
-                tdr = abs(td23 / self.td12)
-            else:
-                tdr = abs(self.td12 / td23)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                tdr = np.abs(np.where(longer, td23 / td12, td12 / td23))
 
             # use kx+d formula to fit (MAX_TDR_VALUES-MIN_TDR_VALUE) between MIN_TDR_FLOAT and MAX_TDR_FLOAT
-            tdr = tdr * __class__.TDR_K + self.TDR_D
+            tdr = tdr * self.TDR_K + self.TDR_D
+            tdr = np.where(longer, self.TDR_RESOLUTION / 2 + tdr, self.TDR_RESOLUTION / 2 - tdr)
+            tdr = np.clip(tdr, 0, self.TDR_RESOLUTION - 1).astype(np.int64) & self.TDR_MASK
 
-            if td23 > self.td12:
-                tdr = self.TDR_RESOLUTION / 2 + tdr
-            else:
-                tdr = self.TDR_RESOLUTION / 2 - tdr
-
-            tdr = int(max(min(tdr, self.TDR_RESOLUTION - 1), 0))
-
-            h = None
-
-            # create hash value according to self.TDR_HASH_TYPE
+            # pitches are truncated like int() does
+            p = pitches.astype(np.int64)
             if self.TDR_HASH_TYPE == self.TDR_HASH_1:
-                h = int(((int(self.p1) & 0x7F) << 25) | ((int(e2[0]) & 0x7F) << 18) |
-                        ((int(e3[0]) & 0x7F) << 11) | (tdr & self.TDR_MASK))
-            elif self.TDR_HASH_TYPE == self.TDR_HASH_2:
-                h = int(((int(e2[0] - self.p1) & 0xFF) << 24) | ((int(e3[0] - e2[0]) & 0xFF) << 16) |
-                        (tdr & self.TDR_MASK))
-            elif self.TDR_HASH_TYPE == self.TDR_HASH_3:
-                h = int(((int(e2[0] - self.p1) & 0xFF) << 24) | ((int(e3[0] - e2[0]) & 0xFF) << 16) |
-                        ((int(e4[0] - e3[0]) & 0xFF) << 8) | (tdr & self.TDR_MASK))
-
-            object.__setattr__(self, "hash", h)
-
-        def __setattr__(self, *args):
-            raise AttributeError("Attributes of Immutable3 cannot be changed")
-
-        def __delattr__(self, *args):
-            raise AttributeError("Attributes of Immutable3 cannot be deleted")
-
-        @staticmethod
-        def update_class_variables(TDR_HASH_TYPE, TDR_RANGE, TDR_RESOLUTION, TDR_WINDOW, TDR_MASK):
-            __class__.TDR_RANGE = TDR_RANGE
-            __class__.TDR_RESOLUTION = TDR_RESOLUTION
-            __class__.TDR_WINDOW = TDR_WINDOW
-            __class__.TDR_DELTA_VALUE = int(TDR_RESOLUTION * TDR_WINDOW)
-            __class__.TDR_MASK = TDR_MASK
-            __class__.TDR_HASH_TYPE = TDR_HASH_TYPE
-
-            __class__.TDR_K = (TDR_RESOLUTION / 2) / (TDR_RANGE - 1)
-            __class__.TDR_D = - __class__.TDR_K
+                h = ((p[:, 0] & 0x7F) << 25) | ((p[:, 1] & 0x7F) << 18) | ((p[:, 2] & 0x7F) << 11) | tdr
+            else:
+                dp = (pitches[:, 1:] - pitches[:, :-1]).astype(np.int64) & 0xFF
+                if self.TDR_HASH_TYPE == self.TDR_HASH_2:
+                    h = (dp[:, 0] << 24) | (dp[:, 1] << 16) | tdr
+                elif self.TDR_HASH_TYPE == self.TDR_HASH_3:
+                    h = (dp[:, 0] << 24) | (dp[:, 1] << 16) | (dp[:, 2] << 8) | tdr
+                else:
+                    raise Exception("Unknown hash type {}".format(self.TDR_HASH_TYPE))
 
-            __class__.PARAM_INIT = True
+            return h.astype(np.uint32)
 
-        def get_hash_iterator(self):
+        def get_hash_ranges(self, hashes):
             """
-            Returns a list of hashes where the tdr-range is adopted for each hash.
-            :return: list of hashes
+            Returns for every hash the range of hashes, where the tdr-range is adopted. The tdr is stored in the
+            lowest bits of the hash, so all accepted hashes form a contiguous range.
+            :param hashes: array of hash values
+            :return: array with the lowest and array with the highest accepted hash values
             """
-            tdr = self.hash & self.TDR_MASK
-            min_tdr = max(0, tdr - self.TDR_DELTA_VALUE)
-            max_tdr = min(self.TDR_RESOLUTION - 1, tdr + self.TDR_DELTA_VALUE)
-
-            part_hash = int(self.hash & (0xFFFFFFFF ^ self.TDR_MASK))
-            hash_list = [self.hash]
-
-            # add hashes in order, where they are closest to the original hash
-            # so smaller differences are found faster
-            # this assumes, that smaller tempo errors are more frequent than larger ones
-            for tdr_offset in range(1, self.TDR_DELTA_VALUE + 1):
-                if max_tdr >= tdr_offset + tdr:
-                    hash_list.append(int(part_hash | int(tdr + tdr_offset)))
-                if min_tdr <= tdr - tdr_offset:
-                    hash_list.append(int(part_hash | int(tdr - tdr_offset)))
+            hashes = np.asarray(hashes, dtype=np.int64)
+            tdr = hashes & self.TDR_MASK
+            part_hash = hashes & (0xFFFFFFFF ^ self.TDR_MASK)
 
-            return hash_list
+            lower = part_hash | np.maximum(0, tdr - self.TDR_DELTA_VALUE)
+            upper = part_hash | np.minimum(self.TDR_RESOLUTION - 1, tdr + self.TDR_DELTA_VALUE)
 
-        def __repr__(self):
-            return self.name + "_" + str(self.pos1)
+            # the hash itself is always accepted
+            return np.minimum(lower, hashes), np.maximum(upper, hashes)
 
-        def __str__(self):
-            return self.name + "_" + str(self.pos1)
+        def get_neighbour_hashes(self, hashes):
+            """
+            Returns all hashes, whose tdr-range can contain one of the given hashes: the hashes with the same pitch
+            part and a tdr-value, which differs by at most TDR_DELTA_VALUE
+            :param hashes: array of hash values
+            :return: array of hash values, may contain duplicates
+            """
+            hashes = np.asarray(hashes, dtype=np.int64)
+            tdr = hashes & self.TDR_MASK
+            part_hash = hashes & (0xFFFFFFFF ^ self.TDR_MASK)
 
-        def __hash__(self):
-            return self.hash
+            neighbour_tdr = tdr[:, None] + np.arange(-self.TDR_DELTA_VALUE, self.TDR_DELTA_VALUE + 1)
+            valid = (neighbour_tdr >= 0) & (neighbour_tdr <= min(self.TDR_RESOLUTION - 1, self.TDR_MASK))
+            return (part_hash[:, None] | neighbour_tdr)[valid]
 
-        def __eq__(self, other):
-            if isinstance(other, self.__class__):
-                return self.hash == other.hash
-            else:
-                return False
 
-        def __ne__(self, other):
-            return not self.__eq__(other)
+# FingerPrinting-instance of an index worker process
+_worker_fingerprinting = None
 
-        def __lt__(self, other):
-            if isinstance(other, self.__class__):
-                return (self.pos1 - other.pos1) < 0
-            else:
-                return False
 
-        def __le__(self, other):
-            if isinstance(other, self.__class__):
-                return (self.pos1 - other.pos1) <= 0
-            else:
-                return False
+def _init_index_worker(parameters):
+    """ Initializes a worker process of the index creation with the fingerprint parameters"""
+    global _worker_fingerprinting
+    _worker_fingerprinting = FingerPrinting(MidiLibrary(None), **parameters)
 
-        def __gt__(self, other):
-            if isinstance(other, self.__class__):
-                return (self.pos1 - other.pos1) > 0
-            else:
-                return False
 
-        def __ge__(self, other):
-            if isinstance(other, self.__class__):
-                return (self.pos1 - other.pos1) >= 0
-            else:
-                return False
+def _create_batch_fingerprints(batch):
+    """ Creates the fingerprints of a batch of files inside of a worker process"""
+    return _worker_fingerprinting.create_batch_fingerprints(batch)
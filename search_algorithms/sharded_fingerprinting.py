@@ -0,0 +1,428 @@
+from search_algorithms.abstract_match_algorithm import AbstractMatchClass
+from search_algorithms.fingerprinting import FingerPrinting
+from search_algorithms.fingerprint_index import FingerPrintIndex
+from library.midilibrary import MidiLibrary
+from library.midifile import MidiFile
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import collections
+import multiprocessing
+import os
+
+
+class FingerPrintShard(object):
+    """
+    A shard of a partitioned fingerprint-index. It holds the FingerPrinting-index of a part of the library
+    and answers the messages of a ShardedFingerPrinting coordinator.
+    """
+
+    # Messages of the coordinator, every message is a tuple starting with one of these
+    MSG_INDEX = "index"
+    MSG_UPDATE = "update"
+    MSG_SEARCH = "search"
+    MSG_EXIT = "exit"
+
+    # Replies are tuples of (status, result), on errors result is the error message
+    REPLY_OK = "ok"
+    REPLY_ERROR = "error"
+
+    def __init__(self):
+        self.library = MidiLibrary(None)
+        self.fingerprinting = None
+
+        # position of every file in the library of the coordinator
+        self.positions = dict()
+
+    def serve(self, connection):
+        """
+        Answers the messages received on connection, until MSG_EXIT is received or the coordinator disconnects.
+        The messages are unpickled, the connection has to be authenticated with a secret key (see serve_shard).
+        :param connection: multiprocessing connection to the coordinator
+        :return: None
+        """
+        handlers = {
+            self.MSG_INDEX: self.index,
+            self.MSG_UPDATE: self.update,
+            self.MSG_SEARCH: self.search
+        }
+
+        while True:
+            try:
+                msg = connection.recv()
+            except EOFError:
+                return
+
+            if msg[0] == self.MSG_EXIT:
+                return
+
+            try:
+                if msg[0] not in handlers:
+                    raise Exception("Unknown message {}".format(msg[0]))
+                reply = (self.REPLY_OK, handlers[msg[0]](*msg[1:]))
+            except Exception as e:
+                reply = (self.REPLY_ERROR, "{}: {}".format(type(e).__name__, e))
+            connection.send(reply)
+
+    def index(self, parameters, midifiles):
+        """
+        Sets the files of this shard. Fingerprints are created for new files and removed for files,
+        which are not part of the shard anymore.
+        :param parameters: FingerPrinting parameters
+        :param midifiles: list of (position in the library, name, path) of all files of the shard
+        :return: the key table of the index
+        """
+        names = set(name for _, name, _ in midifiles)
+        for name in [name for name in self.library.get_midifile_names() if name not in names]:
+            self.library.remove_midifile(name)
+
+        self.positions = dict()
+        for position, name, path in midifiles:
+            self.positions[name] = position
+            if name not in self.library.get_midifile_names():
+                try:
+                    self.library.update_midifile(name, path)
+                except Exception as e:
+                    print(e)
+
+        if self.fingerprinting is None:
+            self.fingerprinting = FingerPrinting(self.library, **parameters)
+        else:
+            self.fingerprinting.create_fp_from_library()
+
+        return self.fingerprinting.get_index().get_key_table()
+
+    def update(self, name, path):
+        """
+        Loads a changed file again and creates its fingerprints
+        :param name: name of the file
+        :param path: path of the changed file
+        :return: the key table of the index
+        """
+        self.library.update_midifile(name, path)
+        self.fingerprinting.update_midifile(name)
+
+        return self.fingerprinting.get_index().get_key_table()
+
+    def search(self, windows, top_x):
+        """
+        Matches the query windows resolved by the coordinator against the files of this shard.
+        :param windows: list of (fingerprints, position of the window in the query), the hash of every fingerprint
+                        is the stored hash of the whole library, which was chosen for it
+        :param top_x: number of results to return, None returns all matched files
+        :return: list of (rank key, name, score, start, end) of the top clusters, sorted like the results of search.
+                 The rank key orders the files with the same score like a single index does.
+        """
+        fingerprinting = self.fingerprinting
+        index = fingerprinting.get_index()
+
+        matchdict = dict()
+        first_seen = dict()
+        for window_nr, (fingerprints, split_offset) in enumerate(windows):
+            hashes = fingerprints["hash"]
+            buckets = index.find_nearest_buckets(hashes, hashes, hashes)
+            query_idx = np.flatnonzero(buckets >= 0)
+            histograms, pair_query_idx = fingerprinting.match_buckets(fingerprints, query_idx, buckets[query_idx])
+
+            # a single index sees the files in the order of their first matched pair, which is given by the window,
+            # the query fingerprint and the order of the postings of a bucket, e.g. the library order
+            first_fingerprints = pair_query_idx[histograms.get_first_matches()]
+            for doc_id, fingerprint in zip(histograms.get_doc_ids().tolist(), first_fingerprints.tolist()):
+                name = index.names[doc_id]
+                first_seen.setdefault(name, (window_nr, fingerprint, self.positions[name]))
+
+            fingerprinting.add_top_bins(matchdict, histograms, split_offset)
+
+        if top_x is None:
+            clustered = fingerprinting.cluster_matches(matchdict)
+        else:
+            clustered = fingerprinting.cluster_top_matches(matchdict, top_x)
+
+        results = [(first_seen[name], name, top_cluster.score, top_cluster.start, top_cluster.end)
+                   for name, top_cluster, _ in clustered]
+        results.sort(key=lambda result: (-result[2], result[0]))
+
+        return results
+
+
+def serve_shard(address, authkey, ready=None):
+    """
+    Runs a shard, which waits on address for a coordinator and answers its messages, until it is closed.
+    On separate nodes every node calls e.g. serve_shard(("10.0.0.5", 6000), key) with the address of a private
+    interface and the coordinator gets the addresses of all nodes and the key, the files of the library have to be
+    found on the nodes under the same paths.
+    The messages are unpickled, so everyone knowing the key can run code on the shard. The key has to be secret,
+    e.g. os.urandom(32), and the port must only be reachable from trusted hosts.
+    :param address: (host, port) to listen on, port 0 picks a free port
+    :param authkey: secret key, the coordinator has to authenticate with
+    :param ready: optional connection, the address of the shard is sent to it as soon as it is listening
+    :return: None
+    """
+    if not authkey:
+        raise Exception("A shard needs a secret authkey")
+
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+
+        with listener.accept() as connection:
+            FingerPrintShard().serve(connection)
+
+
+class ShardedFingerPrinting(FingerPrinting):
+    """
+    Partitioned deployment of FingerPrinting. The files of the library are split by document over several
+    shards, every shard holds the index of its files in its own process and listens on a socket.
+
+    The coordinator only keeps the hashes and bucket lengths of all shards. It creates the query fingerprints,
+    chooses the closest stored hash for every fingerprint and applies the stop-list with the bucket lengths of the whole
+    library, so every shard scores the same pairs as a single index would. The shards cluster the matches of their
+    files and return their top results, which are merged into the ranking of FingerPrinting.search.
+    The ranking equals the one of a single index, which was created from the library at once.
+    """
+
+    SHARDS = "shards"
+    SHARD_ADDRESSES = "shard_addresses"
+    SHARD_AUTHKEY = "shard_authkey"
+
+    DEFAULT_SHARDS = 2
+
+    # Snapshot directory of a shard inside of the index snapshot directory
+    SHARD_SNAPSHOT_DIR = "shard_{:d}"
+
+    def __init__(self, database: MidiLibrary, notify_init_status=None, **kwargs):
+        """
+        :param database: The database to perform the algorithm on
+        :param kwargs: are holding custom parameters for the algorithm settings. Without SHARD_ADDRESSES, SHARDS
+                       shard processes are started on this machine with a random key, otherwise the shards running
+                       at these addresses (see serve_shard) are used, they need the secret key SHARD_AUTHKEY.
+        """
+        kwargs = dict(kwargs)
+        addresses = kwargs.pop(self.SHARD_ADDRESSES, None)
+        n_of_shards = kwargs.pop(self.SHARDS, self.DEFAULT_SHARDS)
+        authkey = kwargs.pop(self.SHARD_AUTHKEY, None)
+        self._snapshot = kwargs.pop(self.INDEX_SNAPSHOT, None)
+        # the stop list is applied with the bucket lengths of the whole library, a shard can not prune its buckets
+        kwargs.pop(self.PRUNE_STOP_LIST, None)
+        self._shard_parameters = kwargs
+
+        self._processes = []
+        if addresses is None:
+            authkey = os.urandom(32)
+            addresses = self._start_local_shards(n_of_shards, authkey)
+        elif not authkey:
+            raise Exception("The shards at {} need the secret key {}".format(addresses, self.SHARD_AUTHKEY))
+        self._connections = [Client(address, authkey=authkey) for address in addresses]
+
+        # shard of every indexed file and the key table of every shard
+        self._shard_of = dict()
+        self._key_tables = [None] * len(self._connections)
+
+        super().__init__(database, notify_init_status, **kwargs)
+
+    def _start_local_shards(self, n_of_shards, authkey):
+        """
+        Starts shard processes listening on localhost
+        :param n_of_shards: number of shards
+        :param authkey: key of the shards
+        :return: list of shard addresses
+        """
+        addresses = []
+        for _ in range(n_of_shards):
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=serve_shard, args=(("localhost", 0), authkey, sender),
+                                              daemon=True)
+            process.start()
+            sender.close()
+            self._processes.append(process)
+            addresses.append(receiver.recv())
+        return addresses
+
+    def close(self):
+        """ Stops all shards, local shard processes are joined"""
+        for connection in self._connections:
+            try:
+                connection.send((FingerPrintShard.MSG_EXIT, ))
+                connection.close()
+            except OSError as e:
+                print(e)
+        for process in self._processes:
+            process.join()
+
+        self._connections = []
+        self._processes = []
+
+    def get_algorithm_name(self):
+        return "ShardedFingerPrinting"
+
+    def create_query_session(self, query_name="", get_top_x=1):
+        """ The postings are stored by the shards, query sessions are not supported"""
+        raise Exception("Query sessions are not supported by {}".format(self.get_algorithm_name()))
+
+    def _get_shard_parameters(self, shard):
+        """ Returns the FingerPrinting parameters of a shard"""
+        parameters = dict(self._shard_parameters)
+        if self._snapshot is not None:
+            parameters[self.INDEX_SNAPSHOT] = os.path.join(self._snapshot, self.SHARD_SNAPSHOT_DIR.format(shard))
+        return parameters
+
+    def _request(self, messages):
+        """
+        Sends messages to shards and waits for all replies, the shards work on their messages at the same time
+        :param messages: dictionary of shard number to message
+        :return: list of the results, in the order of messages
+        """
+        for shard, msg in messages.items():
+            self._connections[shard].send(msg)
+
+        results = []
+        errors = []
+        for shard in messages:
+            status, result = self._connections[shard].recv()
+            if status == FingerPrintShard.REPLY_OK:
+                results.append(result)
+            else:
+                errors.append("Shard {:d}: {}".format(shard, result))
+
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
+        return results
+
+    def _update_key_tables(self, key_tables):
+        """
+        Merges the hashes and bucket lengths of all shards after some shards have changed
+        :param key_tables: dictionary of shard number to its new key table
+        :return: None
+        """
+        for shard, key_table in key_tables.items():
+            self._key_tables[shard] = key_table
+        self._fingerprints = FingerPrintIndex.from_key_tables([key_table for key_table in self._key_tables
+                                                               if key_table is not None])
+        self._update_quantile()
+        self._index_changed()
+
+    def _index_shards(self, shards):
+        """
+        Sends the files of shards to them, the shards create or remove fingerprints to match their files
+        :param shards: list of shard numbers
+        :return: None
+        """
+        positions = dict()
+        for position, midifile in enumerate(self.database.get_midifiles()):
+            if isinstance(midifile, MidiFile):
+                positions[midifile.name] = (position, midifile.file_path)
+
+        partitions = dict((shard, []) for shard in shards)
+        for name, shard in self._shard_of.items():
+            if shard in partitions:
+                partitions[shard].append((positions[name][0], name, positions[name][1]))
+
+        messages = dict((shard, (FingerPrintShard.MSG_INDEX, self._get_shard_parameters(shard), sorted(partition)))
+                        for shard, partition in partitions.items())
+        self._update_key_tables(dict(zip(messages, self._request(messages))))
+
+    def create_fp_from_library(self, notify_init_status=None):
+        """
+        Distributes new files of the library over the shards, a new file is given to the shard with the fewest files.
+        Files, which were removed from the library, are removed from their shards.
+        """
+        names = [midifile.name for midifile in self.database.get_midifiles() if isinstance(midifile, MidiFile)]
+
+        library_names = set(names)
+        for name in [name for name in self._shard_of if name not in library_names]:
+            del self._shard_of[name]
+
+        n_of_files = collections.Counter(self._shard_of.values())
+        for name in names:
+            if name not in self._shard_of:
+                shard = min(range(len(self._connections)), key=lambda s: n_of_files[s])
+                self._shard_of[name] = shard
+                n_of_files[shard] += 1
+
+        self._in_db = set(self._shard_of)
+        self._index_shards(list(range(len(self._connections))))
+
+        if notify_init_status is not None:
+            notify_init_status("fp", len(names), len(names), "")
+
+    def remove_midifile(self, name):
+        """
+        Removes the fingerprints of a file from its shard
+        :param name: name of the midifile
+        :return: True, if the file was in the index
+        """
+        shard = self._shard_of.pop(name, None)
+        if shard is None:
+            return False
+
+        self._in_db.discard(name)
+        self._index_shards([shard])
+        return True
+
+    def update_midifile(self, name, notify_init_status=None):
+        """
+        Creates the fingerprints of a changed file of the library again on its shard, the file has to be updated
+        in the library first (MidiLibrary.update_midifile).
+        :param name: name of the midifile
+        :param notify_init_status: optional callback for progress
+        :return: None
+        """
+        if name not in self._shard_of or name not in self.database.get_midifile_names():
+            super().update_midifile(name, notify_init_status)
+            return
+
+        shard = self._shard_of[name]
+        path = self.database.get_midifile_view(name).file_path
+        self._update_key_tables({shard: self._request({shard: (FingerPrintShard.MSG_UPDATE, name, path)})[0]})
+
+    def _search(self, query, query_name="", evaluate=False, get_top_x=1):
+        """
+        Searches the query on all shards and merges their results, see FingerPrinting.search.
+        If evaluate is False, every shard only returns its get_top_x best files.
+        """
+        if isinstance(query, MidiFile):
+            query_name = query.name
+            query_notes = query.get_notes_for_fingerprints()
+        else:
+            query_notes = query
+
+        created_fingerprints = 0
+        windows = []
+        for split_idx, fingerprints, created in self.create_window_fingerprints(query_notes):
+            created_fingerprints += created
+
+            # the shards look up the chosen hashes of the whole library
+            query_idx, buckets = self.find_query_buckets(fingerprints)
+            window_fingerprints = fingerprints[query_idx]
+            window_fingerprints["hash"] = self._fingerprints.hashes[buckets]
+            windows.append((window_fingerprints, query_notes[split_idx, 1]))
+
+        top_x = None if evaluate else get_top_x
+        msg = (FingerPrintShard.MSG_SEARCH, windows, top_x)
+        matches = [match for shard_matches in self._request(dict((shard, msg) for shard in
+                                                                 range(len(self._connections))))
+                   for match in shard_matches]
+        matches.sort(key=lambda match: (-match[2], match[0]))
+
+        results = []
+        for _, name, score, start, end in matches:
+            top_cluster = self.Cluster()
+            top_cluster.score, top_cluster.start, top_cluster.end = score, start, end
+            results.append((name, top_cluster))
+
+        return self._format_results(results, created_fingerprints, evaluate, get_top_x)
+
+    def search_rank(self, query, query_name=""):
+        """
+        The coordinator holds no postings, the file is ranked by the shards with the default of AbstractMatchClass,
+        which ranks all files with search(query, evaluate=True)
+        """
+        return AbstractMatchClass.search_rank(self, query, query_name)
+
+    def search_ranks(self, queries, query_names=None):
+        """ The queries are ranked one after the other with search_rank, see AbstractMatchClass.search_ranks"""
+        return AbstractMatchClass.search_ranks(self, queries, query_names)
+
+    def search_many(self, queries, query_names=None, evaluate=False, get_top_x=1):
+        """ The queries are searched one after the other with search, see AbstractMatchClass.search_many"""
+        return AbstractMatchClass.search_many(self, queries, query_names, evaluate, get_top_x)
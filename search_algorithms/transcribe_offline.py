@@ -34,15 +34,24 @@ class Transcriptor:
     def process_file(self, input):
         """ Transform input to a note and duration list.
         The output is a 2 column table."""
-        activations = self.rnn_processor.process(input)
-        notes = self.peak_picker(activations)
-        if notes.shape[0] < 3:
+        retval = self.process_chunk(input)
+        if retval.shape[0] < 3:
             raise Exception("Not enough notes in query detected")
-        retval = np.zeros(notes.shape)
-        retval[:, 0] = notes[:, 1]
-        retval[:, 1] = notes[:, 0]
 
         return retval
 
+    def process_chunk(self, input, start=0.0):
+        """ Transform a part of a recording to a note and duration list, the
+        positions of the notes are shifted by start seconds. Unlike process_file,
+        a chunk may contain less than 3 notes.
+        The output is a 2 column table."""
+        activations = self.rnn_processor.process(input)
+        notes = self.peak_picker(activations)
+        if notes.shape[0] == 0:
+            return np.zeros((0, 2))
 
+        retval = np.zeros(notes.shape)
+        retval[:, 0] = notes[:, 1]
+        retval[:, 1] = notes[:, 0] + start
 
+        return retval
@@ -0,0 +1,50 @@
+"""
+Checks the vectorized fingerprint creation against the loops, which created the fingerprints before.
+
+Usage: python -m pytest tests
+"""
+from library.midilibrary import MidiLibrary
+from search_algorithms.fingerprinting import FingerPrinting
+from search_algorithms.benchmark import _create_fingerprints_loops, _select_next_events_loop
+import numpy as np
+import os
+import pytest
+
+SMALL_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "small_db")
+
+# Number of files of small_db, which are compared with the loops
+N_OF_FILES = 30
+
+SETTINGS = ("PARAM_SETTING_1", "PARAM_SETTING_2", "PARAM_SETTING_3")
+
+
+@pytest.fixture(scope="module")
+def library_notes():
+    library = MidiLibrary(SMALL_DB_PATH)
+    midifiles = sorted(library.get_midifiles(), key=lambda midifile: midifile.name)[:N_OF_FILES]
+    return [(midifile.name, midifile.get_notes_for_fingerprints()) for midifile in midifiles]
+
+
+@pytest.mark.parametrize("setting", SETTINGS)
+def test_select_next_events(library_notes, setting):
+    fingerprinting = FingerPrinting(MidiLibrary(None), **getattr(FingerPrinting, setting))
+    for name, notes in library_notes:
+        successors = fingerprinting._select_next_events(np.asarray(notes[:, 0], dtype=np.float64),
+                                                        np.asarray(notes[:, 1], dtype=np.float64))
+        reference = [_select_next_events_loop(fingerprinting, notes.tolist(), idx, 1)[0]
+                     for idx in range(notes.shape[0])]
+        assert successors.tolist() == reference, name
+
+
+@pytest.mark.parametrize("setting", SETTINGS)
+@pytest.mark.parametrize("remove_doubles", (False, True))
+def test_create_fingerprints(library_notes, setting, remove_doubles):
+    fingerprinting = FingerPrinting(MidiLibrary(None), **getattr(FingerPrinting, setting))
+    for name, notes in library_notes:
+        fingerprints, created = fingerprinting.create_fingerprints(notes, name, remove_doubles)
+        reference, reference_created = _create_fingerprints_loops(fingerprinting, notes, remove_doubles)
+
+        assert created == reference_created, name
+        assert fingerprints["hash"].tolist() == [fingerprint[0] for fingerprint in reference], name
+        assert fingerprints["pos1"].tolist() == [fingerprint[1] for fingerprint in reference], name
+        assert fingerprints["td12"].tolist() == [fingerprint[2] for fingerprint in reference], name